@@ -22,6 +22,57 @@ class ApplicationConf:
         self.CONNECTION_TIMEOUT = conf['CONNECTION_TIMEOUT']
         self.DOWNLOAD_TIMEOUT = conf['DOWNLOAD_TIMEOUT']
         self.MAX_RETRIES = conf['MAX_RETRIES']
+        # delay (seconds) before the second attempt of a failed upstream request, doubled for every next one
+        # and randomized; upper bound of the delay; longest Retry-After the server may ask us to wait
+        self.RETRY_BACKOFF_BASE = conf.get('RETRY_BACKOFF_BASE', 0.5)
+        self.RETRY_BACKOFF_MAX = conf.get('RETRY_BACKOFF_MAX', 10)
+        self.RETRY_AFTER_MAX = conf.get('RETRY_AFTER_MAX', 60)
+        # after this many failed requests in a row a host is not asked for CIRCUIT_BREAKER_RESET_TIMEOUT
+        # seconds: requests fail at once and cached data is served (0 = never)
+        self.CIRCUIT_BREAKER_THRESHOLD = conf.get('CIRCUIT_BREAKER_THRESHOLD', 5)
+        self.CIRCUIT_BREAKER_RESET_TIMEOUT = conf.get('CIRCUIT_BREAKER_RESET_TIMEOUT', 30)
+        # how long (seconds) project index data in the DB is served without asking the remote index
+        self.INDEX_TTL = conf.get('INDEX_TTL', 600)
+        # number of threads refreshing stale projects in background
+        self.REFRESH_WORKERS = conf.get('REFRESH_WORKERS', 4)
+        # fetch project pages and JSON with asyncio (needs aiohttp): both documents at once, and batches of
+        # projects concurrently with up to ASYNC_FETCH_CONCURRENCY connections
+        self.ASYNC_FETCH = conf.get('ASYNC_FETCH', True)
+        self.ASYNC_FETCH_CONCURRENCY = conf.get('ASYNC_FETCH_CONCURRENCY', 32)
+        # kept-alive upstream connections per host; [HTTP_HOST_POOL_SIZES] table overrides it for particular hosts
+        self.HTTP_POOL_SIZE = conf.get('HTTP_POOL_SIZE', 10)
+        self.HTTP_HOST_POOL_SIZES = conf.get('HTTP_HOST_POOL_SIZES', {})
+        # production server (`serve` command): worker processes, threads per worker,
+        # seconds given to running requests on shutdown
+        self.SERVER_WORKERS = conf.get('SERVER_WORKERS', os.cpu_count() or 1)
+        self.SERVER_THREADS = conf.get('SERVER_THREADS', 16)
+        self.GRACEFUL_TIMEOUT = conf.get('GRACEFUL_TIMEOUT', 30)
+        # how cached files are sent: "wsgi" (server's sendfile), "x-accel-redirect" (nginx) or "x-sendfile"
+        self.SENDFILE_MODE = conf.get('SENDFILE_MODE', 'wsgi')
+        if self.SENDFILE_MODE not in ('wsgi', 'x-accel-redirect', 'x-sendfile'):
+            raise ValueError(f"Неизвестный SENDFILE_MODE: {self.SENDFILE_MODE}")
+        # nginx internal location which aliases CACHE_DIR, used with SENDFILE_MODE = "x-accel-redirect"
+        self.X_ACCEL_REDIRECT_PREFIX = conf.get('X_ACCEL_REDIRECT_PREFIX', '/_cache/')
+        # interrupted downloads not resumed for this long (seconds) are deleted at startup
+        self.PARTIAL_DOWNLOAD_MAX_AGE = conf.get('PARTIAL_DOWNLOAD_MAX_AGE', 7 * 24 * 3600)
+        # cache limits: total size of cached files (bytes) and time since the last access (seconds); 0 = no limit
+        self.CACHE_MAX_SIZE = conf.get('CACHE_MAX_SIZE', 0)
+        self.CACHE_MAX_AGE = conf.get('CACHE_MAX_AGE', 0)
+        # which files are deleted first: "lru" (least recently used) or "lfu" (least frequently used)
+        self.CACHE_EVICTION_POLICY = conf.get('CACHE_EVICTION_POLICY', 'lru')
+        if self.CACHE_EVICTION_POLICY not in ('lru', 'lfu'):
+            raise ValueError(f"Неизвестный CACHE_EVICTION_POLICY: {self.CACHE_EVICTION_POLICY}")
+        # seconds between eviction runs
+        self.CACHE_EVICTION_INTERVAL = conf.get('CACHE_EVICTION_INTERVAL', 60)
+        # keep /simple/ pages compressed with brotli too (needs the brotli package), not only gzip
+        self.SIMPLE_PAGES_BROTLI = conf.get('SIMPLE_PAGES_BROTLI', True)
+        # files downloaded at the same time by prefetch (cache warm-up)
+        self.PREFETCH_WORKERS = conf.get('PREFETCH_WORKERS', 4)
+        # project mirroring: files downloaded at the same time by one job, and requests per second
+        # to any host (0 = no limit); [MIRROR_HOST_RATE_LIMITS] table overrides it for particular hosts
+        self.MIRROR_WORKERS = conf.get('MIRROR_WORKERS', 4)
+        self.MIRROR_RATE_LIMIT = conf.get('MIRROR_RATE_LIMIT', 0)
+        self.MIRROR_HOST_RATE_LIMITS = conf.get('MIRROR_HOST_RATE_LIMITS', {})
 
         self.LOG_FILE_PATH = os.path.normpath(os.path.join(self.WORKDIR, "messages.log"))
         self.DB_FILE_PATH = os.path.normpath(os.path.join(self.WORKDIR, "remote_index.sqlite"))
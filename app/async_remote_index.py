@@ -0,0 +1,230 @@
+import asyncio
+import json
+import threading
+
+try:
+    import aiohttp
+except ImportError:
+    # optional: pip install pypi-offgrid[async]
+    aiohttp = None
+
+from app.remote_simple_index import SIMPLE_ACCEPT, RemoteSimpleIndex
+from app.simple_page_parser import parse_simple_json, parse_simple_page
+from app.upstream_retry import parse_retry_after
+
+
+class AsyncResponse:
+    """Body and headers of an aiohttp response, read while the connection was open"""
+
+    def __init__(self, status_code, headers, url, content):
+        self.status_code = status_code
+        self.headers = headers
+        self.url = url
+        self.content = content
+
+    @property
+    def text(self):
+        return self.content.decode("utf-8")
+
+    def json(self):
+        return json.loads(self.content)
+
+
+class AsyncRemoteSimpleIndex(RemoteSimpleIndex):
+    """RemoteSimpleIndex on asyncio: the simple page and the JSON of a project are fetched at the same time,
+    and a batch of projects is fetched concurrently by one event loop thread instead of a thread per project.
+
+    The event loop runs in its own thread; the blocking methods (fetch_project, fetch_projects, ...)
+    can be called from any thread. Needs the aiohttp package.
+    """
+
+    def __init__(self, logger, simple_url, json_url, connect_timeout=5, download_timeout=30, max_retries=3,
+                 http_client=None, concurrency=32, retry_policy=None):
+        """Initialize AsyncRemoteSimpleIndex class
+
+        Args:
+            concurrency (int): Max number of connections (requests in flight)
+            (other arguments are the same as of RemoteSimpleIndex)
+        """
+        if aiohttp is None:
+            raise ImportError("AsyncRemoteSimpleIndex needs aiohttp: pip install pypi-offgrid[async]")
+        super().__init__(
+            logger, simple_url, json_url, connect_timeout, download_timeout, max_retries, http_client, retry_policy
+        )
+        self.concurrency = concurrency
+
+        self.lock = threading.Lock()
+        self.loop = None
+        self.session = None
+
+    def _get_loop(self):
+        """Event loop of the engine, started on first use (after gunicorn forked the worker)"""
+        with self.lock:
+            if self.loop is None:
+                self.loop = asyncio.new_event_loop()
+                threading.Thread(target=self.loop.run_forever, name="async-index", daemon=True).start()
+            return self.loop
+
+    def _run(self, coroutine):
+        """Run the coroutine on the engine's event loop and wait for its result"""
+        return asyncio.run_coroutine_threadsafe(coroutine, self._get_loop()).result()
+
+    def _get_session(self):
+        # called on the event loop only, so no lock is needed;
+        # requests over the connector limits wait for a free connection
+        if self.session is None:
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.concurrency),
+                timeout=aiohttp.ClientTimeout(sock_connect=self.connect_timeout, sock_read=self.download_timeout),
+            )
+        return self.session
+
+    async def fetch_response_async(self, url, validators=None, headers=None):
+        """Получает ответ по URL, как fetch_response, но в event loop."""
+        self.logger.info(f"Fetching content from {url}")
+        headers = dict(headers or {})
+        if validators:
+            if validators.get("etag"):
+                headers["If-None-Match"] = validators["etag"]
+            if validators.get("last_modified"):
+                headers["If-Modified-Since"] = validators["last_modified"]
+
+        # aiohttp doesn't go through HttpClient, but the offline mode and the circuit breaker are the same
+        circuit_breaker = self.http.circuit_breaker
+        session = self._get_session()
+        for attempt in range(self.retry_policy.max_retries):
+            retry_after = None
+            if self.http.offline_mode is not None:
+                self.http.offline_mode.check(url)
+            if circuit_breaker is not None:
+                circuit_breaker.before_request(url)
+            try:
+                async with session.get(url, headers=headers) as response:
+                    retry_after = parse_retry_after(response.headers.get("Retry-After"))
+                    if circuit_breaker is not None:
+                        circuit_breaker.record_response(url, response.status, retry_after)
+                    if not self.retry_policy.is_retryable(response.status):
+                        if response.status == 304:
+                            self.logger.debug(f"Not modified: {url}")
+                        else:
+                            # 4xx answers won't change on retry
+                            response.raise_for_status()
+                        return AsyncResponse(response.status, response.headers, str(response.url), await response.read())
+                    self.logger.debug(f"Error fetching content: {url} answered {response.status}")
+            except (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError, asyncio.TimeoutError) as e:
+                self.logger.debug(f"Error fetching content: {e!r}")
+                if circuit_breaker is not None:
+                    circuit_breaker.record_failure(url)
+
+            delay = self.retry_policy.get_delay(attempt, retry_after)
+            if delay is None:
+                break
+            self.logger.debug(f"Retrying {url} in {delay:.1f} seconds")
+            await asyncio.sleep(delay)
+        raise IOError(f"Failed to fetch content from {url} after {attempt + 1} attempts")
+
+    async def fetch_simple_links_async(self, project_name, validators=None):
+        """Получает SIMPLE LINKS для пакета, см. fetch_simple_links."""
+        remote_url = self.remote_simple_url % project_name
+        self.logger.debug(f"Fetching SIMPLE LINKS from {remote_url}")
+        response = await self.fetch_response_async(remote_url, validators, {"Accept": SIMPLE_ACCEPT})
+        if response.status_code == 304:
+            return None, None, self.get_validators(response)
+
+        content_type = response.headers.get("Content-Type", "")
+        if content_type.startswith("application/vnd.pypi.simple.v1+json"):
+            links, link_attrs = parse_simple_json(response.json(), response.url)
+        else:
+            links, link_attrs = parse_simple_page(response.text, response.url)
+        return links, link_attrs, self.get_validators(response)
+
+    async def fetch_pypi_json_async(self, project_name, validators=None):
+        """Получает JSON для пакета, см. fetch_pypi_json."""
+        remote_url = self.remote_json_url % project_name
+        self.logger.info(f"Fetching JSON from {remote_url}")
+        response = await self.fetch_response_async(remote_url, validators)
+        if response.status_code == 304:
+            return None, self.get_validators(response)
+        return (response.json() if response.content else None), self.get_validators(response)
+
+    async def fetch_pypi_json_or_skip_async(self, project_name, package_validators=None):
+        """JSON of the project and its validators; if the JSON fails, see skip_pypi_json"""
+        try:
+            project_info, new_package_validators = await self.fetch_pypi_json_async(project_name, package_validators)
+        except Exception as e:
+            return self.skip_pypi_json(project_name, e), package_validators
+        if project_info is None:
+            new_package_validators = self.merge_validators(package_validators, new_package_validators)
+        return project_info, new_package_validators
+
+    async def fetch_project_async(self, project_name, simple_validators=None, package_validators=None):
+        """Получает SIMPLE LINKS и JSON пакета, см. fetch_project.
+
+        If the saved JSON is as recent as the saved page (same serial), the page is fetched first and the
+        JSON only if the serial of the page changed, like fetch_project does. Otherwise (a new project,
+        an index without serials) both are fetched at the same time; the requests are conditional,
+        so a JSON which didn't change costs a 304.
+        """
+        saved_serial = (package_validators or {}).get("last_serial")
+        json_task = None
+        if saved_serial is None or saved_serial != (simple_validators or {}).get("last_serial"):
+            json_task = asyncio.ensure_future(self.fetch_pypi_json_or_skip_async(project_name, package_validators))
+        try:
+            links, link_attrs, new_simple_validators = await self.fetch_simple_links_async(project_name, simple_validators)
+        except BaseException:
+            if json_task is not None:
+                json_task.cancel()
+            raise
+        if links is None:
+            new_simple_validators = self.merge_validators(simple_validators, new_simple_validators)
+
+        if json_task is not None:
+            project_info, new_package_validators = await json_task
+        elif new_simple_validators.get("last_serial") == saved_serial:
+            self.logger.debug(f"JSON of project {project_name} is up to date (serial {saved_serial})")
+            project_info, new_package_validators = None, package_validators
+        else:
+            project_info, new_package_validators = await self.fetch_pypi_json_or_skip_async(
+                project_name, package_validators
+            )
+        return {
+            "links": links,
+            "link_attrs": link_attrs,
+            "simple_validators": new_simple_validators,
+            "project_info": project_info,
+            "package_validators": new_package_validators,
+        }
+
+    async def fetch_projects_async(self, projects):
+        names = list(projects)
+        results = await asyncio.gather(
+            *(self.fetch_project_async(name, *projects[name]) for name in names), return_exceptions=True
+        )
+        return dict(zip(names, results))
+
+    def fetch_simple_links(self, project_name, validators=None):
+        return self._run(self.fetch_simple_links_async(project_name, validators))
+
+    def fetch_pypi_json(self, project_name, validators=None):
+        return self._run(self.fetch_pypi_json_async(project_name, validators))
+
+    def fetch_project(self, project_name, simple_validators=None, package_validators=None):
+        return self._run(self.fetch_project_async(project_name, simple_validators, package_validators))
+
+    def fetch_projects(self, projects):
+        """Получает данные многих пакетов одновременно, не больше `concurrency` соединений сразу.
+
+        Args and result are the same as of RemoteSimpleIndex.fetch_projects
+        """
+        return self._run(self.fetch_projects_async(projects))
+
+    def close(self):
+        """Close the connections and stop the event loop"""
+        with self.lock:
+            loop, self.loop = self.loop, None
+        if loop is None:
+            return
+        if self.session is not None:
+            asyncio.run_coroutine_threadsafe(self.session.close(), loop).result()
+            self.session = None
+        loop.call_soon_threadsafe(loop.stop)
@@ -0,0 +1,182 @@
+import threading
+from concurrent.futures import CancelledError, Future, ThreadPoolExecutor
+
+
+class BackgroundRefresher:
+    """Runs project refreshes on a worker pool, never more than one refresh of the same project at a time.
+
+    With `batch_refresh_func`, projects queued meanwhile are refreshed together by the next free worker,
+    so a few threads keep many refreshes in flight.
+    """
+
+    # max projects refreshed by one call of batch_refresh_func
+    BATCH_SIZE = 500
+
+    def __init__(self, logger, refresh_func, max_workers=4, batch_refresh_func=None):
+        """Initialize BackgroundRefresher class
+
+        Args:
+            logger (logging.Logger): Logger instance
+            refresh_func (Callable[[str], Any]): Function that refreshes one project
+            max_workers (int): Number of background worker threads
+            batch_refresh_func (Callable[[List[str]], Any]): Function that refreshes many projects at once
+        """
+        self.logger = logger
+        self.refresh_func = refresh_func
+        self.batch_refresh_func = batch_refresh_func
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="refresh")
+        self.lock = threading.Lock()
+        self.in_progress = {}
+        # queued projects not taken by a worker yet (batch mode)
+        self.pending = []
+        self.stopped = False
+
+    def _claim(self, project_name):
+        """Return (future, is_new): the future of the running refresh, or a new one registered for the caller"""
+        with self.lock:
+            future = self.in_progress.get(project_name)
+            if future is not None:
+                return future, False
+            future = Future()
+            self.in_progress[project_name] = future
+            return future, True
+
+    def _release(self, project_name, future):
+        """Forget the finished refresh; call with self.lock held"""
+        if self.in_progress.get(project_name) is future:
+            del self.in_progress[project_name]
+
+    def _run(self, project_name, future):
+        if not future.set_running_or_notify_cancel():
+            # cancelled by shutdown()
+            return
+        try:
+            future.set_result(self.refresh_func(project_name))
+        except Exception as e:
+            self.logger.warning(f"Failed to refresh project {project_name}", exc_info=True)
+            future.set_exception(e)
+        finally:
+            with self.lock:
+                self._release(project_name, future)
+
+    def _run_batch(self, project_names):
+        """Refresh the projects with batch_refresh_func, resolving their futures"""
+        with self.lock:
+            futures = {project_name: self.in_progress.get(project_name) for project_name in project_names}
+        # projects cancelled by shutdown() are dropped
+        futures = {
+            project_name: future for project_name, future in futures.items()
+            if future is not None and future.set_running_or_notify_cancel()
+        }
+        if not futures:
+            return
+
+        error = None
+        try:
+            self.batch_refresh_func(list(futures))
+        except Exception as e:
+            self.logger.warning(f"Failed to refresh {len(futures)} projects", exc_info=True)
+            error = e
+        with self.lock:
+            for project_name, future in futures.items():
+                self._release(project_name, future)
+        for future in futures.values():
+            if error is None:
+                future.set_result(None)
+            else:
+                future.set_exception(error)
+
+    def _run_pending(self):
+        with self.lock:
+            project_names = self.pending[:self.BATCH_SIZE]
+            del self.pending[:self.BATCH_SIZE]
+        if project_names:
+            self._run_batch(project_names)
+
+    def submit(self, project_name):
+        """Queue a background refresh of the project; if one is already queued or running, return it instead
+
+        Args:
+            project_name (str): Project name
+
+        Returns:
+            Future: Future of the refresh; cancelled if the refresher is shut down
+        """
+        with self.lock:
+            if self.stopped:
+                future = Future()
+                future.cancel()
+                return future
+            future = self.in_progress.get(project_name)
+            if future is not None:
+                return future
+            future = Future()
+            self.in_progress[project_name] = future
+            # under the lock, so that shutdown() can't stop the executor in between
+            if self.batch_refresh_func is None:
+                self.executor.submit(self._run, project_name, future)
+            else:
+                self.pending.append(project_name)
+                self.executor.submit(self._run_pending)
+        self.logger.debug(f"Queued background refresh of project {project_name}")
+        return future
+
+    def refresh(self, project_name):
+        """Refresh the project in the calling thread, or wait for the refresh that is already running
+
+        Args:
+            project_name (str): Project name
+
+        Returns:
+            Any: Value returned by refresh_func; None if the refresh waited for was cancelled by shutdown()
+        """
+        future, is_new = self._claim(project_name)
+        if is_new:
+            self._run(project_name, future)
+        try:
+            return future.result()
+        except CancelledError:
+            return None
+
+    def refresh_many(self, project_names):
+        """Refresh the projects in the calling thread, in one batch if possible, and wait for the ones
+        which are already being refreshed
+
+        Args:
+            project_names (List[str]): Project names
+        """
+        futures = []
+        new_futures = {}
+        for project_name in project_names:
+            future, is_new = self._claim(project_name)
+            futures.append(future)
+            if is_new:
+                new_futures[project_name] = future
+
+        if self.batch_refresh_func is not None:
+            new_project_names = list(new_futures)
+            for start in range(0, len(new_project_names), self.BATCH_SIZE):
+                self._run_batch(new_project_names[start:start + self.BATCH_SIZE])
+        else:
+            for project_name, future in new_futures.items():
+                self._run(project_name, future)
+
+        for future in futures:
+            try:
+                future.result()
+            except Exception:
+                # already logged by whoever ran the refresh
+                pass
+
+    def shutdown(self):
+        """Stop accepting refreshes and cancel the queued ones, so that nobody waits for them.
+        Refreshes already running are finished."""
+        with self.lock:
+            self.stopped = True
+            futures = list(self.in_progress.values())
+            self.in_progress.clear()
+            self.pending.clear()
+        for future in futures:
+            # fails for the running ones, which resolve their futures themselves
+            future.cancel()
+        self.executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,147 @@
+import threading
+import time
+
+
+class CacheManager:
+    """Keeps the cache directory within size and age limits
+
+    Hits are counted in memory and written to DB in batches. A background thread periodically
+    deletes the least recently (LRU) or least frequently (LFU) used files, a limited number per run.
+    Files being served or downloaded are pinned and never deleted.
+    """
+
+    # files deleted per DB query and per run, so that one run never takes long
+    BATCH_SIZE = 100
+    MAX_EVICTIONS_PER_RUN = 1000
+
+    def __init__(self, logger, db, cached_files, max_size=0, max_age=0, policy="lru", interval=60):
+        """Initialize CacheManager class
+
+        Args:
+            logger (logging.Logger): Logger instance
+            db (DBSQLite): Database with blob access statistics
+            cached_files (CachedFiles): Cache directory manager
+            max_size (int): Max total size of cached files, bytes; 0 means no limit
+            max_age (int): Files not accessed for this many seconds are deleted; 0 means no limit
+            policy (str): "lru" or "lfu"
+            interval (int): Seconds between eviction runs
+        """
+        self.logger = logger
+        self.db = db
+        self.cached_files = cached_files
+        self.max_size = max_size
+        self.max_age = max_age
+        self.policy = policy
+        self.interval = interval
+
+        self.lock = threading.Lock()
+        self.hits = {}
+        self.pins = {}
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def record_hit(self, sha256):
+        """Count an access to the cached file"""
+        with self.lock:
+            count, _ = self.hits.get(sha256, (0, 0))
+            self.hits[sha256] = (count + 1, time.time())
+
+    def pin(self, sha256):
+        """Protect the file from eviction until unpin() is called as many times"""
+        with self.lock:
+            self.pins[sha256] = self.pins.get(sha256, 0) + 1
+
+    def unpin(self, sha256):
+        with self.lock:
+            count = self.pins.get(sha256, 0) - 1
+            if count > 0:
+                self.pins[sha256] = count
+            else:
+                self.pins.pop(sha256, None)
+
+    def is_pinned(self, sha256):
+        with self.lock:
+            return sha256 in self.pins
+
+    def flush_hits(self):
+        """Write counted hits to DB"""
+        with self.lock:
+            hits, self.hits = self.hits, {}
+        if hits:
+            self.db.record_blob_hits(hits)
+
+    def evict(self, sha256):
+        """Delete the cached file unless it is pinned
+
+        Returns:
+            bool: True if the file was deleted
+        """
+        with self.lock:
+            if sha256 in self.pins:
+                return False
+            # while the lock is held nobody can pin the file, so it is forgotten before it's deleted
+            self.db.delete_blob(sha256)
+        self.cached_files.delete_files([self.cached_files.get_blob_path(sha256)])
+        return True
+
+    def run_once(self):
+        """One eviction run: files older than max_age, then the least used ones while over max_size
+
+        Returns:
+            int: Number of deleted files
+        """
+        self.flush_hits()
+        evicted = 0
+
+        if self.max_age:
+            accessed_before = time.time() - self.max_age
+            while evicted < self.MAX_EVICTIONS_PER_RUN:
+                candidates = self.db.get_eviction_candidates(self.policy, self.BATCH_SIZE, accessed_before)
+                batch_evicted = sum(1 for sha256, _ in candidates if self.evict(sha256))
+                evicted += batch_evicted
+                if batch_evicted == 0:
+                    break
+
+        if self.max_size:
+            total_size = self.db.get_blobs_total_size()
+            offset_pinned = set()
+            while total_size > self.max_size and evicted < self.MAX_EVICTIONS_PER_RUN:
+                candidates = [
+                    (sha256, size)
+                    for sha256, size in self.db.get_eviction_candidates(self.policy, self.BATCH_SIZE + len(offset_pinned))
+                    if sha256 not in offset_pinned
+                ]
+                if not candidates:
+                    break
+                for sha256, size in candidates:
+                    if total_size <= self.max_size:
+                        break
+                    if self.evict(sha256):
+                        total_size -= size or 0
+                        evicted += 1
+                    else:
+                        offset_pinned.add(sha256)
+
+        if evicted:
+            self.logger.info(f"CacheManager: evicted {evicted} files")
+        return evicted
+
+    def _loop(self):
+        while not self.stop_event.wait(self.interval):
+            try:
+                self.run_once()
+            except Exception:
+                self.logger.warning("CacheManager: eviction run failed", exc_info=True)
+
+    def start(self):
+        """Start the background eviction thread"""
+        self.thread = threading.Thread(target=self._loop, name="cache-manager", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """Stop the background thread and save counted hits"""
+        self.stop_event.set()
+        try:
+            self.flush_hits()
+        except Exception:
+            self.logger.warning("CacheManager: failed to save hits", exc_info=True)
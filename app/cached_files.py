@@ -1,24 +1,51 @@
 import base64
+import functools
+import hashlib
 import os
 import logging
+import re
+import threading
 import time
-from urllib.parse import urljoin, urlparse
+import uuid
+from urllib.parse import urldefrag, urljoin, urlparse
 
 
 class CachedFiles:
     """Class for caching files, managing cache directory and handling operations on it"""
 
-    def __init__(self, logger, cache_dir, proxy_server_base_url, download_endpoint_name):
+    # bounds of the memoized mappings: hosts are few, URL -> path mappings are per file
+    HOST_CACHE_SIZE = 1024
+    PATH_CACHE_SIZE = 16384
+
+    # temp files of older versions, written next to the cached file: <cached path>.<unix time>[.<random>].tmp
+    LEGACY_TEMP_FILE_RE = re.compile(r"\.\d+(\.[0-9a-f]{12})?\.tmp$")
+
+    def __init__(self, logger, cache_dir, proxy_server_base_url, download_endpoint_name, db=None):
         """Initialize CachedFiles class
 
+        Files are stored by content: cache_dir/sha256/ab/cd/abcd..., and DB maps URLs to digests.
+        Files cached by older versions under their URL path (see convert_url_to_file_path) are still
+        served and moved into the content-addressed store when requested.
+
         Args:
             logger (logging.Logger): Logger instance
             cache_dir (str): Cache directory path
+            db (DBSQLite): Database keeping the URL -> sha256 index
         """
         self.logger = logger
         self.cache_dir = self.__normalize_path(cache_dir)
+        self.blobs_dir = os.path.join(self.cache_dir, "sha256")
+        self.temp_dir = os.path.join(self.cache_dir, "tmp")
         self.proxy_server_base_url = proxy_server_base_url
         self.download_endpoint_name = download_endpoint_name
+        self.db = db
+        self.adopting = set()
+        self.adopting_lock = threading.Lock()
+
+        # memoized per instance, so that the caches go away with it
+        self._get_host_prefix = functools.lru_cache(maxsize=self.HOST_CACHE_SIZE)(self._get_host_prefix)
+        self._decode_host = functools.lru_cache(maxsize=self.HOST_CACHE_SIZE)(self.decode_data_from_base64url)
+        self.convert_url_to_file_path = functools.lru_cache(maxsize=self.PATH_CACHE_SIZE)(self.convert_url_to_file_path)
         os.makedirs(self.cache_dir, exist_ok=True)
         # self.logger.debug(f"Initialized cache directory: {self.cache_dir}")
 
@@ -42,16 +69,83 @@ class CachedFiles:
         """Decode data from base64 URL-safe format."""
         return base64.urlsafe_b64decode(encoded_data.encode()).decode()
 
+    def _get_host_prefix(self, scheme_host_port):
+        """Proxified URL of the root of the remote host; memoized in __init__"""
+        base64_host = self.encode_data_to_base64url(scheme_host_port)
+        return urljoin(self.proxy_server_base_url, f"{self.download_endpoint_name}/{base64_host}/")
+
+    @staticmethod
+    def _split_url(remote_url):
+        """Split a plain http(s) URL into (scheme://host:port, path, fragment) with string operations.
+
+        Returns None for URLs which urlparse/urljoin would treat specially (parameters, whitespace,
+        empty or dot path segments); such URLs are proxified the slow way.
+        """
+        if not remote_url.startswith(("https://", "http://")):
+            return None
+        url, _, fragment = remote_url.partition("#")
+        url = url.partition("?")[0]
+        path_start = url.find("/", url.index("//") + 2)
+        if path_start < 0:
+            return url, "", fragment
+        path = url[path_start:]
+        if "//" in path or "/." in path or ";" in path or "\t" in url or "\n" in url or "\r" in url:
+            return None
+        return url[:path_start], path, fragment
+
     def proxify_url(self, remote_url):
-        """Create a proxied URL combining a proxy server and the original URL."""
-        parsed_url = urlparse(remote_url)
-        base64_host = self.encode_data_to_base64url(f"{parsed_url.scheme}://{parsed_url.netloc}")
-        file_path = parsed_url.path
-        return urljoin(self.proxy_server_base_url, f"{self.download_endpoint_name}/{base64_host}/{file_path}")
+        """Create a proxied URL combining a proxy server and the original URL.
+
+        The fragment (e.g. #sha256=...) is kept, so that the client can verify the file too.
+        """
+        parts = self._split_url(remote_url)
+        if parts is None:
+            parsed_url = urlparse(remote_url)
+            base64_host = self.encode_data_to_base64url(f"{parsed_url.scheme}://{parsed_url.netloc}")
+            file_path = parsed_url.path
+            proxified_url = urljoin(self.proxy_server_base_url, f"{self.download_endpoint_name}/{base64_host}/{file_path}")
+            if parsed_url.fragment:
+                proxified_url += f"#{parsed_url.fragment}"
+            return proxified_url
+
+        scheme_host_port, path, fragment = parts
+        proxified_url = self._get_host_prefix(scheme_host_port) + path[1:]
+        if fragment:
+            proxified_url += f"#{fragment}"
+        return proxified_url
+
+    def proxify_urls(self, links):
+        """Proxify all links of a project page at once
+
+        Args:
+            links (Dict[str, str]): Link text -> remote URL
+
+        Returns:
+            Dict[str, str]: Link text -> proxified URL
+        """
+        split_url = self._split_url
+        get_host_prefix = self._get_host_prefix
+        # links of a page mostly share one host: skip even the memoized lookup for it
+        last_host, last_prefix = None, None
+
+        proxified_links = {}
+        for link_text, remote_url in links.items():
+            parts = split_url(remote_url)
+            if parts is None:
+                proxified_links[link_text] = self.proxify_url(remote_url)
+                continue
+            scheme_host_port, path, fragment = parts
+            if scheme_host_port != last_host:
+                last_host, last_prefix = scheme_host_port, get_host_prefix(scheme_host_port)
+            if fragment:
+                proxified_links[link_text] = f"{last_prefix}{path[1:]}#{fragment}"
+            else:
+                proxified_links[link_text] = last_prefix + path[1:]
+        return proxified_links
 
     def deproxify_url(self, encoded_url, path):
         """Reconstruct the original URL from the proxied format."""
-        scheme_host_port = self.decode_data_from_base64url(encoded_url)
+        scheme_host_port = self._decode_host(encoded_url)
         return f"{scheme_host_port}/{path.lstrip('/')}"
 
     def get_file_name_from_url(self, url):
@@ -65,16 +159,16 @@ class CachedFiles:
         proxified_url = self.proxify_url(
             remote_url
         )
-        cached_file_path = self.convert_url_to_file_path(remote_url)
+        cached_file_path = self.find_cached_file(remote_url)
         
         if file_name is None:
-            file_name = os.path.basename(cached_file_path)
+            file_name = self.get_file_name_from_url(urldefrag(remote_url)[0])
                 
         # gather info about the actual file: exists, size, human size
         file_exists = False
         file_size = None
         human_file_size = ""
-        if os.path.exists(cached_file_path):
+        if cached_file_path is not None:
             file_exists = True
             file_size = os.path.getsize(cached_file_path)
             human_file_size = self.human_readable_size(file_size)
@@ -100,6 +194,143 @@ class CachedFiles:
 
 
 
+    def get_blob_path(self, sha256):
+        """Return path of the file with the given sha256 in the content-addressed store
+
+        Args:
+            sha256 (str): Hex digest
+
+        Returns:
+            str: cache_dir/sha256/ab/cd/abcd...
+        """
+        return os.path.join(self.blobs_dir, sha256[:2], sha256[2:4], sha256)
+
+    def get_blob_sha256(self, file_path):
+        """Return sha256 of a file in the content-addressed store, or None for any other path"""
+        if os.path.dirname(os.path.dirname(os.path.dirname(file_path))) != self.blobs_dir:
+            return None
+        return os.path.basename(file_path)
+
+    def get_expected_sha256(self, remote_url):
+        """Return sha256 the remote index publishes for the file: from the #sha256= fragment or from DB
+
+        Args:
+            remote_url (str): URL of the file, with or without fragment
+
+        Returns:
+            Optional[str]: Hex digest or None if unknown
+        """
+        url, fragment = urldefrag(remote_url)
+        if fragment.startswith("sha256="):
+            return fragment[len("sha256="):]
+        if self.db is None:
+            return None
+        return self.db.get_expected_sha256(url)
+
+    def find_cached_file(self, remote_url):
+        """Return path of the cached copy of the file at remote_url, or None if it isn't cached
+
+        Args:
+            remote_url (str): URL of the file, with or without fragment
+
+        Returns:
+            Optional[str]: Path of the file in the cache directory
+        """
+        url = urldefrag(remote_url)[0]
+
+        if self.db is not None:
+            sha256 = self.db.get_url_blob(url)
+            if sha256 is not None and os.path.exists(self.get_blob_path(sha256)):
+                return self.get_blob_path(sha256)
+
+            # the same file could be cached from another URL (mirror)
+            sha256 = self.get_expected_sha256(remote_url)
+            if sha256 is not None and os.path.exists(self.get_blob_path(sha256)):
+                blob_path = self.get_blob_path(sha256)
+                self.db.save_url_blob(url, sha256, os.path.getsize(blob_path))
+                return blob_path
+
+        # cached by an older version under its URL path
+        legacy_path = self.convert_url_to_file_path(url)
+        if os.path.isfile(legacy_path):
+            if self.db is not None:
+                self.adopt_legacy_file_async(remote_url, legacy_path)
+            return legacy_path
+
+        return None
+
+    def hash_file(self, file_path):
+        """Return sha256 hex digest of the file"""
+        hasher = hashlib.sha256()
+        with open(file_path, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                hasher.update(chunk)
+        return hasher.hexdigest()
+
+    def store_blob(self, temp_file_path, sha256, remote_url):
+        """Move a downloaded and verified file into the content-addressed store and index it by URL.
+        If the same content is already stored, the new copy is deleted.
+
+        Args:
+            temp_file_path (str): Downloaded file
+            sha256 (str): Its hex digest
+            remote_url (str): URL it was downloaded from
+
+        Returns:
+            str: Path of the stored file
+        """
+        blob_path = self.get_blob_path(sha256)
+        size = os.path.getsize(temp_file_path)
+        if os.path.exists(blob_path):
+            self.logger.debug(f"Blob {sha256} is already stored, dropping the new copy")
+            self.delete_files([temp_file_path])
+        else:
+            self.create_directories([self.extract_parent_directory(blob_path)])
+            os.replace(temp_file_path, blob_path)
+        self.db.save_url_blob(urldefrag(remote_url)[0], sha256, size)
+        return blob_path
+
+    def store_bytes(self, data, remote_url):
+        """Store a small file produced in memory (e.g. wheel metadata) as if it was downloaded from remote_url
+
+        Returns:
+            str: Path of the stored file
+        """
+        file_name = os.path.basename(urlparse(remote_url).path)
+        temp_file_path = self.get_temporary_file_name(os.path.join(self.temp_dir, file_name))
+        self.create_directories([self.temp_dir])
+        with open(temp_file_path, "wb") as f:
+            f.write(data)
+        return self.store_blob(temp_file_path, hashlib.sha256(data).hexdigest(), remote_url)
+
+    def adopt_legacy_file(self, remote_url, legacy_path):
+        """Move a file cached under its URL path into the content-addressed store.
+        A file whose digest differs from the published one is deleted, to be downloaded again."""
+        try:
+            sha256 = self.hash_file(legacy_path)
+            expected_sha256 = self.get_expected_sha256(remote_url)
+            if expected_sha256 is not None and expected_sha256 != sha256:
+                self.logger.warning(f"Cached file {legacy_path} has wrong sha256, deleting it")
+                self.delete_files([legacy_path])
+                return
+            self.store_blob(legacy_path, sha256, remote_url)
+            self.logger.debug(f"Moved {legacy_path} into the content-addressed store as {sha256}")
+        except OSError:
+            self.logger.warning(f"Failed to move {legacy_path} into the content-addressed store", exc_info=True)
+        finally:
+            with self.adopting_lock:
+                self.adopting.discard(legacy_path)
+
+    def adopt_legacy_file_async(self, remote_url, legacy_path):
+        """Run adopt_legacy_file in a background thread, once per file"""
+        with self.adopting_lock:
+            if legacy_path in self.adopting:
+                return
+            self.adopting.add(legacy_path)
+        threading.Thread(
+            target=self.adopt_legacy_file, args=(remote_url, legacy_path), name="adopt", daemon=True
+        ).start()
+
     def extract_parent_directory(self, path):
         """Extract parent directory path from the given path and return normalized dir path
 
@@ -177,15 +408,16 @@ class CachedFiles:
             List[Tuple[str, str, bool, Union[int, 0]]]: List of tuples with file path, file name, is_file_exists and file_size
         """
         # self.logger.debug(f"Getting files info: {file_paths}")
-        file_info = [
-            (
-                file_path,
-                os.path.basename(file_path),
-                os.path.exists(file_path),
-                os.path.getsize(file_path) if os.path.exists(file_path) else 0,
-            )
-            for file_path in file_paths
-        ]
+        file_info = []
+        for file_path in file_paths:
+            # one stat per file instead of exists + exists + getsize
+            try:
+                file_size = os.stat(file_path).st_size
+                file_exists = True
+            except OSError:
+                file_size = 0
+                file_exists = False
+            file_info.append((file_path, os.path.basename(file_path), file_exists, file_size))
         # self.logger.debug(f"File info: {file_info}")
         return file_info
 
@@ -210,7 +442,7 @@ class CachedFiles:
         return success
 
     def get_temporary_file_name(self, file_path):
-        """Returns a file path with a suffix of ".{unix_time}.tmp"
+        """Returns a unique file path with a suffix of ".{unix_time}.{random}.tmp"
 
         Args:
             file_path (str): File path
@@ -220,10 +452,22 @@ class CachedFiles:
         """
         # self.logger.debug(f"Getting temporary file name: {file_path}")
         unix_time = str(int(time.time()))
-        temporary_file_name = f"{file_path.rstrip('/').rstrip('\\')}.{unix_time}.tmp"
+        # several writers may start within the same second, so the name gets a random part too
+        unique_part = uuid.uuid4().hex[:12]
+        base_path = file_path.rstrip("/").rstrip("\\")
+        temporary_file_name = f"{base_path}.{unix_time}.{unique_part}.tmp"
         # self.logger.debug(f"Temporary file name: {temporary_file_name}")
         return temporary_file_name
 
+    def find_legacy_temp_files(self):
+        """Yield paths of temp files older versions left next to cached files (outside of temp_dir)"""
+        skipped_dirs = {self.blobs_dir, self.temp_dir}
+        for dir_path, dir_names, file_names in os.walk(self.cache_dir):
+            dir_names[:] = [name for name in dir_names if os.path.join(dir_path, name) not in skipped_dirs]
+            for file_name in file_names:
+                if self.LEGACY_TEMP_FILE_RE.search(file_name):
+                    yield os.path.join(dir_path, file_name)
+
     def prepare_directory_for_file(self, file_path):
         """Create directories as needed for a given file path
 
@@ -1,26 +1,130 @@
+import os
 import sqlite3
 import json
+import threading
+import time
 
 class DBSQLite:
+    # seconds to wait for a lock held by another connection before "database is locked"
+    BUSY_TIMEOUT = 30
+    # number of prepared statements kept by each connection
+    CACHED_STATEMENTS = 256
+    MMAP_SIZE = 256 * 1024 * 1024
+    # negative value means KiB
+    CACHE_SIZE = -64 * 1024
+    # PRAGMA user_version of the current schema, see create_tables
+    SCHEMA_VERSION = 2
+    # fields of the JSON API `info` object kept in the `projects` table
+    PROJECT_INFO_FIELDS = (
+        "version", "summary", "author", "author_email", "maintainer", "maintainer_email",
+        "license", "home_page", "package_url", "release_url", "project_url", "download_url",
+        "platform", "requires_python", "requires_dist", "yanked", "yanked_reason", "description",
+    )
+
     def __init__(self, db_path: str):
         self.db_path = db_path
+        self.local = threading.local()
+        # set by create_tables: False if this SQLite has no FTS5 trigram tokenizer
+        self.fts_enabled = False
         self.create_tables()
 
+    def _connection(self):
+        """Returns the connection of the current thread, opening it on first use
+
+        Connections are persistent, so statements prepared by them are reused (see CACHED_STATEMENTS).
+        A connection inherited through fork is never reused by the child process.
+        """
+        conn = getattr(self.local, "conn", None)
+        if conn is None or self.local.pid != os.getpid():
+            conn = sqlite3.connect(
+                self.db_path,
+                timeout=self.BUSY_TIMEOUT,
+                cached_statements=self.CACHED_STATEMENTS,
+            )
+            # WAL lets readers work while a writer commits
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(f"PRAGMA mmap_size={self.MMAP_SIZE}")
+            conn.execute(f"PRAGMA cache_size={self.CACHE_SIZE}")
+            self.local.conn = conn
+            self.local.pid = os.getpid()
+        return conn
+
+    def close(self):
+        """Closes the connection of the current thread"""
+        conn = getattr(self.local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self.local.conn = None
+
     def create_tables(self):
-        with sqlite3.connect(self.db_path) as conn:
+        with self._connection() as conn:
             cursor = conn.cursor()
 
+            # project metadata from the JSON API, one row per project, release and file
             cursor.execute(
                 """
-                CREATE TABLE IF NOT EXISTS packages (
+                CREATE TABLE IF NOT EXISTS projects (
                     name TEXT PRIMARY KEY,
-                    info TEXT,
-                    releases TEXT,
-                    urls TEXT,
-                    last_serial INTEGER
+                    version TEXT,
+                    summary TEXT,
+                    author TEXT,
+                    author_email TEXT,
+                    maintainer TEXT,
+                    maintainer_email TEXT,
+                    license TEXT,
+                    home_page TEXT,
+                    package_url TEXT,
+                    release_url TEXT,
+                    project_url TEXT,
+                    download_url TEXT,
+                    platform TEXT,
+                    requires_python TEXT,
+                    requires_dist TEXT,
+                    yanked INTEGER,
+                    yanked_reason TEXT,
+                    description TEXT,
+                    last_serial INTEGER,
+                    etag TEXT,
+                    last_modified TEXT
+                )
+                """
+            )
+
+            cursor.execute(
+                """
+                CREATE TABLE IF NOT EXISTS releases (
+                    project_name TEXT NOT NULL,
+                    version TEXT NOT NULL,
+                    PRIMARY KEY (project_name, version)
+                )
+                """
+            )
+
+            cursor.execute(
+                """
+                CREATE TABLE IF NOT EXISTS files (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    project_name TEXT NOT NULL,
+                    version TEXT NOT NULL,
+                    filename TEXT NOT NULL,
+                    url TEXT NOT NULL,
+                    size INTEGER,
+                    sha256 TEXT,
+                    hashes TEXT,
+                    requires_python TEXT,
+                    packagetype TEXT,
+                    python_version TEXT,
+                    yanked INTEGER,
+                    yanked_reason TEXT,
+                    upload_time TEXT,
+                    UNIQUE (project_name, filename)
                 )
                 """
             )
+            cursor.execute("CREATE INDEX IF NOT EXISTS files_project_version ON files (project_name, version)")
+            cursor.execute("CREATE INDEX IF NOT EXISTS files_url ON files (url)")
+            cursor.execute("CREATE INDEX IF NOT EXISTS files_sha256 ON files (sha256)")
 
             cursor.execute(
                 """
@@ -31,6 +135,13 @@ class DBSQLite:
                 )
                 """
             )
+            self._add_column_if_missing(cursor, "simple_links", "refreshed_at", "REAL")
+            # upstream validators for conditional requests
+            self._add_column_if_missing(cursor, "simple_links", "etag", "TEXT")
+            self._add_column_if_missing(cursor, "simple_links", "last_modified", "TEXT")
+            self._add_column_if_missing(cursor, "simple_links", "last_serial", "INTEGER")
+            # data-* attributes of the links: {text: {"requires_python": ..., "yanked": ..., ...}}
+            self._add_column_if_missing(cursor, "simple_links", "link_attrs", "TEXT")
             
             cursor.execute(
                 """
@@ -41,10 +152,213 @@ class DBSQLite:
                 )
                 """
             )
-            
+
+            # content-addressed cache: files stored by sha256, and which URL gives which file
+            cursor.execute(
+                """
+                CREATE TABLE IF NOT EXISTS blobs (
+                    sha256 TEXT PRIMARY KEY,
+                    size INTEGER,
+                    created_at REAL
+                )
+                """
+            )
+            cursor.execute(
+                """
+                CREATE TABLE IF NOT EXISTS url_blobs (
+                    url TEXT PRIMARY KEY,
+                    sha256 TEXT NOT NULL
+                )
+                """
+            )
+            cursor.execute("CREATE INDEX IF NOT EXISTS url_blobs_sha256 ON url_blobs (sha256)")
+            # access statistics for cache eviction
+            self._add_column_if_missing(cursor, "blobs", "last_access", "REAL")
+            self._add_column_if_missing(cursor, "blobs", "hit_count", "INTEGER NOT NULL DEFAULT 0")
+            cursor.execute("UPDATE blobs SET last_access = created_at WHERE last_access IS NULL")
+            cursor.execute("CREATE INDEX IF NOT EXISTS blobs_last_access ON blobs (last_access)")
+            cursor.execute("CREATE INDEX IF NOT EXISTS blobs_hit_count ON blobs (hit_count, last_access)")
+
+            # background jobs (project mirroring), visible to every worker process
+            cursor.execute(
+                """
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    kind TEXT NOT NULL,
+                    project_name TEXT,
+                    params TEXT,
+                    state TEXT NOT NULL,
+                    total_files INTEGER NOT NULL DEFAULT 0,
+                    done_files INTEGER NOT NULL DEFAULT 0,
+                    downloaded_files INTEGER NOT NULL DEFAULT 0,
+                    failed_files INTEGER NOT NULL DEFAULT 0,
+                    skipped_files INTEGER NOT NULL DEFAULT 0,
+                    downloaded_bytes INTEGER NOT NULL DEFAULT 0,
+                    error TEXT,
+                    created_at REAL,
+                    updated_at REAL
+                )
+                """
+            )
+            # files a cancelled job never got to
+            self._add_column_if_missing(cursor, "jobs", "skipped_files", "INTEGER NOT NULL DEFAULT 0")
+
+            # rendered /simple/ pages, compressed; `state` tells what the page was built from
+            cursor.execute(
+                """
+                CREATE TABLE IF NOT EXISTS rendered_pages (
+                    key TEXT NOT NULL,
+                    format TEXT NOT NULL,
+                    etag TEXT NOT NULL,
+                    state INTEGER,
+                    body_gzip BLOB,
+                    body_br BLOB,
+                    fragment_gzip BLOB,
+                    PRIMARY KEY (key, format)
+                )
+                """
+            )
+
+            # interrupted downloads which can be resumed with a Range request; `claimed_by` is the
+            # download manager working on the file (any worker process), `updated_at` its last checkpoint
+            cursor.execute(
+                """
+                CREATE TABLE IF NOT EXISTS partial_downloads (
+                    remote_url TEXT PRIMARY KEY,
+                    temp_file_path TEXT NOT NULL,
+                    bytes_written INTEGER NOT NULL DEFAULT 0,
+                    content_length INTEGER,
+                    etag TEXT,
+                    last_modified TEXT,
+                    claimed_by TEXT,
+                    updated_at REAL
+                )
+                """
+            )
+
+            # sha256 of the files from the #sha256= fragments of the simple pages: files of
+            # projects without the JSON are verified against them too
+            cursor.execute(
+                """
+                CREATE TABLE IF NOT EXISTS link_digests (
+                    url TEXT PRIMARY KEY,
+                    pkg_name TEXT NOT NULL,
+                    sha256 TEXT NOT NULL
+                )
+                """
+            )
+            cursor.execute("CREATE INDEX IF NOT EXISTS link_digests_pkg_name ON link_digests (pkg_name)")
+
+            self.fts_enabled = self._create_search_index(cursor)
+
+            cursor.execute("PRAGMA user_version")
+            schema_version = cursor.fetchone()[0]
+            if schema_version < 1:
+                self._migrate_packages_to_projects(cursor)
+            if schema_version < 2:
+                self._fill_link_digests(cursor)
+            cursor.execute(f"PRAGMA user_version = {self.SCHEMA_VERSION}")
+
+
+    def _create_search_index(self, cursor):
+        """Creates (and fills, if it is new) the full-text index of project names and summaries
+
+        Returns:
+            bool: False if the index can't be created (SQLite older than 3.34 or built without FTS5)
+        """
+        cursor.execute("SELECT name FROM sqlite_master WHERE name = 'project_search'")
+        if cursor.fetchone() is not None:
+            return True
+
+        try:
+            cursor.execute("CREATE VIRTUAL TABLE project_search USING fts5(name, summary, tokenize = 'trigram')")
+        except sqlite3.OperationalError:
+            return False
+
+        # rowid of the index is simple_links.id
+        cursor.execute(
+            """
+            INSERT INTO project_search (rowid, name, summary)
+            SELECT simple_links.id, simple_links.pkg_name, projects.summary
+            FROM simple_links LEFT JOIN projects ON projects.name = simple_links.pkg_name
+            """
+        )
+        return True
+
+
+    def _update_search_index(self, cursor, pkg_name):
+        """Puts the current name and summary of the project into the full-text index"""
+        if not self.fts_enabled:
+            return
+
+        cursor.execute("SELECT id FROM simple_links WHERE pkg_name = ?", (pkg_name,))
+        row = cursor.fetchone()
+        if row is None:
+            return
+
+        cursor.execute("DELETE FROM project_search WHERE rowid = ?", (row[0],))
+        cursor.execute(
+            "INSERT INTO project_search (rowid, name, summary) VALUES (?, ?, (SELECT summary FROM projects WHERE name = ?))",
+            (row[0], pkg_name, pkg_name)
+        )
+
+
+    @staticmethod
+    def _get_link_digests(links: dict) -> list:
+        """(url, sha256) of the links having a #sha256= fragment"""
+        digests = []
+        for link_href in links.values():
+            url, _, fragment = link_href.partition("#")
+            if fragment.startswith("sha256="):
+                digests.append((url, fragment[len("sha256="):].lower()))
+        return digests
+
+
+    def _save_link_digests(self, cursor, pkg_name: str, links: dict):
+        cursor.execute("DELETE FROM link_digests WHERE pkg_name = ?", (pkg_name,))
+        cursor.executemany(
+            "INSERT OR REPLACE INTO link_digests (url, pkg_name, sha256) VALUES (?, ?, ?)",
+            [(url, pkg_name, sha256) for url, sha256 in self._get_link_digests(links)]
+        )
+
+
+    def _fill_link_digests(self, cursor):
+        """Fills link_digests from the links saved by older versions"""
+        cursor.execute("SELECT pkg_name, links FROM simple_links")
+        for pkg_name, links in cursor.fetchall():
+            self._save_link_digests(cursor, pkg_name, json.loads(links or "{}"))
+
+
+    def _migrate_packages_to_projects(self, cursor):
+        """Moves project JSON blobs of the old `packages` table into projects/releases/files"""
+        cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'packages'")
+        if cursor.fetchone() is None:
+            return
+
+        cursor.execute("SELECT * FROM packages")
+        columns = [column[0] for column in cursor.description]
+        for row in cursor.fetchall():
+            package = dict(zip(columns, row))
+            self._save_project(
+                cursor,
+                package["name"],
+                json.loads(package["info"]),
+                json.loads(package["releases"]),
+                package["last_serial"],
+                {"etag": package.get("etag"), "last_modified": package.get("last_modified")},
+            )
+        cursor.execute("DROP TABLE packages")
+
+
+    def _add_column_if_missing(self, cursor, table, column, column_type):
+        """Adds a column to an existing table, so databases created by older versions keep working"""
+        cursor.execute(f"PRAGMA table_info({table})")
+        if column not in [row[1] for row in cursor.fetchall()]:
+            cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {column_type}")
+
 
     def get_prefs_value(self, key, default_value):
-        with sqlite3.connect(self.db_path) as conn:
+        with self._connection() as conn:
             cursor = conn.cursor()
 
             cursor.execute("SELECT value FROM settings WHERE key = ?", (key,))
@@ -57,7 +371,7 @@ class DBSQLite:
                 return default_value
 
     def set_prefs_value(self, key, value):
-        with sqlite3.connect(self.db_path) as conn:
+        with self._connection() as conn:
             cursor = conn.cursor()
 
             cursor.execute("INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)", (key, value))
@@ -68,55 +382,133 @@ class DBSQLite:
             
             
     def get_project_summary(self, pkg_name: str):
-        with sqlite3.connect(self.db_path) as conn:
+        with self._connection() as conn:
             cursor = conn.cursor()
 
-            cursor.execute("SELECT info FROM packages WHERE name = ?", (pkg_name,))
+            cursor.execute("SELECT summary FROM projects WHERE name = ?", (pkg_name,))
 
             row = cursor.fetchone()
 
             if row is not None:
-                info = json.loads(row[0])
-
-                if 'summary' in info:
-                    return info['summary']
-                else:
-                    return None
+                return row[0]
             else:
                 return None
-        pass            
             
             
     def delete_package(self, pkg_name: str):
-        with sqlite3.connect(self.db_path) as conn:
+        with self._connection() as conn:
             cursor = conn.cursor()
 
-            # Удалить из таблицы simple_links
+            # Удалить из полнотекстового индекса и из таблицы simple_links
+            if self.fts_enabled:
+                cursor.execute(
+                    "DELETE FROM project_search WHERE rowid = (SELECT id FROM simple_links WHERE pkg_name = ?)", (pkg_name,)
+                )
             cursor.execute("DELETE FROM simple_links WHERE pkg_name = ?", (pkg_name,))
+            cursor.execute("DELETE FROM link_digests WHERE pkg_name = ?", (pkg_name,))
+            cursor.execute("DELETE FROM rendered_pages WHERE key IN (?, '/')", (pkg_name,))
 
-            # Удалить из таблицы packages
-            cursor.execute("DELETE FROM packages WHERE name = ?", (pkg_name,))
+            # Удалить метаданные проекта
+            cursor.execute("DELETE FROM files WHERE project_name = ?", (pkg_name,))
+            cursor.execute("DELETE FROM releases WHERE project_name = ?", (pkg_name,))
+            cursor.execute("DELETE FROM projects WHERE name = ?", (pkg_name,))
             
 
-    def save_simple_links(self, pkg_name: str, links: dict):
-        with sqlite3.connect(self.db_path) as conn:
+    def save_simple_links(self, pkg_name: str, links: dict, validators: dict = None, link_attrs: dict = None):
+        validators = validators or {}
+        with self._connection() as conn:
             cursor = conn.cursor()
 
             serialized_links = json.dumps(links)
-            data = (pkg_name, serialized_links)
+            data = (
+                pkg_name,
+                serialized_links,
+                time.time(),
+                validators.get("etag"),
+                validators.get("last_modified"),
+                validators.get("last_serial"),
+                json.dumps(link_attrs or {}),
+            )
 
             cursor.execute(
                 """
-                INSERT INTO simple_links (pkg_name, links)
-                VALUES (?, ?)
-                ON CONFLICT(pkg_name) DO UPDATE SET links = excluded.links
+                INSERT INTO simple_links (pkg_name, links, refreshed_at, etag, last_modified, last_serial, link_attrs)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT(pkg_name) DO UPDATE SET links = excluded.links, refreshed_at = excluded.refreshed_at,
+                    etag = excluded.etag, last_modified = excluded.last_modified, last_serial = excluded.last_serial,
+                    link_attrs = excluded.link_attrs
                 """,
                 data
             )
+            cursor.execute("DELETE FROM rendered_pages WHERE key = ?", (pkg_name,))
+            self._save_link_digests(cursor, pkg_name, links)
+            self._update_search_index(cursor, pkg_name)
+
+
+    def touch_simple_links(self, pkg_name: str, validators: dict = None):
+        """Marks the saved links as fresh without rewriting them (upstream answered 304 Not Modified)"""
+        validators = validators or {}
+        with self._connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                """
+                UPDATE simple_links SET refreshed_at = ?,
+                    etag = COALESCE(?, etag), last_modified = COALESCE(?, last_modified), last_serial = COALESCE(?, last_serial)
+                WHERE pkg_name = ?
+                """,
+                (time.time(), validators.get("etag"), validators.get("last_modified"), validators.get("last_serial"), pkg_name)
+            )
+
+
+    def get_simple_validators(self, pkg_name: str) -> dict:
+        """Returns upstream ETag, Last-Modified and last serial of the saved simple links"""
+        with self._connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT etag, last_modified, last_serial FROM simple_links WHERE pkg_name = ?", (pkg_name,))
+            row = cursor.fetchone()
+
+            if row is not None:
+                return {"etag": row[0], "last_modified": row[1], "last_serial": row[2]}
+            else:
+                return {}
+
+
+    def get_package_validators(self, pkg_name: str) -> dict:
+        """Returns upstream ETag, Last-Modified and last serial of the saved project JSON"""
+        with self._connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT etag, last_modified, last_serial FROM projects WHERE name = ?", (pkg_name,))
+            row = cursor.fetchone()
+
+            if row is not None:
+                return {"etag": row[0], "last_modified": row[1], "last_serial": row[2]}
+            else:
+                return {}
+
+
+    def get_project_refreshed_at(self, project_name: str):
+        """Returns unix time of the last successful refresh from the remote index, or None"""
+        with self._connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT refreshed_at FROM simple_links WHERE pkg_name = ?", (project_name,))
+            row = cursor.fetchone()
+
+            if row is not None:
+                return row[0]
+            else:
+                return None
+
+
+    def is_project_fresh(self, project_name: str, ttl) -> bool:
+        """True if the project was refreshed from the remote index less than `ttl` seconds ago"""
+        refreshed_at = self.get_project_refreshed_at(project_name)
+        if refreshed_at is None:
+            return False
+        return time.time() - refreshed_at < ttl
 
 
     def get_simple_links(self, project_name: str) -> list:
-        with sqlite3.connect(self.db_path) as conn:
+        with self._connection() as conn:
             cursor = conn.cursor()
             cursor.execute("SELECT links FROM simple_links WHERE pkg_name = ?", (project_name,))
             row = cursor.fetchone()
@@ -128,8 +520,21 @@ class DBSQLite:
                 return None
 
 
+    def get_simple_link_attrs(self, project_name: str) -> dict:
+        """Returns data-* attributes of the project links: {text: {"requires_python": ..., ...}}"""
+        with self._connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT link_attrs FROM simple_links WHERE pkg_name = ?", (project_name,))
+            row = cursor.fetchone()
+
+            if row is not None and row[0]:
+                return json.loads(row[0])
+            else:
+                return {}
+
+
     def get_simple_links_old(self, project_name: str):
-        with sqlite3.connect(self.db_path) as conn:
+        with self._connection() as conn:
             cursor = conn.cursor()
             cursor.execute("SELECT links FROM simple_links WHERE pkg_name = ?", (project_name,))
             row = cursor.fetchone()
@@ -140,69 +545,507 @@ class DBSQLite:
                 return None
 
     def get_simple_all_names(self):
-        with sqlite3.connect(self.db_path) as conn:
+        with self._connection() as conn:
             cursor = conn.cursor()
             cursor.execute("SELECT pkg_name FROM simple_links")
             rows = cursor.fetchall()
             return [row[0] for row in rows]
 
 
-    def get_simple_advanced(self, pkg_mask=None, page_size=None, page_number=None):
-        with sqlite3.connect(self.db_path) as conn:
+    def get_simple_max_id(self) -> int:
+        with self._connection() as conn:
             cursor = conn.cursor()
+            cursor.execute("SELECT COALESCE(MAX(id), 0) FROM simple_links")
+            return cursor.fetchone()[0]
 
-            query = "SELECT pkg_name FROM simple_links"
-            data = ()
 
+    def get_simple_names_after(self, after_id: int) -> list:
+        """Returns (id, pkg_name) of projects added after `after_id`, in the order they were added"""
+        with self._connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT id, pkg_name FROM simple_links WHERE id > ? ORDER BY id", (after_id,))
+            return cursor.fetchall()
+
+
+    def _projects_query(self, pkg_mask, page_size, page_number, after, with_summaries):
+        """Builds the query of get_simple_advanced; with_summaries adds project summary as the second column"""
+        if pkg_mask is not None:
             pkg_mask = pkg_mask.strip()
 
-            if pkg_mask=='*':
-                pkg_mask = None
+        if pkg_mask=='*':
+            pkg_mask = None
 
+        conditions = []
+        data = ()
+
+        if pkg_mask is not None and self.fts_enabled and len(pkg_mask) >= 3:
+            name_column = "name"
+            # the index keeps summaries too, no join needed
+            query = "SELECT name, summary FROM project_search" if with_summaries else "SELECT name FROM project_search"
+            conditions.append("project_search MATCH ?")
+            # quoted, the mask is a plain substring, not an FTS query
+            data += ('"' + pkg_mask.replace('"', '""') + '"',)
+        else:
+            name_column = "pkg_name"
+            if with_summaries:
+                query = "SELECT pkg_name, projects.summary FROM simple_links LEFT JOIN projects ON projects.name = simple_links.pkg_name"
+            else:
+                query = "SELECT pkg_name FROM simple_links"
             if pkg_mask is not None:
-                query += " WHERE pkg_name LIKE ?"
+                conditions.append("pkg_name LIKE ?")
                 data += ('%' + pkg_mask + '%',)
 
-            if page_size is not None and page_number is not None:
-                query += " LIMIT ? OFFSET ?"
-                data += (page_size, (page_number - 1) * page_size)
+        if after is not None:
+            conditions.append(f"{name_column} > ?")
+            data += (after,)
+
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        query += f" ORDER BY {name_column}"
+
+        if page_size is not None and after is not None:
+            query += " LIMIT ?"
+            data += (page_size,)
+        elif page_size is not None and page_number is not None:
+            query += " LIMIT ? OFFSET ?"
+            data += (page_size, (page_number - 1) * page_size)
+
+        return query, data
 
-            cursor.execute(query, data)
+
+    def get_simple_advanced(self, pkg_mask=None, page_size=None, page_number=None, after=None):
+        """Returns project names, sorted, filtered by `pkg_mask` and paginated
+
+        Masks of 3+ characters are looked up in the full-text index of names and summaries,
+        shorter ones with LIKE on names. A page is selected either by `page_number` (LIMIT/OFFSET)
+        or, faster on deep pages, by `after`: the last name of the previous page.
+        """
+        with self._connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(*self._projects_query(pkg_mask, page_size, page_number, after, False))
 
             rows = cursor.fetchall()
 
             return [row[0] for row in rows]
 
+
+    def get_project_summaries(self, pkg_mask=None, page_size=None, page_number=None, after=None):
+        """Same as get_simple_advanced, but returns (name, summary) tuples, all in one query"""
+        with self._connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(*self._projects_query(pkg_mask, page_size, page_number, after, True))
+            return cursor.fetchall()
+
+
+    def iter_project_summaries(self, pkg_mask=None, batch_size=1000):
+        """Yields all (name, summary) tuples matching `pkg_mask` in lists of up to `batch_size`,
+        without loading the whole result into memory"""
+        with self._connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(*self._projects_query(pkg_mask, None, None, None, True))
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                yield rows
+
         
         
 
-    def save_package_json(self, pkg_name: str, pypi_json: dict):
-        with sqlite3.connect(self.db_path) as conn:
+    def save_package_json(self, pkg_name: str, pypi_json: dict, validators: dict = None):
+        with self._connection() as conn:
+            cursor = conn.cursor()
+            self._save_project(
+                cursor,
+                pkg_name,
+                pypi_json['info'],
+                pypi_json['releases'],
+                pypi_json['last_serial'],
+                validators or {},
+            )
+
+
+    def _save_project(self, cursor, pkg_name, info, releases, last_serial, validators):
+        """Writes project `info` and `releases` of the JSON API into projects/releases/files"""
+        project_values = [info.get(field) for field in self.PROJECT_INFO_FIELDS]
+        # requires_dist is a short list, kept as JSON
+        project_values[self.PROJECT_INFO_FIELDS.index("requires_dist")] = json.dumps(info.get("requires_dist"))
+
+        columns = ("name",) + self.PROJECT_INFO_FIELDS + ("last_serial", "etag", "last_modified")
+        cursor.execute(
+            f"""
+            INSERT OR REPLACE INTO projects ({", ".join(columns)})
+            VALUES ({", ".join("?" * len(columns))})
+            """,
+            [pkg_name] + project_values + [last_serial, validators.get("etag"), validators.get("last_modified")]
+        )
+
+        self._update_search_index(cursor, pkg_name)
+
+        cursor.execute("DELETE FROM files WHERE project_name = ?", (pkg_name,))
+        cursor.execute("DELETE FROM releases WHERE project_name = ?", (pkg_name,))
+        cursor.executemany(
+            "INSERT INTO releases (project_name, version) VALUES (?, ?)",
+            [(pkg_name, version) for version in releases]
+        )
+        cursor.executemany(
+            """
+            INSERT OR REPLACE INTO files (project_name, version, filename, url, size, sha256, hashes, requires_python,
+                packagetype, python_version, yanked, yanked_reason, upload_time)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """,
+            [
+                (
+                    pkg_name,
+                    version,
+                    file["filename"],
+                    file["url"],
+                    file.get("size"),
+                    file.get("digests", {}).get("sha256"),
+                    json.dumps(file.get("digests", {})),
+                    file.get("requires_python"),
+                    file.get("packagetype"),
+                    file.get("python_version"),
+                    file.get("yanked"),
+                    file.get("yanked_reason"),
+                    file.get("upload_time_iso_8601") or file.get("upload_time"),
+                )
+                for version, files in releases.items()
+                for file in files
+            ]
+        )
+
+
+    def get_project_info(self, pkg_name: str):
+        with self._connection() as conn:
+            cursor = conn.cursor()
+
+            cursor.execute(f"SELECT name, {', '.join(self.PROJECT_INFO_FIELDS)} FROM projects WHERE name = ?", (pkg_name,))
+
+            row = cursor.fetchone()
+
+            if row is not None:
+                info = dict(zip(("name",) + self.PROJECT_INFO_FIELDS, row))
+                info["requires_dist"] = json.loads(info["requires_dist"]) if info["requires_dist"] else None
+                return info
+            else:
+                return None
+
+
+    def get_project_files(self, pkg_name: str, version: str = None) -> list:
+        """Returns files of the project (or of one its release) from the JSON API data, as list of dicts"""
+        with self._connection() as conn:
+            cursor = conn.cursor()
+
+            query = """
+                SELECT version, filename, url, size, sha256, requires_python, packagetype, python_version,
+                    yanked, yanked_reason, upload_time
+                FROM files WHERE project_name = ?
+            """
+            data = (pkg_name,)
+            if version is not None:
+                query += " AND version = ?"
+                data += (version,)
+            cursor.execute(query, data)
+
+            columns = [column[0] for column in cursor.description]
+            return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+
+    def get_url_blob(self, url: str):
+        """Returns sha256 of the cached file downloaded from `url`, or None"""
+        with self._connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT sha256 FROM url_blobs WHERE url = ?", (url,))
+            row = cursor.fetchone()
+
+            if row is not None:
+                return row[0]
+            else:
+                return None
+
+
+    def save_url_blob(self, url: str, sha256: str, size: int):
+        """Records that the file at `url` is cached as blob `sha256`"""
+        with self._connection() as conn:
+            cursor = conn.cursor()
+            now = time.time()
+            cursor.execute(
+                "INSERT OR IGNORE INTO blobs (sha256, size, created_at, last_access) VALUES (?, ?, ?, ?)",
+                (sha256, size, now, now)
+            )
+            cursor.execute("INSERT OR REPLACE INTO url_blobs (url, sha256) VALUES (?, ?)", (url, sha256))
+
+
+    def get_expected_sha256(self, url: str):
+        """Returns sha256 of the file at `url` published by the remote index (JSON API, or else
+        the #sha256= fragment of its link on the simple page), or None"""
+        with self._connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT sha256 FROM files WHERE url = ? AND sha256 IS NOT NULL LIMIT 1", (url,))
+            row = cursor.fetchone()
+            if row is None:
+                cursor.execute("SELECT sha256 FROM link_digests WHERE url = ?", (url,))
+                row = cursor.fetchone()
+
+            if row is not None:
+                return row[0]
+            else:
+                return None
+
+
+    def record_blob_hits(self, hits: dict):
+        """Adds hits to the access statistics of blobs
+
+        Args:
+            hits (Dict[str, Tuple[int, float]]): sha256 -> (number of hits, time of the last one)
+        """
+        with self._connection() as conn:
             cursor = conn.cursor()
+            cursor.executemany(
+                "UPDATE blobs SET hit_count = hit_count + ?, last_access = MAX(last_access, ?) WHERE sha256 = ?",
+                [(count, last_access, sha256) for sha256, (count, last_access) in hits.items()]
+            )
 
-            data = (pkg_name, json.dumps(pypi_json['info']), json.dumps(pypi_json['releases']), json.dumps(pypi_json['urls']), pypi_json['last_serial'])
 
+    def get_blobs_total_size(self) -> int:
+        with self._connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT COALESCE(SUM(size), 0) FROM blobs")
+            return cursor.fetchone()[0]
+
+
+    def get_eviction_candidates(self, policy="lru", limit=100, accessed_before=None):
+        """Returns (sha256, size) of blobs to evict first: least recently used ("lru")
+        or least frequently used ("lfu"), optionally only those not accessed since `accessed_before`"""
+        with self._connection() as conn:
+            cursor = conn.cursor()
+
+            query = "SELECT sha256, size FROM blobs"
+            data = ()
+            if accessed_before is not None:
+                query += " WHERE last_access < ?"
+                data += (accessed_before,)
+            if policy == "lfu":
+                query += " ORDER BY hit_count, last_access"
+            else:
+                query += " ORDER BY last_access"
+            query += " LIMIT ?"
+            data += (limit,)
+
+            cursor.execute(query, data)
+            return cursor.fetchall()
+
+
+    def delete_blob(self, sha256: str):
+        """Forgets the blob and all URLs pointing to it"""
+        with self._connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("DELETE FROM url_blobs WHERE sha256 = ?", (sha256,))
+            cursor.execute("DELETE FROM blobs WHERE sha256 = ?", (sha256,))
+
+
+    JOB_FIELDS = (
+        "id", "kind", "project_name", "params", "state", "total_files", "done_files", "downloaded_files",
+        "failed_files", "skipped_files", "downloaded_bytes", "error", "created_at", "updated_at",
+    )
+
+    def create_job(self, job_id: str, kind: str, project_name: str, params: dict, total_files: int):
+        with self._connection() as conn:
+            cursor = conn.cursor()
+            now = time.time()
             cursor.execute(
                 """
-                INSERT INTO packages (name, info, releases, urls, last_serial)
-                VALUES (?, ?, ?, ?, ?)
-                ON CONFLICT(name) DO UPDATE SET info = excluded.info, releases = excluded.releases, urls = excluded.urls, last_serial = excluded.last_serial
+                INSERT INTO jobs (id, kind, project_name, params, state, total_files, created_at, updated_at)
+                VALUES (?, ?, ?, ?, 'running', ?, ?, ?)
                 """,
-                data
+                (job_id, kind, project_name, json.dumps(params), total_files, now, now)
             )
 
 
-    def get_project_info(self, pkg_name: str):
-        with sqlite3.connect(self.db_path) as conn:
+    def update_job(self, job_id: str, **fields):
+        """Sets job fields; `<field>_add` adds to a counter instead, e.g. done_files_add=1.
+        Counters of finished jobs (see finish_job) are final and are not added to."""
+        assignments = []
+        data = ()
+        for field, value in fields.items():
+            if field.endswith("_add"):
+                field = field[:-len("_add")]
+                assignments.append(f"{field} = {field} + ?")
+            else:
+                assignments.append(f"{field} = ?")
+            if field not in self.JOB_FIELDS:
+                raise ValueError(f"Unknown job field {field}")
+            data += (value,)
+
+        condition = "id = ?"
+        if any(field.endswith("_add") for field in fields):
+            condition += " AND state IN ('running', 'cancelling')"
+
+        with self._connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                f"UPDATE jobs SET {', '.join(assignments)}, updated_at = ? WHERE {condition}",
+                data + (time.time(), job_id)
+            )
+
+
+    def finish_job(self, job_id: str, state: str, error: str = None):
+        """Sets the final state of the job; files it didn't get to are counted as done and skipped,
+        so that done_files == total_files for every finished job"""
+        with self._connection() as conn:
             cursor = conn.cursor()
+            cursor.execute(
+                """
+                UPDATE jobs SET state = ?, error = COALESCE(?, error),
+                    skipped_files = skipped_files + MAX(total_files - done_files, 0),
+                    done_files = MAX(total_files, done_files), updated_at = ?
+                WHERE id = ?
+                """,
+                (state, error, time.time(), job_id)
+            )
 
-            cursor.execute("SELECT info, releases, urls, last_serial FROM packages WHERE name = ?", (pkg_name,))
 
+    def get_job(self, job_id: str):
+        with self._connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(f"SELECT {', '.join(self.JOB_FIELDS)} FROM jobs WHERE id = ?", (job_id,))
             row = cursor.fetchone()
+            if row is None:
+                return None
+            job = dict(zip(self.JOB_FIELDS, row))
+            job["params"] = json.loads(job["params"] or "{}")
+            return job
 
-            if row is not None:
-                return json.loads(row[0])
+
+    def list_jobs(self, project_name: str = None, limit: int = 50) -> list:
+        """Returns the latest jobs, newest first"""
+        with self._connection() as conn:
+            cursor = conn.cursor()
+            query = f"SELECT {', '.join(self.JOB_FIELDS)} FROM jobs"
+            data = ()
+            if project_name is not None:
+                query += " WHERE project_name = ?"
+                data += (project_name,)
+            query += " ORDER BY created_at DESC LIMIT ?"
+            cursor.execute(query, data + (limit,))
+
+            jobs = []
+            for row in cursor.fetchall():
+                job = dict(zip(self.JOB_FIELDS, row))
+                job["params"] = json.loads(job["params"] or "{}")
+                jobs.append(job)
+            return jobs
+
+
+    RENDERED_PAGE_FIELDS = ("etag", "state", "body_gzip", "body_br", "fragment_gzip")
+
+    def get_rendered_page(self, key: str, page_format: str, with_body: bool = True):
+        """Returns the rendered page as a dict of RENDERED_PAGE_FIELDS (only etag and state without body), or None"""
+        fields = self.RENDERED_PAGE_FIELDS if with_body else self.RENDERED_PAGE_FIELDS[:2]
+        with self._connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                f"SELECT {', '.join(fields)} FROM rendered_pages WHERE key = ? AND format = ?", (key, page_format)
+            )
+            row = cursor.fetchone()
+            if row is None:
+                return None
+            return dict(zip(fields, row))
+
+
+    def save_rendered_page(self, key: str, page_format: str, page: dict):
+        with self._connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                f"""
+                INSERT OR REPLACE INTO rendered_pages (key, format, {', '.join(self.RENDERED_PAGE_FIELDS)})
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                """,
+                (key, page_format) + tuple(page.get(field) for field in self.RENDERED_PAGE_FIELDS)
+            )
+
+
+    def delete_rendered_pages(self, key: str = None):
+        """Forgets the rendered pages of `key`, or all of them"""
+        with self._connection() as conn:
+            cursor = conn.cursor()
+            if key is None:
+                cursor.execute("DELETE FROM rendered_pages")
             else:
+                cursor.execute("DELETE FROM rendered_pages WHERE key = ?", (key,))
+
+
+    PARTIAL_DOWNLOAD_FIELDS = (
+        "remote_url", "temp_file_path", "bytes_written", "content_length", "etag", "last_modified",
+        "claimed_by", "updated_at",
+    )
+
+    def save_partial_download(self, partial: dict, replace: bool = False) -> bool:
+        """Records a download in progress, claimed by partial["claimed_by"].
+        Unless `replace`, a record of the same URL is kept and False is returned."""
+        partial = dict(partial, bytes_written=partial.get("bytes_written") or 0, updated_at=time.time())
+        with self._connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                f"""
+                INSERT OR {'REPLACE' if replace else 'IGNORE'} INTO partial_downloads
+                ({', '.join(self.PARTIAL_DOWNLOAD_FIELDS)}) VALUES ({', '.join('?' * len(self.PARTIAL_DOWNLOAD_FIELDS))})
+                """,
+                tuple(partial.get(field) for field in self.PARTIAL_DOWNLOAD_FIELDS)
+            )
+            return cursor.rowcount == 1
+
+
+    def claim_partial_download(self, remote_url: str, owner: str, abandoned_before: float):
+        """Takes the partial download of the URL for `owner`, unless somebody else has claimed it after
+        `abandoned_before`. Returns it as a dict of PARTIAL_DOWNLOAD_FIELDS, or None."""
+        with self._connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                """
+                UPDATE partial_downloads SET claimed_by = ?, updated_at = ?
+                WHERE remote_url = ? AND (claimed_by IS NULL OR updated_at < ?)
+                """,
+                (owner, time.time(), remote_url, abandoned_before)
+            )
+            if cursor.rowcount == 0:
                 return None
-            
+            cursor.execute(
+                f"SELECT {', '.join(self.PARTIAL_DOWNLOAD_FIELDS)} FROM partial_downloads WHERE remote_url = ?",
+                (remote_url,)
+            )
+            row = cursor.fetchone()
+            return dict(zip(self.PARTIAL_DOWNLOAD_FIELDS, row)) if row is not None else None
+
 
+    def update_partial_download(self, remote_url: str, owner: str, bytes_written: int, release: bool = False):
+        """Checkpoint of the download claimed by `owner`; `release` gives up the claim (the download stopped)"""
+        with self._connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                f"""
+                UPDATE partial_downloads SET bytes_written = ?, updated_at = ?{', claimed_by = NULL' if release else ''}
+                WHERE remote_url = ? AND claimed_by = ?
+                """,
+                (bytes_written, time.time(), remote_url, owner)
+            )
+
+
+    def delete_partial_download(self, remote_url: str, owner: str = None):
+        """Forgets the partial download; with `owner`, only if it's claimed by the owner"""
+        with self._connection() as conn:
+            cursor = conn.cursor()
+            if owner is None:
+                cursor.execute("DELETE FROM partial_downloads WHERE remote_url = ?", (remote_url,))
+            else:
+                cursor.execute(
+                    "DELETE FROM partial_downloads WHERE remote_url = ? AND claimed_by = ?", (remote_url, owner)
+                )
+
+
+    def list_partial_downloads(self) -> list:
+        with self._connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(f"SELECT {', '.join(self.PARTIAL_DOWNLOAD_FIELDS)} FROM partial_downloads")
+            return [dict(zip(self.PARTIAL_DOWNLOAD_FIELDS, row)) for row in cursor.fetchall()]
@@ -0,0 +1,505 @@
+import hashlib
+import os
+import threading
+import time
+import uuid
+from urllib.parse import urldefrag, urlparse
+
+import requests
+
+from app.http_client import HttpClient
+from app.offline_mode import OfflineModeError
+from app.upstream_retry import CircuitOpenError, RetryPolicy, parse_retry_after
+
+# failures after which an interrupted download is worth continuing later
+TRANSIENT_ERRORS = (requests.exceptions.RequestException, CircuitOpenError, OfflineModeError)
+
+
+class InflightDownload:
+    """One upstream download written into a temporary file, shared by every client asking for the same file"""
+
+    def __init__(self, remote_url, temp_file_path, expected_sha256=None, cache_manager=None):
+        self.remote_url = remote_url
+        self.temp_file_path = temp_file_path
+        self.expected_sha256 = expected_sha256
+        # path in the content-addressed store, known when the download is complete
+        self.cached_file_path = None
+        self.sha256 = None
+
+        # the stored file is pinned against eviction while the download runs or anyone reads it
+        self.cache_manager = cache_manager
+        self.readers = 0
+        self.pinned = False
+
+        self.cond = threading.Condition()
+        self.headers_ready = False
+        self.status_code = None
+        self.content_type = None
+        self.content_length = None
+        self.bytes_written = 0
+        self.done = False
+        self.error = None
+
+    def wait_for_headers(self):
+        """Block until the upstream answered (or the download failed)
+
+        Returns:
+            bool: True if the upstream answered 200 and the body is being downloaded
+        """
+        with self.cond:
+            while not self.headers_ready and self.error is None:
+                self.cond.wait()
+            return self.headers_ready and self.status_code == 200
+
+    def wait_until_done(self):
+        """Block until the download is complete or failed
+
+        Returns:
+            bool: True if the file is now in the cache
+        """
+        with self.cond:
+            while not self.done and self.error is None:
+                self.cond.wait()
+            return self.done
+
+    def _update_pin(self):
+        """Pin or unpin the stored file; call with self.cond held"""
+        if self.cache_manager is None or self.sha256 is None:
+            return
+        wanted = self.readers > 0 or not self.done
+        if wanted and not self.pinned:
+            self.cache_manager.pin(self.sha256)
+            self.pinned = True
+        elif not wanted and self.pinned:
+            self.cache_manager.unpin(self.sha256)
+            self.pinned = False
+
+    def _open(self):
+        try:
+            return open(self.temp_file_path, "rb")
+        except FileNotFoundError:
+            # the download has just finished and the file got its permanent name
+            if self.cached_file_path is None:
+                raise IOError(f"Download of {self.remote_url} failed: {self.error}")
+            return open(self.cached_file_path, "rb")
+
+    def iter_content(self, start=0, stop=None, chunk_size=65536):
+        """Yield bytes [start, stop) of the file body, following the temporary file as it grows
+
+        Raises:
+            IOError: if the upstream download fails before the requested bytes are received
+        """
+        with self.cond:
+            self.readers += 1
+            self._update_pin()
+        try:
+            with self._open() as f:
+                f.seek(start)
+                offset = start
+                while stop is None or offset < stop:
+                    with self.cond:
+                        while offset >= self.bytes_written and not self.done and self.error is None:
+                            self.cond.wait()
+                        if self.error is not None:
+                            raise IOError(f"Download of {self.remote_url} failed: {self.error}")
+                        available = self.bytes_written if stop is None else min(self.bytes_written, stop)
+                        finished = self.done
+
+                    if offset < available:
+                        data = f.read(min(chunk_size, available - offset))
+                        offset += len(data)
+                        yield data
+                    elif finished:
+                        return
+        finally:
+            with self.cond:
+                self.readers -= 1
+                self._update_pin()
+
+
+class IncompleteDownloadError(IOError):
+    """The remote server sent less than it announced"""
+
+
+class DownloadManager:
+    """Downloads files from the remote server into the cache, one upstream request per file
+    no matter how many clients ask for it at the same time.
+
+    With `db`, interrupted downloads of large files are kept with their byte offset and upstream
+    validators, and the next download of the file continues with a Range request.
+    """
+
+    # smaller files are downloaded again from the start rather than tracked
+    RESUME_MIN_SIZE = 1024 * 1024
+    # progress of tracked downloads is saved to DB every CHECKPOINT_BYTES or CHECKPOINT_INTERVAL seconds
+    CHECKPOINT_BYTES = 8 * 1024 * 1024
+    CHECKPOINT_INTERVAL = 10
+
+    def __init__(self, logger, cached_files, connect_timeout=5, download_timeout=30, http_client=None,
+                 cache_manager=None, retry_policy=None, db=None):
+        """Initialize DownloadManager class
+
+        Args:
+            logger (logging.Logger): Logger instance
+            cached_files (CachedFiles): Cache directory manager
+            connect_timeout (int): Upstream connection timeout, seconds
+            download_timeout (int): Upstream read timeout, seconds
+            http_client (HttpClient): Pooled HTTP client for upstream requests
+            cache_manager (CacheManager): Pins downloaded files against eviction while they are read
+            retry_policy (RetryPolicy): How failed requests are retried before the body starts coming
+            db (DBSQLite): Database keeping interrupted downloads; without it downloads are not resumed
+        """
+        self.logger = logger
+        self.http = http_client or HttpClient(logger)
+        self.cached_files = cached_files
+        self.connect_timeout = connect_timeout
+        self.download_timeout = download_timeout
+        self.cache_manager = cache_manager
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.db = db
+        # claims on partial downloads in DB, unique per process
+        self.owner = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        # a claimed download without checkpoints for this long is considered abandoned by a dead process
+        self.claim_timeout = self.CHECKPOINT_INTERVAL + download_timeout + 30
+        self.lock = threading.Lock()
+        self.downloads = {}
+
+    def get_or_start(self, remote_url):
+        """Return the running download of the file, starting it if needed
+
+        Args:
+            remote_url (str): URL of the file on the remote server
+
+        Returns:
+            Optional[InflightDownload]: The download, or None if the file is already in the cache
+        """
+        # the #sha256= fragment, if any, is the digest the file is checked against
+        expected_sha256 = self.cached_files.get_expected_sha256(remote_url)
+        remote_url = urldefrag(remote_url)[0]
+        with self.lock:
+            download = self.downloads.get(remote_url)
+            if download is not None:
+                self.logger.debug(f"DownloadManager: joining download of {remote_url}")
+                return download
+
+            # the previous download could have finished between the caller's check and this one
+            if self.cached_files.find_cached_file(remote_url) is not None:
+                return None
+
+            file_name = os.path.basename(urlparse(remote_url).path)
+            temp_file_path = self.cached_files.get_temporary_file_name(
+                os.path.join(self.cached_files.temp_dir, file_name)
+            )
+            download = InflightDownload(
+                remote_url, temp_file_path, expected_sha256, self.cache_manager
+            )
+            self.downloads[remote_url] = download
+
+        threading.Thread(
+            target=self.stream_and_save, args=(download,), name="download", daemon=True
+        ).start()
+        return download
+
+    def fetch_range(self, remote_url, start, stop=None):
+        """Request bytes [start, stop) of the file straight from the remote server, bypassing the cache.
+        A negative `start` without `stop` requests the last -start bytes.
+
+        Returns:
+            requests.Response: Streamed response; the caller must check for 206 and close it
+        """
+        if stop is None:
+            byte_range = f"bytes={start}" if start < 0 else f"bytes={start}-"
+        else:
+            byte_range = f"bytes={start}-{stop - 1}"
+        return self.http.get(
+            remote_url,
+            headers={"Range": byte_range},
+            stream=True,
+            timeout=(self.connect_timeout, self.download_timeout),
+        )
+
+    def open_response(self, remote_url, headers=None):
+        """GET the file, retrying connection errors, 429 and 5xx answers with backoff.
+        Only the request is retried: once the body is being streamed to clients, a failure is final.
+
+        Returns:
+            requests.Response: Streamed response; the last answer if retries ran out
+
+        Raises:
+            CircuitOpenError: if the remote host is failing and is not asked now
+            requests.exceptions.RequestException: if the last attempt failed to connect
+        """
+        attempt = 0
+        while True:
+            try:
+                response = self.http.get(
+                    remote_url, headers=headers, stream=True, timeout=(self.connect_timeout, self.download_timeout)
+                )
+            except CircuitOpenError:
+                raise
+            except requests.exceptions.RequestException as e:
+                delay = self.retry_policy.get_delay(attempt)
+                if delay is None:
+                    raise
+                self.logger.debug(f"DownloadManager: {remote_url}: {e}, retrying in {delay:.1f} seconds")
+            else:
+                if not self.retry_policy.is_retryable(response.status_code):
+                    return response
+                delay = self.retry_policy.get_delay(attempt, parse_retry_after(response.headers.get("Retry-After")))
+                if delay is None:
+                    return response
+                response.close()
+                self.logger.debug(
+                    f"DownloadManager: {remote_url}: remote server answered {response.status_code}, "
+                    f"retrying in {delay:.1f} seconds"
+                )
+            time.sleep(delay)
+            attempt += 1
+
+    def _claim_partial(self, download):
+        """Take the interrupted download of the file, if any; returns it or None"""
+        if self.db is None:
+            return None
+        partial = self.db.claim_partial_download(
+            download.remote_url, self.owner, time.time() - self.claim_timeout
+        )
+        if partial is not None and not os.path.isfile(partial["temp_file_path"]):
+            self.db.delete_partial_download(download.remote_url, self.owner)
+            return None
+        return partial
+
+    @staticmethod
+    def _get_content_length(response):
+        """Size of the body from Content-Length, or None; with content-encoding it's of the encoded body, useless"""
+        content_length = response.headers.get("content-length")
+        if not content_length or "content-encoding" in response.headers:
+            return None
+        return int(content_length)
+
+    @staticmethod
+    def _parse_content_range(value):
+        """(first byte, total size or None) from "bytes 100-999/1000", or None"""
+        try:
+            unit, byte_range = value.split(" ", 1)
+            first_last, total = byte_range.split("/", 1)
+            if unit != "bytes":
+                return None
+            return int(first_last.split("-", 1)[0]), (None if total == "*" else int(total))
+        except (AttributeError, ValueError):
+            return None
+
+    def _open_resumed(self, download, partial):
+        """Request the rest of the partially downloaded file
+
+        Returns:
+            Tuple[requests.Response, int, Optional[int]]: the response, offset the body starts at
+            (0 if the remote server sent the whole file) and total size of the file if known
+        """
+        offset = os.path.getsize(partial["temp_file_path"])
+        headers = {"Range": f"bytes={offset}-"}
+        # the file must not have changed since: If-Range takes a strong ETag or the date
+        if partial["etag"] and not partial["etag"].startswith("W/"):
+            headers["If-Range"] = partial["etag"]
+        elif partial["last_modified"]:
+            headers["If-Range"] = partial["last_modified"]
+
+        response = self.open_response(download.remote_url, headers)
+        content_range = self._parse_content_range(response.headers.get("content-range"))
+        if response.status_code == 206 and content_range is not None and content_range[0] == offset:
+            self.logger.info(f"DownloadManager: resuming {download.remote_url} from byte {offset}")
+            return response, offset, content_range[1]
+
+        self.logger.debug(
+            f"DownloadManager: can't resume {download.remote_url} (answer {response.status_code}), starting over"
+        )
+        if response.status_code != 200:
+            # e.g. the range is not satisfiable: the file was complete but failed to be stored
+            response.close()
+            response = self.open_response(download.remote_url)
+        # the file changed (If-Range didn't match) or the server ignores ranges: the whole file is coming
+        return response, 0, self._get_content_length(response)
+
+    def _track_partial(self, download, response, partial, total_size):
+        """Record the download in DB so that it can be resumed; returns True if it's tracked"""
+        if self.db is None:
+            return False
+        etag = response.headers.get("etag") or (partial["etag"] if response.status_code == 206 else None)
+        last_modified = response.headers.get("last-modified") or (
+            partial["last_modified"] if response.status_code == 206 else None
+        )
+        # without validators nothing would tell whether the remote file changed in between
+        if (total_size is not None and total_size < self.RESUME_MIN_SIZE) or not (
+            etag or last_modified or download.expected_sha256
+        ):
+            if partial is not None:
+                self.db.delete_partial_download(download.remote_url, self.owner)
+            return False
+        return self.db.save_partial_download(
+            {
+                "remote_url": download.remote_url,
+                "temp_file_path": download.temp_file_path,
+                "bytes_written": download.bytes_written,
+                "content_length": total_size,
+                "etag": etag,
+                "last_modified": last_modified,
+                "claimed_by": self.owner,
+            },
+            # our own claimed record is updated, somebody else's is left alone
+            replace=partial is not None,
+        )
+
+    def stream_and_save(self, download):
+        """Download the file into its temporary file, computing sha256 on the way, then move it into
+        the content-addressed store if (and only if) the download is complete and the digest matches
+        the one published by the remote index.
+
+        An interrupted download of the file is continued with a Range request: the downloaded part is
+        hashed again from the disk and the rest is appended to it."""
+        partial = None
+        tracked = False
+        try:
+            self.cached_files.create_directories(
+                [self.cached_files.extract_parent_directory(download.temp_file_path)]
+            )
+            hasher = hashlib.sha256()
+
+            partial = self._claim_partial(download)
+            if partial is not None:
+                with download.cond:
+                    download.temp_file_path = partial["temp_file_path"]
+                response, offset, total_size = self._open_resumed(download, partial)
+            else:
+                response = self.open_response(download.remote_url)
+                offset = 0
+                total_size = self._get_content_length(response)
+
+            with response, open(download.temp_file_path, "r+b" if offset else "wb") as f:
+                if offset:
+                    # sha256 of the whole file is needed: hash the part downloaded before, the rest is appended
+                    for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                        hasher.update(chunk)
+
+                with download.cond:
+                    # clients get the whole file from the temporary file, not just the requested range
+                    download.status_code = 200 if offset else response.status_code
+                    download.content_type = response.headers.get("content-type")
+                    if total_size is not None:
+                        download.content_length = str(total_size)
+                    download.bytes_written = offset
+                    download.headers_ready = True
+                    download.cond.notify_all()
+
+                if download.status_code != 200:
+                    raise IOError(f"remote server answered {response.status_code}")
+
+                tracked = self._track_partial(download, response, partial, total_size)
+                checkpoint_bytes = offset
+                checkpoint_at = time.monotonic()
+
+                for chunk in response.iter_content(chunk_size=65536):
+                    if chunk:  # filter out keep-alive new chunks
+                        f.write(chunk)
+                        f.flush()
+                        hasher.update(chunk)
+                        with download.cond:
+                            download.bytes_written += len(chunk)
+                            download.cond.notify_all()
+
+                        if tracked and (
+                            download.bytes_written - checkpoint_bytes >= self.CHECKPOINT_BYTES
+                            or time.monotonic() - checkpoint_at >= self.CHECKPOINT_INTERVAL
+                        ):
+                            self.db.update_partial_download(download.remote_url, self.owner, download.bytes_written)
+                            checkpoint_bytes = download.bytes_written
+                            checkpoint_at = time.monotonic()
+
+            if download.content_length is not None and int(download.content_length) > download.bytes_written:
+                raise IncompleteDownloadError(f"got {download.bytes_written} bytes of {download.content_length}")
+            if download.content_length is not None and int(download.content_length) < download.bytes_written:
+                raise IOError(f"got {download.bytes_written} bytes of {download.content_length}")
+
+            sha256 = hasher.hexdigest()
+            if download.expected_sha256 is not None and download.expected_sha256 != sha256:
+                raise IOError(f"sha256 mismatch: expected {download.expected_sha256}, got {sha256}")
+
+            # readers opening the file from now on may find the temporary file gone
+            with download.cond:
+                download.cached_file_path = self.cached_files.get_blob_path(sha256)
+                download.sha256 = sha256
+                download._update_pin()
+            self.logger.debug(
+                f"DownloadManager: store {download.temp_file_path} as {download.cached_file_path}"
+            )
+            self.cached_files.store_blob(download.temp_file_path, sha256, download.remote_url)
+            if tracked:
+                self.db.delete_partial_download(download.remote_url, self.owner)
+
+            with download.cond:
+                download.done = True
+                download._update_pin()
+                download.cond.notify_all()
+
+        except Exception as e:
+            # a broken stream can be continued next time, wrong content can't
+            resumable = isinstance(e, TRANSIENT_ERRORS + (IncompleteDownloadError,)) and (
+                tracked or (partial is not None and not download.headers_ready)
+            )
+            if resumable:
+                bytes_written = download.bytes_written if download.headers_ready else partial["bytes_written"]
+                self.logger.warning(
+                    f"Failed to download {download.remote_url} at byte {bytes_written}, will resume next time: {e}"
+                )
+                self.db.update_partial_download(download.remote_url, self.owner, bytes_written, release=True)
+            else:
+                self.logger.warning(f"Failed to download {download.remote_url}: {e}")
+                self.cached_files.delete_files([download.temp_file_path])
+                if self.db is not None and (tracked or partial is not None):
+                    self.db.delete_partial_download(download.remote_url, self.owner)
+            with download.cond:
+                download.error = e
+                download.cond.notify_all()
+
+        finally:
+            with self.lock:
+                self.downloads.pop(download.remote_url, None)
+
+    def collect_garbage(self, max_age):
+        """Delete temporary files nobody will use: left by crashed processes or by interrupted downloads
+        not resumed for `max_age` seconds, and temp files of older versions not modified for `max_age`
+        seconds. Files being written (recently modified) are left alone."""
+        now = time.time()
+        keep = set()
+        deleted = 0
+        for partial in self.db.list_partial_downloads() if self.db is not None else []:
+            temp_file_path = os.path.normpath(partial["temp_file_path"])
+            claimed = partial["claimed_by"] is not None and partial["updated_at"] >= now - self.claim_timeout
+            if claimed or (os.path.isfile(temp_file_path) and partial["updated_at"] >= now - max_age):
+                keep.add(temp_file_path)
+                continue
+            self.db.delete_partial_download(partial["remote_url"])
+            if os.path.isfile(temp_file_path):
+                self.cached_files.delete_files([temp_file_path])
+                deleted += 1
+
+        temp_dir = self.cached_files.temp_dir
+        for file_name in os.listdir(temp_dir) if os.path.isdir(temp_dir) else []:
+            temp_file_path = os.path.normpath(os.path.join(temp_dir, file_name))
+            if temp_file_path in keep:
+                continue
+            try:
+                if os.path.getmtime(temp_file_path) < now - self.claim_timeout:
+                    os.remove(temp_file_path)
+                    deleted += 1
+            except OSError:
+                pass
+
+        # older versions wrote temp files next to the cached files; nothing resumes those
+        for temp_file_path in self.cached_files.find_legacy_temp_files():
+            try:
+                if os.path.getmtime(temp_file_path) < now - max_age:
+                    os.remove(temp_file_path)
+                    deleted += 1
+            except OSError:
+                pass
+        if deleted:
+            self.logger.info(f"DownloadManager: deleted {deleted} stale temporary files")
@@ -0,0 +1,82 @@
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+
+from app.upstream_retry import parse_retry_after
+
+
+class HttpClient:
+    """Keep-alive connection pools for all upstream traffic
+
+    Connection pools live in the adapters and are shared by all threads; every thread gets
+    its own lightweight requests.Session on top of them, because Session itself is not thread-safe.
+    With a circuit breaker, requests to failing hosts fail at once instead of waiting for timeouts;
+    in offline mode no request is sent at all.
+    """
+
+    def __init__(self, logger, pool_size=10, host_pool_sizes=None, circuit_breaker=None, offline_mode=None):
+        """Initialize HttpClient class
+
+        Args:
+            logger (logging.Logger): Logger instance
+            pool_size (int): Max number of kept-alive connections per host
+            host_pool_sizes (Dict[str, int]): Pool sizes for particular hosts, overriding pool_size
+            circuit_breaker (CircuitBreaker): Per-host circuit breaker, shared with other upstream clients
+            offline_mode (OfflineMode): Offline mode switch
+        """
+        self.logger = logger
+        self.circuit_breaker = circuit_breaker
+        self.offline_mode = offline_mode
+        self.pool_size = pool_size
+        self.host_pool_sizes = dict(host_pool_sizes or {})
+
+        self.default_adapter = HTTPAdapter(pool_maxsize=pool_size)
+        self.host_adapters = {}
+        for host, host_pool_size in self.host_pool_sizes.items():
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=host_pool_size)
+            self.host_adapters[f"http://{host}/"] = adapter
+            self.host_adapters[f"https://{host}/"] = adapter
+
+        self.local = threading.local()
+
+    @property
+    def session(self):
+        """requests.Session of the current thread, bound to the shared connection pools"""
+        session = getattr(self.local, "session", None)
+        if session is None:
+            session = requests.Session()
+            session.mount("http://", self.default_adapter)
+            session.mount("https://", self.default_adapter)
+            for prefix, adapter in self.host_adapters.items():
+                session.mount(prefix, adapter)
+            self.local.session = session
+        return session
+
+    def get(self, url, **kwargs):
+        """Send a GET request through the pooled connections; arguments are the same as of requests.get
+
+        Raises:
+            OfflineModeError: if offline mode is on
+            CircuitOpenError: if the host is failing and is not asked now
+        """
+        if self.offline_mode is not None:
+            self.offline_mode.check(url)
+        if self.circuit_breaker is None:
+            return self.session.get(url, **kwargs)
+
+        self.circuit_breaker.before_request(url)
+        try:
+            response = self.session.get(url, **kwargs)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+            self.circuit_breaker.record_failure(url)
+            raise
+        self.circuit_breaker.record_response(
+            url, response.status_code, parse_retry_after(response.headers.get("Retry-After"))
+        )
+        return response
+
+    def close(self):
+        """Close all pooled connections"""
+        self.default_adapter.close()
+        for adapter in self.host_adapters.values():
+            adapter.close()
@@ -0,0 +1,65 @@
+import threading
+import time
+
+
+class OfflineModeError(IOError):
+    """Offline mode is on: nothing is requested from the remote server"""
+
+    def __init__(self, url=None):
+        super().__init__(f"offline mode is on, not requesting {url}" if url else "offline mode is on")
+        self.url = url
+
+
+class OfflineMode:
+    """The offline mode switch, kept in the settings table so that it survives restarts
+    and is shared by all worker processes.
+
+    The setting is re-read from DB at most once per `check_interval` seconds: a switch made through
+    one worker process reaches the others within that time, while requests cost no DB query.
+    """
+
+    PREFS_KEY = "offline_mode"
+    # settings.value is TEXT: store a word, not a bool, which would come back as '0'/'1'
+    ON_VALUES = ("1", "on", "true")
+
+    def __init__(self, logger, db, check_interval=1):
+        """Initialize OfflineMode class
+
+        Args:
+            logger (logging.Logger): Logger instance
+            db (DBSQLite): Database keeping the setting
+            check_interval (float): Seconds the setting read from DB is trusted for
+        """
+        self.logger = logger
+        self.db = db
+        self.check_interval = check_interval
+        self.lock = threading.Lock()
+        self.enabled = self._read()
+        self.checked_at = time.monotonic()
+
+    def _read(self):
+        value = self.db.get_prefs_value(self.PREFS_KEY, "off")
+        return str(value).strip().lower() in self.ON_VALUES
+
+    @property
+    def is_on(self):
+        now = time.monotonic()
+        if now - self.checked_at >= self.check_interval:
+            with self.lock:
+                if now - self.checked_at >= self.check_interval:
+                    self.enabled = self._read()
+                    self.checked_at = now
+        return self.enabled
+
+    def set(self, enabled):
+        """Switch offline mode on or off, for all worker processes"""
+        with self.lock:
+            self.db.set_prefs_value(self.PREFS_KEY, "on" if enabled else "off")
+            self.enabled = bool(enabled)
+            self.checked_at = time.monotonic()
+        self.logger.info(f"Offline mode is {'on' if enabled else 'off'}")
+
+    def check(self, url=None):
+        """Raise OfflineModeError if offline mode is on"""
+        if self.is_on:
+            raise OfflineModeError(url)
@@ -0,0 +1,101 @@
+import gzip
+import hashlib
+
+try:
+    import brotli
+except ImportError:
+    # optional: pip install pypi-offgrid[brotli]
+    brotli = None
+
+
+class PageCache:
+    """Rendered /simple/ pages kept in DB in compressed form, so that a request costs a lookup
+    instead of a template rendering. Every page has a strong ETag derived from its content.
+
+    Pages of a project are dropped by DBSQLite.save_simple_links when its links change.
+    """
+
+    # the root page is recompressed whenever a project is added, so compression must stay cheap
+    GZIP_LEVEL = 6
+    BROTLI_QUALITY = 6
+
+    def __init__(self, db, use_brotli=True):
+        """Initialize PageCache class
+
+        Args:
+            db (DBSQLite): Database keeping the pages
+            use_brotli (bool): Also keep brotli-compressed bodies (needs the brotli package)
+        """
+        self.db = db
+        self.use_brotli = use_brotli and brotli is not None
+
+    def get(self, key, page_format, with_body=True):
+        """Return the page (see DBSQLite.get_rendered_page) or None if it's not rendered yet"""
+        return self.db.get_rendered_page(key, page_format, with_body)
+
+    def put(self, key, page_format, body, state=None, fragment=None):
+        """Compress and save the rendered page
+
+        Args:
+            key (str): Project name, or "/" for the root index
+            page_format (str): "html" or "json"
+            body (str): Rendered page
+            state (int): What the page was built from, for the caller to tell if it's outdated
+            fragment (str): Part of the page kept for building the next version of it incrementally
+
+        Returns:
+            dict: The saved page
+        """
+        body = body.encode("utf-8")
+        page = {
+            "etag": hashlib.sha256(body).hexdigest()[:32],
+            "state": state,
+            "body_gzip": gzip.compress(body, self.GZIP_LEVEL, mtime=0),
+            "body_br": brotli.compress(body, quality=self.BROTLI_QUALITY) if self.use_brotli else None,
+            "fragment_gzip": gzip.compress(fragment.encode("utf-8"), 1, mtime=0) if fragment is not None else None,
+        }
+        self.db.save_rendered_page(key, page_format, page)
+        return page
+
+    @staticmethod
+    def get_fragment(page):
+        if not page or page.get("fragment_gzip") is None:
+            return None
+        return gzip.decompress(page["fragment_gzip"]).decode("utf-8")
+
+    def invalidate(self, key=None):
+        """Drop the rendered pages of `key`, or all of them"""
+        self.db.delete_rendered_pages(key)
+
+    @staticmethod
+    def etags(page):
+        """ETags of the page (unquoted): one per content encoding, as a strong ETag must differ between them"""
+        return {
+            None: page["etag"],
+            "gzip": f"{page['etag']}-gzip",
+            "br": f"{page['etag']}-br",
+        }
+
+    def choose_encoding(self, accepts_encoding):
+        """The best content encoding of pages the client accepts
+
+        Args:
+            accepts_encoding (Callable[[str], bool]): Whether the client accepts the content encoding
+
+        Returns:
+            Optional[str]: "br", "gzip" or None for identity
+        """
+        if self.use_brotli and accepts_encoding("br"):
+            return "br"
+        if accepts_encoding("gzip"):
+            return "gzip"
+        return None
+
+    @staticmethod
+    def get_body(page, encoding):
+        """Body of the page in the content encoding; returns (body, encoding actually used)"""
+        if encoding == "br" and page["body_br"] is not None:
+            return page["body_br"], "br"
+        if encoding in ("br", "gzip"):
+            return page["body_gzip"], "gzip"
+        return gzip.decompress(page["body_gzip"]), None
@@ -0,0 +1,242 @@
+import json
+import os
+import threading
+import toml
+from concurrent.futures import ThreadPoolExecutor
+
+from packaging.requirements import InvalidRequirement, Requirement
+from packaging.utils import (
+    InvalidSdistFilename,
+    InvalidWheelFilename,
+    canonicalize_name,
+    parse_sdist_filename,
+    parse_wheel_filename,
+)
+from packaging.version import InvalidVersion
+
+
+def parse_requirements_text(text, base_dir=None):
+    """Parse requirements.txt contents
+
+    Options (--index-url, --hash=... etc.), editable installs and direct URLs are skipped.
+    `-r`/`-c` files are read too when `base_dir` is given.
+
+    Returns:
+        Tuple[List[Requirement], List[str]]: Requirements and lines which could not be parsed
+    """
+    requirements = []
+    invalid = []
+
+    # join continued lines and drop comments
+    lines = text.replace("\\\r\n", " ").replace("\\\n", " ").splitlines()
+    for line in lines:
+        line = line.split(" #", 1)[0].strip()
+        if not line or line.startswith("#"):
+            continue
+
+        included_file = None
+        for option in ("--requirement", "--constraint", "-r", "-c"):
+            if line.startswith(option):
+                included_file = line[len(option):].lstrip(" =")
+                break
+        if included_file is not None:
+            if base_dir is not None:
+                nested_requirements, nested_invalid = parse_requirements_file(os.path.join(base_dir, included_file))
+                requirements += nested_requirements
+                invalid += nested_invalid
+            continue
+        if line.startswith("-"):
+            continue
+
+        # per-requirement options: "name==1.0 --hash=sha256:..."
+        line = line.split(" --", 1)[0].strip()
+        try:
+            requirement = Requirement(line)
+        except InvalidRequirement:
+            invalid.append(line)
+            continue
+        if requirement.url is None:
+            requirements.append(requirement)
+
+    return requirements, invalid
+
+
+def parse_lockfile(data):
+    """Parse a lockfile: poetry.lock, pdm.lock, uv.lock, pylock.toml (TOML) or Pipfile.lock (JSON)
+
+    Args:
+        data (dict): Parsed contents of the lockfile
+
+    Returns:
+        Tuple[List[Requirement], List[str]]: Pinned requirements and entries which could not be parsed
+    """
+    packages = []
+    if "package" in data or "packages" in data:
+        # [[package]] (poetry, pdm, uv) or [[packages]] (PEP 751)
+        packages = [(p.get("name"), p.get("version")) for p in data.get("package", data.get("packages", []))]
+    else:
+        # Pipfile.lock: {"default": {"name": {"version": "==1.0"}}, "develop": {...}}
+        for section in ("default", "develop"):
+            for name, entry in data.get(section, {}).items():
+                packages.append((name, entry.get("version", "").lstrip("=")))
+
+    requirements = []
+    invalid = []
+    for name, version in packages:
+        if not name or not version:
+            # local and VCS packages have no version to look up
+            continue
+        try:
+            requirements.append(Requirement(f"{name}=={version}"))
+        except InvalidRequirement:
+            invalid.append(f"{name}=={version}")
+    return requirements, invalid
+
+
+def parse_requirements_content(text, file_name, base_dir=None):
+    """Parse a requirements file or a lockfile; the format is told by the file name"""
+    file_name = os.path.basename(file_name).lower()
+    if (file_name.endswith(".lock") and file_name != "pipfile.lock") or file_name.endswith(".toml"):
+        return parse_lockfile(toml.loads(text))
+    if file_name == "pipfile.lock" or file_name.endswith(".json"):
+        return parse_lockfile(json.loads(text))
+    return parse_requirements_text(text, base_dir)
+
+
+def parse_requirements_file(file_path):
+    with open(file_path, "r", encoding="utf-8") as f:
+        return parse_requirements_content(f.read(), file_path, os.path.dirname(file_path))
+
+
+def get_file_version(file_name):
+    """Version of the project file from its name, or None for unknown file types"""
+    try:
+        if file_name.endswith(".whl"):
+            return parse_wheel_filename(file_name)[1]
+        if file_name.endswith((".tar.gz", ".zip")):
+            return parse_sdist_filename(file_name)[1]
+    except (InvalidWheelFilename, InvalidSdistFilename, InvalidVersion):
+        pass
+    return None
+
+
+class Prefetcher:
+    """Downloads into the cache all files of the projects' versions selected by requirements,
+    so that later installs are served without going to the remote server"""
+
+    def __init__(self, logger, db, download_manager, refresh_func, index_ttl=600, max_workers=4, refresh_many_func=None):
+        """Initialize Prefetcher class
+
+        Args:
+            logger (logging.Logger): Logger instance
+            db (DBSQLite): Database with project links
+            download_manager (DownloadManager): Downloads files into the cache
+            refresh_func (Callable[[str], Any]): Function that refreshes one project from the remote index
+            index_ttl (int): Project data younger than this (seconds) is not refreshed
+            max_workers (int): Number of files downloaded at the same time
+            refresh_many_func (Callable[[List[str]], Any]): Function that refreshes many projects at once
+        """
+        self.logger = logger
+        self.db = db
+        self.download_manager = download_manager
+        self.refresh_func = refresh_func
+        self.index_ttl = index_ttl
+        self.max_workers = max_workers
+        self.refresh_many_func = refresh_many_func
+
+    def resolve(self, requirement):
+        """Find files of the best version matching the requirement: the version pip would install
+
+        Returns:
+            List[str]: URLs of the files on the remote server; empty if nothing matches
+        """
+        project_name = canonicalize_name(requirement.name)
+        if not self.db.is_project_fresh(project_name, self.index_ttl):
+            self.refresh_func(project_name)
+
+        files_by_version = {}
+        for link in self.db.get_simple_links(project_name) or []:
+            for link_text, link_href in link.items():
+                version = get_file_version(link_text)
+                if version is not None:
+                    files_by_version.setdefault(version, []).append(link_href)
+
+        versions = list(requirement.specifier.filter(files_by_version))
+        if not versions:
+            return []
+        return files_by_version[max(versions)]
+
+    def download(self, remote_url):
+        """Download the file into the cache unless it's already there
+
+        Returns:
+            bool: True if the file was downloaded, False if it was already cached
+
+        Raises:
+            IOError: if the download fails
+        """
+        download = self.download_manager.get_or_start(remote_url)
+        if download is None:
+            return False
+        if not download.wait_until_done():
+            raise IOError(f"Download of {remote_url} failed: {download.error}")
+        return True
+
+    def prefetch(self, requirements):
+        """Resolve the requirements and download the files, `max_workers` at a time
+
+        Returns:
+            dict: Summary: numbers of files downloaded, already cached and failed,
+                  and requirements nothing was found for
+        """
+        result = {"downloaded": 0, "cached": 0, "failed": [], "unresolved": []}
+
+        # refresh stale projects in one batch rather than one by one in resolve()
+        if self.refresh_many_func is not None:
+            stale_projects = {
+                canonicalize_name(requirement.name) for requirement in requirements
+                if not self.db.is_project_fresh(canonicalize_name(requirement.name), self.index_ttl)
+            }
+            if stale_projects:
+                self.refresh_many_func(sorted(stale_projects))
+
+        remote_urls = []
+        for requirement in requirements:
+            try:
+                files = self.resolve(requirement)
+            except Exception:
+                self.logger.warning(f"Prefetch: failed to resolve {requirement}", exc_info=True)
+                files = []
+            if not files:
+                result["unresolved"].append(str(requirement))
+            remote_urls += [url for url in files if url not in remote_urls]
+
+        self.logger.info(f"Prefetch: {len(requirements)} requirements, {len(remote_urls)} files")
+
+        lock = threading.Lock()
+
+        def download_one(remote_url):
+            try:
+                downloaded = self.download(remote_url)
+            except Exception as e:
+                self.logger.warning(f"Prefetch: {e}")
+                with lock:
+                    result["failed"].append(remote_url)
+                return
+            with lock:
+                result["downloaded" if downloaded else "cached"] += 1
+
+        with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="prefetch") as executor:
+            list(executor.map(download_one, remote_urls))
+
+        self.logger.info(
+            f"Prefetch finished: {result['downloaded']} downloaded, {result['cached']} already cached, "
+            f"{len(result['failed'])} failed, {len(result['unresolved'])} requirements not found"
+        )
+        return result
+
+    def prefetch_in_background(self, requirements):
+        """Run prefetch() in a background thread; the summary goes to the log"""
+        thread = threading.Thread(target=self.prefetch, args=(requirements,), name="prefetch", daemon=True)
+        thread.start()
+        return thread
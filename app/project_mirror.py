@@ -0,0 +1,222 @@
+import fnmatch
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+
+from packaging.specifiers import InvalidSpecifier, SpecifierSet
+from packaging.utils import InvalidWheelFilename, parse_wheel_filename
+
+from app.prefetcher import get_file_version
+
+
+class HostRateLimiter:
+    """Spaces out requests to each host: no more than `rate` requests per second"""
+
+    def __init__(self, default_rate=0, host_rates=None):
+        """Initialize HostRateLimiter class
+
+        Args:
+            default_rate (float): Requests per second to any host; 0 means no limit
+            host_rates (Dict[str, float]): Limits of particular hosts, overriding `default_rate`
+        """
+        self.default_rate = default_rate
+        self.host_rates = host_rates or {}
+        self.lock = threading.Lock()
+        self.next_request_at = {}
+
+    def wait(self, url):
+        """Block until a request to the host of `url` is allowed"""
+        host = urlparse(url).hostname
+        rate = self.host_rates.get(host, self.default_rate)
+        if not rate:
+            return
+
+        with self.lock:
+            now = time.monotonic()
+            request_at = max(now, self.next_request_at.get(host, now))
+            self.next_request_at[host] = request_at + 1 / rate
+        if request_at > now:
+            time.sleep(request_at - now)
+
+
+class ProjectMirror:
+    """Downloads every missing file of a project (optionally filtered by version and tags) as a background job.
+
+    Jobs and their progress are kept in DB, so any worker process can report or cancel them.
+    """
+
+    def __init__(self, logger, db, cached_files, download_manager, refresh_func, max_workers=4, rate_limiter=None):
+        """Initialize ProjectMirror class
+
+        Args:
+            logger (logging.Logger): Logger instance
+            db (DBSQLite): Database with project links and jobs
+            cached_files (CachedFiles): Cache directory manager
+            download_manager (DownloadManager): Downloads files into the cache
+            refresh_func (Callable[[str], Any]): Function that refreshes one project from the remote index
+            max_workers (int): Number of files downloaded at the same time by one job
+            rate_limiter (HostRateLimiter): Limits requests per second to each host
+        """
+        self.logger = logger
+        self.db = db
+        self.cached_files = cached_files
+        self.download_manager = download_manager
+        self.refresh_func = refresh_func
+        self.max_workers = max_workers
+        self.rate_limiter = rate_limiter or HostRateLimiter()
+        # jobs run by this process, marked cancelled if it stops before they finish
+        self.lock = threading.Lock()
+        self.running_jobs = set()
+
+    @staticmethod
+    def _split_patterns(value):
+        if not value:
+            return []
+        if isinstance(value, str):
+            value = value.split(",")
+        return [pattern.strip() for pattern in value if pattern.strip()]
+
+    def matches(self, file_name, versions=None, python_tags=None, platform_tags=None):
+        """Whether the project file passes the filters
+
+        Args:
+            file_name (str): Name of the file
+            versions (str): Version specifier, e.g. ">=2.0,<3"
+            python_tags (List[str]): Wheel python tag patterns, e.g. ["cp311", "py3"]
+            platform_tags (List[str]): Wheel platform tag patterns, e.g. ["manylinux*_x86_64", "any"]
+
+        Tags are fnmatch patterns; sdists have no tags and pass the tag filters.
+        """
+        if versions:
+            version = get_file_version(file_name)
+            if version is None or not SpecifierSet(versions).contains(version, prereleases=True):
+                return False
+
+        if (python_tags or platform_tags) and file_name.endswith(".whl"):
+            try:
+                tags = parse_wheel_filename(file_name)[3]
+            except InvalidWheelFilename:
+                return False
+            if python_tags and not any(
+                fnmatch.fnmatch(tag.interpreter, pattern) for tag in tags for pattern in python_tags
+            ):
+                return False
+            if platform_tags and not any(
+                fnmatch.fnmatch(tag.platform, pattern) for tag in tags for pattern in platform_tags
+            ):
+                return False
+
+        return True
+
+    def select_files(self, project_name, versions=None, python_tags=None, platform_tags=None):
+        """Files of the project passing the filters, as returned by CachedFiles.get_cached_file_info
+
+        Raises:
+            ValueError: if `versions` is not a valid version specifier
+        """
+        if versions:
+            try:
+                SpecifierSet(versions)
+            except InvalidSpecifier:
+                raise ValueError(f"Invalid version specifier: {versions}")
+        python_tags = self._split_patterns(python_tags)
+        platform_tags = self._split_patterns(platform_tags)
+
+        files_info = []
+        for link in self.db.get_simple_links(project_name) or []:
+            for link_text, link_href in link.items():
+                if self.matches(link_text, versions, python_tags, platform_tags):
+                    files_info.append(self.cached_files.get_cached_file_info(link_href, link_text))
+        return files_info
+
+    def start(self, project_name, versions=None, python_tags=None, platform_tags=None, refresh=True):
+        """Start mirroring the project in background
+
+        Returns:
+            dict: The new job, see DBSQLite.get_job
+        """
+        if refresh:
+            self.refresh_func(project_name)
+        files_info = self.select_files(project_name, versions, python_tags, platform_tags)
+        missing_urls = [info["remote_url"] for info in files_info if not info["file_exists"]]
+
+        job_id = uuid.uuid4().hex[:12]
+        params = {"versions": versions, "python_tags": python_tags, "platform_tags": platform_tags}
+        self.db.create_job(job_id, "mirror", project_name, params, len(missing_urls))
+        self.logger.info(f"Mirror job {job_id}: {len(missing_urls)} files of project {project_name} to download")
+
+        with self.lock:
+            self.running_jobs.add(job_id)
+        threading.Thread(
+            target=self.run_job, args=(job_id, missing_urls), name=f"mirror-{job_id}", daemon=True
+        ).start()
+        return self.db.get_job(job_id)
+
+    def cancel(self, job_id):
+        """Ask the job to stop; files already being downloaded are finished, the rest are skipped
+
+        Returns:
+            bool: False if there is no such running job
+        """
+        job = self.db.get_job(job_id)
+        if job is None or job["state"] != "running":
+            return False
+        self.db.update_job(job_id, state="cancelling")
+        return True
+
+    def _download(self, job_id, remote_url):
+        if self.db.get_job(job_id)["state"] != "running":
+            return
+
+        self.rate_limiter.wait(remote_url)
+        try:
+            download = self.download_manager.get_or_start(remote_url)
+            if download is not None and not download.wait_until_done():
+                raise IOError(f"Download of {remote_url} failed: {download.error}")
+        except Exception as e:
+            self.logger.warning(f"Mirror job {job_id}: {e}")
+            self.db.update_job(job_id, done_files_add=1, failed_files_add=1)
+            return
+
+        if download is None:
+            # cached meanwhile by somebody else
+            self.db.update_job(job_id, done_files_add=1)
+        else:
+            self.db.update_job(
+                job_id,
+                done_files_add=1,
+                downloaded_files_add=1,
+                downloaded_bytes_add=download.bytes_written,
+            )
+
+    def run_job(self, job_id, remote_urls):
+        """Download the files, `max_workers` at a time, recording progress in the job"""
+        try:
+            with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="mirror") as executor:
+                list(executor.map(lambda remote_url: self._download(job_id, remote_url), remote_urls))
+        except Exception as e:
+            self.logger.warning(f"Mirror job {job_id} failed", exc_info=True)
+            self.db.finish_job(job_id, "failed", str(e))
+            return
+        finally:
+            with self.lock:
+                self.running_jobs.discard(job_id)
+
+        # "cancelling", or "cancelled" already by shutdown()
+        state = "finished" if self.db.get_job(job_id)["state"] == "running" else "cancelled"
+        self.db.finish_job(job_id, state)
+        job = self.db.get_job(job_id)
+        self.logger.info(
+            f"Mirror job {job_id} {state}: {job['downloaded_files']} downloaded, {job['failed_files']} failed, "
+            f"{job['skipped_files']} skipped"
+        )
+
+    def shutdown(self):
+        """Mark the jobs of this process cancelled: their threads stop with it"""
+        with self.lock:
+            job_ids, self.running_jobs = self.running_jobs, set()
+        for job_id in job_ids:
+            self.logger.info(f"Mirror job {job_id} cancelled: the process is stopping")
+            self.db.finish_job(job_id, "cancelled")
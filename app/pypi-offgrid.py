@@ -2,14 +2,18 @@
 
 import os
 import sys
+import json
 import time
 import toml
 import click
 import psutil
 import platform
-import requests
+import hashlib
+import mimetypes
 
 from pprint import pprint
+from urllib.parse import quote, urldefrag
+from markupsafe import Markup, escape
 from dotenv import load_dotenv
 
 from flask import (
@@ -35,6 +39,17 @@ from app.cached_files import CachedFiles
 from app.logger import get_logger
 from app.db_sqlite import DBSQLite
 from app.remote_simple_index import RemoteSimpleIndex
+from app.async_remote_index import AsyncRemoteSimpleIndex, aiohttp
+from app.background_refresher import BackgroundRefresher
+from app.download_manager import TRANSIENT_ERRORS, DownloadManager
+from app.cache_manager import CacheManager
+from app.prefetcher import Prefetcher, parse_requirements_content, parse_requirements_file
+from app.project_mirror import HostRateLimiter, ProjectMirror
+from app.page_cache import PageCache
+from app.wheel_metadata import WheelMetadata
+from app.http_client import HttpClient
+from app.upstream_retry import CircuitBreaker, CircuitOpenError, RetryPolicy
+from app.offline_mode import OfflineMode
 
 
 main = Blueprint('main', __name__)
@@ -47,6 +62,15 @@ logger = None
 cached_files = None
 db = None
 remote_index = None
+http_client = None
+refresher = None
+download_manager = None
+cache_manager = None
+prefetcher = None
+project_mirror = None
+page_cache = None
+wheel_metadata = None
+offline_mode = None
 FLASK_LISTEN_IP = None
 FLASK_LISTEN_PORT = None
 PROXY_SERVER_BASE_URL = None
@@ -54,11 +78,19 @@ REMOTE_INDEX_SIMPLE = None
 REMOTE_INDEX_JSON = None
 CONNECTION_TIMEOUT = None
 DOWNLOAD_TIMEOUT = None
+# ranges starting this far beyond the downloaded part of an in-flight file are requested from the remote server
+RANGE_PASSTHROUGH_DISTANCE = 4 * 1024 * 1024
 MAX_RETRIES = None
+INDEX_TTL = None
+REFRESH_WORKERS = None
 LOG_FILE_PATH = None
 DB_FILE_PATH = None
 CACHE_DIR = None
+SENDFILE_MODE = None
+X_ACCEL_REDIRECT_PREFIX = None
 WORKDIR = None
+# increase when rendering of /simple/ pages changes, to drop the pages rendered by the previous version
+RENDERED_PAGES_VERSION = 3
 
 
 
@@ -139,7 +171,7 @@ def settings_route():
     # log_human_file_size = cached_files.human_readable_size(os.path.getsize(LOG_FILE_PATH))
 
     server_info = {
-#        "offline_mode": OFFLINE_MODE,
+        "Offline mode": "on" if offline_mode.is_on else "off",
         "Listen IP": FLASK_LISTEN_IP,
         "Listen port": FLASK_LISTEN_PORT,
         "Proxy server base URL": PROXY_SERVER_BASE_URL,
@@ -151,6 +183,17 @@ def settings_route():
         "Connection timeout": CONNECTION_TIMEOUT,
         "Download timeout": DOWNLOAD_TIMEOUT,
         "Remote access retries": MAX_RETRIES,
+        "Index freshness window": cached_files.human_readable_time(INDEX_TTL),
+        "Background refresh workers": REFRESH_WORKERS,
+        "Prefetch workers": app_conf.PREFETCH_WORKERS,
+        "Mirror workers per job": app_conf.MIRROR_WORKERS,
+        "Mirror rate limit per host": f"{app_conf.MIRROR_RATE_LIMIT} requests/s" if app_conf.MIRROR_RATE_LIMIT else "none",
+        "Upstream connection pool size": app_conf.HTTP_POOL_SIZE,
+        "Cached files sent by": SENDFILE_MODE,
+        "Index pages compression": "gzip, brotli" if page_cache.use_brotli else "gzip",
+        "Cache size limit": cached_files.human_readable_size(app_conf.CACHE_MAX_SIZE) if app_conf.CACHE_MAX_SIZE else "none",
+        "Cache age limit": cached_files.human_readable_time(app_conf.CACHE_MAX_AGE) if app_conf.CACHE_MAX_AGE else "none",
+        "Cache eviction policy": app_conf.CACHE_EVICTION_POLICY,
 
         "Server OS": f"{os_name} {os_version}",
         "Server uptime": cached_files.human_readable_time(uptime),
@@ -184,6 +227,91 @@ def favicon_route():
 ##       ######  #### ##     ## ##        ######## ########
 
 
+# PEP 691 content types of the simple API
+SIMPLE_JSON = "application/vnd.pypi.simple.v1+json"
+SIMPLE_HTML = "application/vnd.pypi.simple.v1+html"
+
+
+def negotiate_simple_format():
+    """Content type of the simple API response the client prefers (PEP 691); HTML if it didn't say.
+    ?format=<content type> overrides the Accept header."""
+    requested = request.args.get("format")
+    if requested in (SIMPLE_JSON, SIMPLE_HTML, "text/html"):
+        return requested
+    if not request.accept_mimetypes:
+        return "text/html"
+    # of equally acceptable types the first is chosen: */* (curl, requests, old installers) gets HTML,
+    # JSON goes only to clients asking for it
+    return request.accept_mimetypes.best_match(["text/html", SIMPLE_HTML, SIMPLE_JSON]) or "text/html"
+
+
+def simple_page_response(page, page_format, load_page):
+    """Response with a page from the page cache: 304 if the client has it, otherwise its body
+    in the best content encoding the client accepts.
+
+    Args:
+        page (dict): The page; may be without body (see PageCache.get)
+        page_format (str): "html" or "json"
+        load_page (Callable[[], Optional[dict]]): Returns the page with body
+    """
+    if page_format == "json":
+        mimetype = SIMPLE_JSON
+    else:
+        mimetype = SIMPLE_HTML if negotiate_simple_format() == SIMPLE_HTML else "text/html"
+
+    encoding = page_cache.choose_encoding(lambda name: request.accept_encodings[name] > 0)
+    etags = page_cache.etags(page)
+
+    if any(request.if_none_match.contains(etag) for etag in etags.values()):
+        response = Response(status=304)
+    else:
+        if page.get("body_gzip") is None:
+            page = load_page()
+            if page is None:
+                return "Not found", 404
+            etags = page_cache.etags(page)
+        body, encoding = page_cache.get_body(page, encoding)
+        response = Response(body, mimetype=mimetype)
+        if encoding is not None:
+            response.headers["Content-Encoding"] = encoding
+
+    response.set_etag(etags[encoding])
+    response.vary.add("Accept")
+    response.vary.add("Accept-Encoding")
+    return response
+
+
+def render_simple_index(page_format):
+    """Render the root /simple/ page and save it to the page cache.
+
+    Links are rendered only for projects added since the saved page was built (projects are listed
+    in the order they were added), and appended to the links of the saved page.
+    """
+    old_page = page_cache.get("/", page_format)
+    fragment = page_cache.get_fragment(old_page)
+    after_id = old_page["state"] if fragment is not None else 0
+    if fragment is None:
+        fragment = ""
+
+    last_id = after_id
+    new_links = []
+    for project_id, project_name in db.get_simple_names_after(after_id):
+        if page_format == "json":
+            new_links.append(f',{{"name": {json.dumps(project_name)}}}')
+        else:
+            new_links.append(f'\n    <a href="{escape(project_name)}/">{escape(project_name)}</a><br />')
+        last_id = project_id
+    fragment += "".join(new_links)
+
+    if page_format == "json":
+        body = '{"meta": {"api-version": "1.0"}, "projects": [' + fragment[1:] + "]}"
+    else:
+        # TODO rename "package_name" to "project_name"
+        body = render_template("simple_index.html", package_links=Markup(fragment))
+
+    return page_cache.put("/", page_format, body, state=last_id, fragment=fragment)
+
+
 @main.route("/simple/", strict_slashes=False)
 def list_packages_route():
     """List all available packages as HTML."""
@@ -192,61 +320,160 @@ def list_packages_route():
     # TODO it was my mistake to call "project" a "package" and now i need to rename all the right way
 
     try:
-        project_names = db.get_simple_all_names()
-        # TODO rename "package_name" to "project_name"
-        return render_template("simple_index.html", package_names=project_names)
+        page_format = "json" if negotiate_simple_format() == SIMPLE_JSON else "html"
+        page = page_cache.get("/", page_format, with_body=False)
+        if page is None or page["state"] != db.get_simple_max_id():
+            page = render_simple_index(page_format)
+        return simple_page_response(
+            page, page_format, lambda: page_cache.get("/", page_format) or render_simple_index(page_format)
+        )
     except Exception as e:
         logger.error("Failed to list packages", exc_info=e)
         return jsonify(error=str(e)), 500
 
 
+def refresh_project(project_name):
+    """Fetch project links and JSON from the remote index and save them to DB.
+
+    Requests are conditional, so unchanged data is neither downloaded nor rewritten.
+    """
+    refresh_projects([project_name])
+
+
+def refresh_projects(project_names):
+    """Refresh many projects at once: with the async engine all of them are fetched concurrently."""
+    projects = {
+        project_name: (db.get_simple_validators(project_name), db.get_package_validators(project_name))
+        for project_name in project_names
+    }
+    results = remote_index.fetch_projects(projects)
+
+    for project_name, result in results.items():
+        if isinstance(result, Exception):
+            logger.warning(f"Failed to get project {project_name} info from remote index", exc_info=result)
+            continue
+        try:
+            if result["links"] is None:
+                db.touch_simple_links(project_name, result["simple_validators"])
+            else:
+                db.save_simple_links(project_name, result["links"], result["simple_validators"], result["link_attrs"])
+            if result["project_info"] is not None:
+                db.save_package_json(project_name, result["project_info"], result["package_validators"])
+        except:
+            logger.warning(f"Failed to save project {project_name} info", exc_info=True)
+
+
 @main.route("/simple/<project_name>/", strict_slashes=False)
 def list_package_files_route(project_name):
     """List all files for a specific package as HTML."""
     logger.debug(f"Listing files for package {project_name}")
 
-    try:
-        # TODO implement OFFLINE_MODE
-        project_links = remote_index.fetch_simple_links(project_name)
-        db.save_simple_links(project_name, project_links)
-
-        project_info = remote_index.fetch_pypi_json(project_name)
-        db.save_package_json(project_name, project_info)
-
-    except:
-        logger.warning("Failed to get project info from remote index", exc_info=True)
+    # go to the remote index only if the data in DB is missing or older than INDEX_TTL;
+    # stale data is served right away and refreshed in background
+    if offline_mode.is_on:
+        logger.debug(f"Offline mode, serving project {project_name} from DB")
+    elif db.is_project_fresh(project_name, INDEX_TTL):
+        logger.debug(f"Project {project_name} is fresh, serving it from DB")
+    elif db.get_project_refreshed_at(project_name) is not None:
+        logger.debug(f"Project {project_name} is stale, serving it from DB")
+        refresher.submit(project_name)
+    else:
+        refresher.refresh(project_name)
 
     try:
-        # load project data from DB
-        simple_links = db.get_simple_links(project_name)
-        if simple_links:
-            # proxify links and return project page with links to packages
-            proxified_links = {}
-
-            for link in simple_links:
-                for link_text, link_href in link.items():
-                    proxified_link_href = cached_files.proxify_url(link_href)
-                    proxified_links[link_text] = proxified_link_href
-
-            return render_template(
-                "simple_package.html",
-                project_name=project_name,
-                links=proxified_links,
-            )
-
-        else:
+        page_format = "json" if negotiate_simple_format() == SIMPLE_JSON else "html"
+        page = page_cache.get(project_name, page_format, with_body=False)
+        if page is None:
+            page = render_project_page(project_name, page_format)
+        if page is None:
+            if offline_mode.is_on:
+                # not in DB and the remote index is not asked in offline mode
+                return "Service Unavailable (Offline Mode Enabled)", 503
             # no records found or project contains no links -- return 404
             logger.warning(f"Project {project_name} not found")
             return f"Project {project_name} not found", 404
 
+        return simple_page_response(
+            page,
+            page_format,
+            lambda: page_cache.get(project_name, page_format) or render_project_page(project_name, page_format),
+        )
+
     except Exception as e:
         logger.error(f"Failed to list files for package {project_name}", exc_info=e)
         return jsonify(error=str(e)), 500
 
 
+def render_project_page(project_name, page_format):
+    """Render the project page from DB and save it to the page cache
+
+    Returns:
+        Optional[dict]: The page, or None if the project has no links
+    """
+    # load project data from DB
+    simple_links = db.get_simple_links(project_name)
+    if not simple_links:
+        return None
+
+    # proxify links and render project page with links to packages
+    links = {}
+    for link in simple_links:
+        links.update(link)
+    proxified_links = cached_files.proxify_urls(links)
+    link_attrs = db.get_simple_link_attrs(project_name)
+    # metadata (PEP 658) is advertised only where the download route serves it: wheels at .whl URLs
+    metadata_links = {
+        link_text for link_text, link_href in proxified_links.items()
+        if link_text.endswith(".whl") and WheelMetadata.is_wheel_url(link_href)
+    }
+
+    if page_format == "json":
+        body = json.dumps(simple_project_json(project_name, proxified_links, link_attrs, metadata_links))
+    else:
+        body = render_template(
+            "simple_package.html",
+            project_name=project_name,
+            links=proxified_links,
+            link_attrs=link_attrs,
+            metadata_links=metadata_links,
+        )
+    return page_cache.put(project_name, page_format, body)
+
+
+def simple_project_json(project_name, links, link_attrs, metadata_links=()):
+    """PEP 691 JSON of the project page, built from its links and their data-* attributes"""
+    files = []
+    for link_text, link_href in links.items():
+        url, fragment = urldefrag(link_href)
+        hashes = {}
+        if "=" in fragment:
+            hash_name, hash_value = fragment.split("=", 1)
+            hashes[hash_name] = hash_value
+
+        file = {"filename": link_text, "url": url, "hashes": hashes}
+        attrs = link_attrs.get(link_text, {})
+        if attrs.get("requires_python"):
+            file["requires-python"] = attrs["requires_python"]
+        if "yanked" in attrs:
+            file["yanked"] = attrs["yanked"] or True
+        if link_text in metadata_links:
+            # metadata of the wheel is served at <url>.metadata (PEP 658), see WheelMetadata
+            file["core-metadata"] = file["dist-info-metadata"] = core_metadata_json(attrs.get("core_metadata"))
+        files.append(file)
+
+    return {"meta": {"api-version": "1.0"}, "name": project_name, "files": files}
+
+
+def core_metadata_json(core_metadata):
+    """data-core-metadata value ("true" or "<hash name>=<hex>,...") in PEP 691 form: True or {hash name: hex}"""
+    if not core_metadata or "=" not in core_metadata:
+        return True
+    return dict(item.split("=", 1) for item in core_metadata.split(",") if "=" in item)
+
+
 @main.route(
     "/download_file/<string:base64_host>/<path:file_path>",
-    methods=["GET"],
+    methods=["GET", "HEAD"],
     strict_slashes=False,
 )
 def download_file_route(base64_host, file_path):
@@ -266,66 +493,182 @@ def download_file_route(base64_host, file_path):
     logger.info(f"request to download file {remote_url} ")
     logger.debug(f"download_file_route: {base64_host} {file_path}")
 
-    # Convert URL file path to the local absolute path in the cache directory
-    cached_file_path = cached_files.convert_url_to_file_path(remote_url)
+    # Find the file in the cache directory
+    cached_file_path = cached_files.find_cached_file(remote_url)
 
-    if os.path.exists(cached_file_path):
+    if cached_file_path is not None:
         # File is already in cache: send it to user
         logger.debug(f"download_file_route: FILE ALREADY CACHED {cached_file_path}")
-        return send_from_directory(
-            os.path.dirname(cached_file_path), os.path.basename(cached_file_path)
-        )
-
-    # elif OFFLINE_MODE:
-    #     # File is not in cache, but offline mode is enabled: return http error "503 Service Unavailable"
-    #     return "Service Unavailable (Offline Mode Enabled)", 503
+        return send_cached_file(cached_file_path, remote_url)
+
+    elif wheel_metadata.is_metadata_url(remote_url):
+        # PEP 658 metadata of a wheel: taken from the wheel instead of downloading a separate file
+        # the metadata is advertised, so clients take 404 for a broken index: failures are 502/503
+        try:
+            cached_file_path = wheel_metadata.get_metadata_file(remote_url)
+        except CircuitOpenError as e:
+            logger.warning(f"download_file_route: no metadata for {remote_url}: {e}")
+            return str(e), 503, {"Retry-After": str(int(e.retry_in) + 1)}
+        except Exception as e:
+            logger.warning(f"download_file_route: no metadata for {remote_url}: {e}")
+            if offline_mode.is_on:
+                # neither the metadata nor the wheel is cached
+                return "Service Unavailable (Offline Mode Enabled)", 503
+            return f"Failed to get metadata of {remote_url}", 502
+        return send_cached_file(cached_file_path, remote_url)
+
+    elif offline_mode.is_on:
+        # File is not in cache, but offline mode is enabled: return http error "503 Service Unavailable"
+        return "Service Unavailable (Offline Mode Enabled)", 503
 
     else:
         # File is not in cache: start downloading, at the same time sending it to user
-        # Downloading goes into temporary file, which is renamed into permanent one if (and only if) download is successful
+        # Downloading goes into temporary file, which is moved into the cache if (and only if) download is successful.
+        # Clients asking for the same file meanwhile share the same download.
         logger.debug(f"download_file_route: FILE DOES NOT CACHED {remote_url}")
 
-        # Prepare the temporary file path
-        # temp_file_path = helpers.append_temporary_file_suffix(cached_file_path)
-        temp_file_path = cached_files.get_temporary_file_name(cached_file_path)
+        download = download_manager.get_or_start(remote_url)
+        if download is None:
+            # download finished right now
+            return send_cached_file(cached_files.find_cached_file(remote_url), remote_url)
 
-        # Prepare target directories for the downloading files
-        cached_files.create_directories(
-            [
-                cached_files.extract_parent_directory(cached_file_path),
-                cached_files.extract_parent_directory(temp_file_path),
-            ]
-        )
-        # helpers.prepare_directory_for_file(cached_file_path)
-        # helpers.prepare_directory_for_file(temp_file_path)
-
-        # Create the download_stream to remote_url with timeouts CONNECTION_TIMEOUT and DOWNLOAD_TIMEOUT
-        download_stream = requests.get(
-            remote_url,
-            stream=True,
-            timeout=(CONNECTION_TIMEOUT, DOWNLOAD_TIMEOUT),
-        )
+        if not download.wait_for_headers():
+            if isinstance(download.error, CircuitOpenError):
+                # the remote server is down: fail at once, the client may retry or use another index
+                logger.warning(f"download_file_route: {download.error}")
+                return str(download.error), 503, {"Retry-After": str(int(download.error.retry_in) + 1)}
+            status_code = download.status_code or 502
+            logger.warning(f"download_file_route: remote server failed with {status_code} for {remote_url}")
+            return f"Failed to download {remote_url}", status_code
 
-        def stream_and_save():
-            with open(temp_file_path, "wb") as f:
-                for chunk in download_stream.iter_content(chunk_size=8192):
-                    if chunk:  # filter out keep-alive new chunks
-                        f.write(chunk)
-                        yield chunk
+        return inflight_download_response(download)
 
-            # When (and if) file is downloaded, rename it from temporary name to permanent one
-            logger.debug(
-                f"download_file_route: rename {temp_file_path} to {cached_file_path}"
-            )
-            os.rename(temp_file_path, cached_file_path)
 
-        # Return the response object containing the downloaded file
+def send_cached_file(cached_file_path, remote_url):
+    """Response with a file from the cache directory, sent without reading it into Python when possible.
+
+    SENDFILE_MODE:
+        "wsgi" -- send_file hands the open file to the server's wsgi.file_wrapper; gunicorn (`serve`)
+                  sends it with os.sendfile. Range and HEAD are handled by send_file.
+        "x-accel-redirect" -- empty response with X-Accel-Redirect to X_ACCEL_REDIRECT_PREFIX + path
+                  relative to the cache directory; nginx sends the file (internal location required).
+        "x-sendfile" -- empty response with X-Sendfile: absolute path (Apache mod_xsendfile, lighttpd).
+    """
+    # files in the content-addressed store have no extension, the type is guessed from the URL
+    mimetype = mimetypes.guess_type(cached_files.get_file_name_from_url(remote_url))[0] or "application/octet-stream"
+
+    if SENDFILE_MODE == "x-accel-redirect":
+        relative_path = os.path.relpath(cached_file_path, CACHE_DIR).replace(os.sep, "/")
+        response = Response(mimetype=mimetype)
+        response.headers["X-Accel-Redirect"] = X_ACCEL_REDIRECT_PREFIX.rstrip("/") + "/" + quote(relative_path)
+    else:
+        # with USE_X_SENDFILE (set for "x-sendfile" mode) send_file itself answers with X-Sendfile
+        response = send_file(cached_file_path, mimetype=mimetype, conditional=True)
+
+    # the file can't be evicted until it is sent
+    sha256 = cached_files.get_blob_sha256(cached_file_path)
+    if sha256 is not None:
+        cache_manager.record_hit(sha256)
+        cache_manager.pin(sha256)
+        call_once_on_close(response, lambda: cache_manager.unpin(sha256))
+    return response
+
+
+def call_once_on_close(response, callback):
+    """Call `callback` once, when the server is done with the response.
+
+    Response.call_on_close() alone is not enough for send_file responses: their file wrapper is handed
+    to the server as is (direct_passthrough), and the server closes the wrapper, not the response.
+    """
+    called = []
+
+    def callback_once():
+        if not called:
+            called.append(True)
+            callback()
+
+    response.call_on_close(callback_once)
+    body = response.response
+    if response.direct_passthrough and hasattr(body, "close"):
+        close_body = body.close
+
+        def close_body_and_callback():
+            try:
+                close_body()
+            finally:
+                callback_once()
+
+        body.close = close_body_and_callback
+
+
+def inflight_download_response(download):
+    """Response with the file which is still being downloaded: the whole file or the requested Range of it.
+
+    Bytes that have already arrived are sent at once, the rest as it arrives. A range lying far beyond
+    the downloaded part (e.g. the zip directory at the end of a wheel) is requested from the remote server.
+    """
+    if download.content_length is None:
+        # size is unknown, so ranges can't be served
+        return Response(
+            download.iter_content(),
+            content_type=download.content_type,
+            direct_passthrough=True,
+        )
+
+    length = int(download.content_length)
+    headers = {"Accept-Ranges": "bytes"}
+
+    # a single range is served; for several ranges or If-Range the whole file is sent, as RFC 9110 allows
+    byte_range = request.range
+    if byte_range is None or len(byte_range.ranges) != 1 or "If-Range" in request.headers:
+        headers["Content-Length"] = str(length)
         return Response(
-            stream_with_context(stream_and_save()),
-            content_type=download_stream.headers["content-type"],
+            download.iter_content(),
+            content_type=download.content_type,
+            headers=headers,
             direct_passthrough=True,
         )
 
+    start_stop = byte_range.range_for_length(length)
+    if start_stop is None:
+        return Response(
+            "Requested Range Not Satisfiable",
+            status=416,
+            headers={"Content-Range": f"bytes */{length}"},
+        )
+    start, stop = start_stop
+
+    if start - download.bytes_written > RANGE_PASSTHROUGH_DISTANCE and request.method != "HEAD":
+        try:
+            upstream_response = download_manager.fetch_range(download.remote_url, start, stop)
+        except TRANSIENT_ERRORS as e:
+            # the range is served from the download then, once it gets there
+            logger.debug(f"download_file_route: range request of {download.remote_url} failed: {e}")
+            upstream_response = None
+        if upstream_response is not None and upstream_response.status_code == 206:
+            logger.debug(f"download_file_route: range {start}-{stop - 1} of {download.remote_url} requested from remote server")
+            headers["Content-Range"] = upstream_response.headers.get("Content-Range", f"bytes {start}-{stop - 1}/{length}")
+            headers["Content-Length"] = str(stop - start)
+            return Response(
+                upstream_response.iter_content(chunk_size=65536),
+                status=206,
+                content_type=download.content_type,
+                headers=headers,
+                direct_passthrough=True,
+            )
+        if upstream_response is not None:
+            upstream_response.close()
+
+    headers["Content-Range"] = f"bytes {start}-{stop - 1}/{length}"
+    headers["Content-Length"] = str(stop - start)
+    return Response(
+        download.iter_content(start, stop),
+        status=206,
+        content_type=download.content_type,
+        headers=headers,
+        direct_passthrough=True,
+    )
+
 
 ##       ######     ###     ######  ##     ## ########            ######  ########    ###    ######## ##     ##  ######
 ##      ##    ##   ## ##   ##    ## ##     ## ##                 ##    ##    ##      ## ##      ##    ##     ## ##    ##
@@ -392,29 +735,41 @@ def cache_status_files_route(project_name):
 ##      ##     ##  ######  ##     ## ##      ##      ######## ##    ## ########  ##         #######  #### ##    ##    ##     ######
 
 
-# @main.route("/webapi/get_offline_mode", strict_slashes=False)
-# def get_offline_mode():
+@main.route("/webapi/get_offline_mode", strict_slashes=False)
+def get_offline_mode():
 
-#     ret_value = "on" if OFFLINE_MODE else "off"
+    ret_value = "on" if offline_mode.is_on else "off"
 
-#     logger.debug(f"get_offline_mode requested, returning {ret_value}")
-#     return jsonify(ret_value)
+    logger.debug(f"get_offline_mode requested, returning {ret_value}")
+    return jsonify(ret_value)
 
 
-# @main.route("/webapi/set_offline_mode/<string:value>", strict_slashes=False)
-# def set_offline_mode(value):
-#     global OFFLINE_MODE
-#     OFFLINE_MODE = value.lower() in ["true", "on"]
-#     db.set_prefs_value("offline_mode", OFFLINE_MODE)
-#     logger.debug(f"set_offline_mode requested, setting to {OFFLINE_MODE}")
-#     return jsonify(OFFLINE_MODE)
+@main.route("/webapi/set_offline_mode/<string:value>", methods=["GET", "POST"], strict_slashes=False)
+def set_offline_mode(value):
+    """Switch offline mode: "on"/"true" or "off"/"false"; saved in DB, all worker processes follow"""
+    if value.lower() not in ["true", "on", "false", "off"]:
+        return jsonify(error=f"Invalid value {value}, expected on or off"), 400
+    offline_mode.set(value.lower() in ["true", "on"])
+    logger.debug(f"set_offline_mode requested, setting to {value}")
+    return jsonify(offline_mode.is_on)
 
 
 @main.route("/webapi/list_projects/", strict_slashes=False)
 def list_all_projects():
-    return list_filtered_paginated_projects(
-        items_per_page=None, page_number=None, prj_mask=None
-    )
+    """All projects with summaries as one JSON object, streamed as it is read from DB"""
+    logger.debug("list_projects requested, all projects")
+
+    def generate():
+        yield "{"
+        separator = ""
+        for rows in db.iter_project_summaries("*"):
+            yield separator + ",".join(
+                f"{json.dumps(project_name)}:{json.dumps(summary)}" for project_name, summary in rows
+            )
+            separator = ","
+        yield "}"
+
+    return Response(generate(), mimetype="application/json")
 
 
 @main.route(
@@ -432,18 +787,87 @@ def list_paginated_projects(items_per_page=20, page_number=1):
 def list_filtered_paginated_projects(items_per_page, page_number, prj_mask=None):
     if prj_mask is None:
         prj_mask = "*"
+    # ?after=<last project name of the previous page> selects the page instead of page_number
+    after = request.args.get("after")
     logger.debug(
-        f"list_projects requested, prj_mask: {prj_mask}, items_per_page: {items_per_page}, page_number: {page_number}"
+        f"list_projects requested, prj_mask: {prj_mask}, items_per_page: {items_per_page}, page_number: {page_number}, after: {after}"
     )
-    project_names = db.get_simple_advanced(prj_mask, items_per_page, page_number)
-    project_descriptions = {
-        project_name: db.get_project_summary(project_name)
-        for project_name in project_names
-    }
+    project_descriptions = dict(db.get_project_summaries(prj_mask, items_per_page, page_number, after))
     ret_json = jsonify(project_descriptions)
     return ret_json
 
 
+@main.route("/webapi/prefetch/", methods=["POST"], strict_slashes=False)
+def prefetch_route():
+    """Warm up the cache: download in background all files required by the posted requirements files
+    or lockfiles. Files are posted as multipart form data, or as the request body with ?filename=
+    telling the format (requirements.txt, poetry.lock, Pipfile.lock, ...)."""
+    if request.files:
+        contents = [(f.filename, f.read().decode("utf-8")) for f in request.files.values()]
+    else:
+        contents = [(request.args.get("filename", "requirements.txt"), request.get_data(as_text=True))]
+
+    requirements = []
+    invalid = []
+    try:
+        for file_name, text in contents:
+            file_requirements, file_invalid = parse_requirements_content(text, file_name)
+            requirements += file_requirements
+            invalid += file_invalid
+    except Exception as e:
+        logger.warning("prefetch: failed to parse requirements", exc_info=True)
+        return jsonify(error=str(e)), 400
+
+    if offline_mode.is_on:
+        return jsonify(error="Service Unavailable (Offline Mode Enabled)"), 503
+
+    logger.info(f"prefetch requested: {len(requirements)} requirements")
+    prefetcher.prefetch_in_background(requirements)
+    return jsonify(requirements=[str(r) for r in requirements], invalid=invalid), 202
+
+
+@main.route("/webapi/mirror_project/<project_name>/", methods=["POST"], strict_slashes=False)
+def mirror_project_route(project_name):
+    """Start downloading all missing files of the project. Optional filters (form fields or JSON):
+    versions -- version specifier, e.g. ">=2.0,<3"; python_tags, platform_tags -- comma separated
+    wheel tag patterns, e.g. "cp311,py3" and "manylinux*_x86_64,any"."""
+    if offline_mode.is_on:
+        return jsonify(error="Service Unavailable (Offline Mode Enabled)"), 503
+
+    params = request.get_json(silent=True) or request.form
+    try:
+        job = project_mirror.start(
+            project_name,
+            versions=params.get("versions") or None,
+            python_tags=params.get("python_tags") or None,
+            platform_tags=params.get("platform_tags") or None,
+        )
+    except ValueError as e:
+        return jsonify(error=str(e)), 400
+    return jsonify(job), 202
+
+
+@main.route("/webapi/jobs/", strict_slashes=False)
+def list_jobs_route():
+    """Latest background jobs, newest first; ?project=<name> selects jobs of one project"""
+    return jsonify(db.list_jobs(request.args.get("project")))
+
+
+@main.route("/webapi/jobs/<job_id>", strict_slashes=False)
+def get_job_route(job_id):
+    job = db.get_job(job_id)
+    if job is None:
+        return jsonify(error=f"Job {job_id} not found"), 404
+    return jsonify(job)
+
+
+@main.route("/webapi/jobs/<job_id>/cancel", methods=["POST"], strict_slashes=False)
+def cancel_job_route(job_id):
+    if not project_mirror.cancel(job_id):
+        return jsonify(error=f"Job {job_id} is not running"), 409
+    return jsonify(db.get_job(job_id))
+
+
 
     
 ##       ######  ##       ####  ######  ##     ## 
@@ -459,9 +883,12 @@ def list_filtered_paginated_projects(items_per_page, page_number, prj_mask=None)
 def cli():
     pass
 
-@cli.command()
-@click.argument('workdir')
-def run(workdir):
+def init_app(workdir):
+    """Set up module globals: config, logger, DB, cache and upstream clients.
+
+    Called once per process; under the production server every worker calls it after fork,
+    so no connections, threads or locks are shared between workers.
+    """
     global app_conf    
     global WORKDIR
     global FLASK_LISTEN_IP
@@ -472,9 +899,13 @@ def run(workdir):
     global CONNECTION_TIMEOUT
     global DOWNLOAD_TIMEOUT
     global MAX_RETRIES
+    global INDEX_TTL
+    global REFRESH_WORKERS
     global LOG_FILE_PATH
     global DB_FILE_PATH
     global CACHE_DIR
+    global SENDFILE_MODE
+    global X_ACCEL_REDIRECT_PREFIX
     global app_conf
     global app
     global main
@@ -482,6 +913,15 @@ def run(workdir):
     global cached_files
     global db
     global remote_index
+    global http_client
+    global refresher
+    global download_manager
+    global cache_manager
+    global prefetcher
+    global project_mirror
+    global page_cache
+    global wheel_metadata
+    global offline_mode
     
             
     app_conf = ApplicationConf(workdir, 'pypi-offgrid.toml')
@@ -495,32 +935,252 @@ def run(workdir):
     CONNECTION_TIMEOUT = app_conf.CONNECTION_TIMEOUT
     DOWNLOAD_TIMEOUT = app_conf.DOWNLOAD_TIMEOUT
     MAX_RETRIES = app_conf.MAX_RETRIES
+    INDEX_TTL = app_conf.INDEX_TTL
+    REFRESH_WORKERS = app_conf.REFRESH_WORKERS
     # LOG_FILE_PATH = app_conf.LOG_FILE_PATH
     DB_FILE_PATH = app_conf.DB_FILE_PATH
     CACHE_DIR = app_conf.CACHE_DIR
+    SENDFILE_MODE = app_conf.SENDFILE_MODE
+    X_ACCEL_REDIRECT_PREFIX = app_conf.X_ACCEL_REDIRECT_PREFIX
 
     app.register_blueprint(main)
     app.logger.propagate = True
-    app.debug = True    
+    app.config['USE_X_SENDFILE'] = SENDFILE_MODE == "x-sendfile"
     
     logger = get_logger(WORKDIR, "messages.log")
     logger.debug("views.py loaded")
     
-    cached_files = CachedFiles(logger, CACHE_DIR, PROXY_SERVER_BASE_URL, "download_file")
     db = DBSQLite(DB_FILE_PATH)
-    remote_index = RemoteSimpleIndex(
+    cached_files = CachedFiles(logger, CACHE_DIR, PROXY_SERVER_BASE_URL, "download_file", db)
+    page_cache = PageCache(db, use_brotli=app_conf.SIMPLE_PAGES_BROTLI)
+    # rendered pages contain proxified links and depend on the templates: drop them when either changes
+    rendered_pages_key = hashlib.sha256(
+        (str(RENDERED_PAGES_VERSION) + PROXY_SERVER_BASE_URL + str(page_cache.use_brotli)).encode("utf-8")
+    )
+    for name in ("simple_index.html", "simple_package.html"):
+        with open(os.path.join(app.root_path, "templates", name), "rb") as f:
+            rendered_pages_key.update(f.read())
+    rendered_pages_key = rendered_pages_key.hexdigest()
+    if db.get_prefs_value("rendered_pages_key", None) != rendered_pages_key:
+        page_cache.invalidate()
+        db.set_prefs_value("rendered_pages_key", rendered_pages_key)
+    offline_mode = OfflineMode(logger, db)
+    retry_policy = RetryPolicy(
+        MAX_RETRIES,
+        backoff_base=app_conf.RETRY_BACKOFF_BASE,
+        backoff_max=app_conf.RETRY_BACKOFF_MAX,
+        retry_after_max=app_conf.RETRY_AFTER_MAX,
+    )
+    http_client = HttpClient(
         logger,
+        pool_size=app_conf.HTTP_POOL_SIZE,
+        host_pool_sizes=app_conf.HTTP_HOST_POOL_SIZES,
+        circuit_breaker=CircuitBreaker(
+            logger,
+            failure_threshold=app_conf.CIRCUIT_BREAKER_THRESHOLD,
+            reset_timeout=app_conf.CIRCUIT_BREAKER_RESET_TIMEOUT,
+            retry_after_max=app_conf.RETRY_AFTER_MAX,
+        ),
+        offline_mode=offline_mode,
+    )
+    remote_index_args = dict(
         simple_url=REMOTE_INDEX_SIMPLE,
         json_url=REMOTE_INDEX_JSON,
         connect_timeout=CONNECTION_TIMEOUT,
         download_timeout=DOWNLOAD_TIMEOUT,
         max_retries=MAX_RETRIES,
+        http_client=http_client,
+        retry_policy=retry_policy,
     )
+    if app_conf.ASYNC_FETCH and aiohttp is not None:
+        remote_index = AsyncRemoteSimpleIndex(
+            logger,
+            concurrency=app_conf.ASYNC_FETCH_CONCURRENCY,
+            **remote_index_args,
+        )
+    else:
+        remote_index = RemoteSimpleIndex(logger, **remote_index_args)
+    # batches only pay off when the projects of a batch are fetched concurrently
+    refresher = BackgroundRefresher(
+        logger,
+        refresh_project,
+        max_workers=REFRESH_WORKERS,
+        batch_refresh_func=refresh_projects if isinstance(remote_index, AsyncRemoteSimpleIndex) else None,
+    )
+    cache_manager = CacheManager(
+        logger,
+        db,
+        cached_files,
+        max_size=app_conf.CACHE_MAX_SIZE,
+        max_age=app_conf.CACHE_MAX_AGE,
+        policy=app_conf.CACHE_EVICTION_POLICY,
+        interval=app_conf.CACHE_EVICTION_INTERVAL,
+    )
+    cache_manager.start()
+    download_manager = DownloadManager(
+        logger,
+        cached_files,
+        connect_timeout=CONNECTION_TIMEOUT,
+        download_timeout=DOWNLOAD_TIMEOUT,
+        http_client=http_client,
+        cache_manager=cache_manager,
+        retry_policy=retry_policy,
+        db=db,
+    )
+    # temporary files of crashed processes and of downloads nobody resumed
+    download_manager.collect_garbage(app_conf.PARTIAL_DOWNLOAD_MAX_AGE)
+    prefetcher = Prefetcher(
+        logger,
+        db,
+        download_manager,
+        refresher.refresh,
+        index_ttl=INDEX_TTL,
+        max_workers=app_conf.PREFETCH_WORKERS,
+        refresh_many_func=refresher.refresh_many,
+    )
+    project_mirror = ProjectMirror(
+        logger,
+        db,
+        cached_files,
+        download_manager,
+        refresher.refresh,
+        max_workers=app_conf.MIRROR_WORKERS,
+        rate_limiter=HostRateLimiter(app_conf.MIRROR_RATE_LIMIT, app_conf.MIRROR_HOST_RATE_LIMITS),
+    )
+    wheel_metadata = WheelMetadata(logger, db, cached_files, download_manager)
 
     
     app.config['WORKDIR'] = workdir
+
+
+def shutdown_app():
+    """Stop background workers and close upstream connections of this process."""
+    logger.info("Shutting down")
+    project_mirror.shutdown()
+    refresher.shutdown()
+    cache_manager.stop()
+    remote_index.close()
+    http_client.close()
+    db.close()
+
+
+@cli.command()
+@click.argument('workdir')
+def run(workdir):
+    """Run the development server (single process, debug mode)."""
+    init_app(workdir)
+    app.debug = True    
     app.run(host=FLASK_LISTEN_IP, port=FLASK_LISTEN_PORT)
 
+
+@cli.command()
+@click.argument('workdir')
+@click.option('--workers', type=int, default=None, help='Number of worker processes (SERVER_WORKERS).')
+@click.option('--threads', type=int, default=None, help='Number of threads per worker (SERVER_THREADS).')
+def serve(workdir, workers, threads):
+    """Run the production server: several worker processes with a thread pool each."""
+    try:
+        from gunicorn.app.base import BaseApplication
+    except ImportError:
+        raise click.ClickException("the production server needs gunicorn: pip install gunicorn")
+
+    conf = ApplicationConf(workdir, 'pypi-offgrid.toml')
+
+    class ProductionServer(BaseApplication):
+        def load_config(self):
+            self.cfg.set("bind", f"{conf.FLASK_LISTEN_IP}:{conf.FLASK_LISTEN_PORT}")
+            self.cfg.set("workers", workers or conf.SERVER_WORKERS)
+            self.cfg.set("threads", threads or conf.SERVER_THREADS)
+            self.cfg.set("worker_class", "gthread")
+            self.cfg.set("graceful_timeout", conf.GRACEFUL_TIMEOUT)
+            self.cfg.set("worker_exit", lambda server, worker: shutdown_app())
+
+        def load(self):
+            # runs in every worker after fork
+            init_app(workdir)
+            return app
+
+    ProductionServer().run()
+
+@cli.command()
+@click.argument('workdir')
+@click.argument('files', nargs=-1, required=True, type=click.Path(exists=True, dir_okay=False))
+@click.option('--workers', type=int, default=None, help='Files downloaded at the same time (PREFETCH_WORKERS).')
+def prefetch(workdir, files, workers):
+    """Warm up the cache: download all files required by requirements files or lockfiles."""
+    init_app(workdir)
+    if offline_mode.is_on:
+        shutdown_app()
+        raise click.ClickException("offline mode is on, switch it off first: offline WORKDIR off")
+    if workers:
+        prefetcher.max_workers = workers
+
+    requirements = []
+    for file_path in files:
+        file_requirements, invalid = parse_requirements_file(file_path)
+        for line in invalid:
+            click.echo(f"{file_path}: skipped invalid requirement {line}", err=True)
+        requirements += file_requirements
+
+    try:
+        result = prefetcher.prefetch(requirements)
+    finally:
+        shutdown_app()
+
+    click.echo(f"downloaded: {result['downloaded']}, already cached: {result['cached']}")
+    for requirement in result["unresolved"]:
+        click.echo(f"not found: {requirement}", err=True)
+    for remote_url in result["failed"]:
+        click.echo(f"failed: {remote_url}", err=True)
+    if result["failed"]:
+        sys.exit(1)
+
+@cli.command()
+@click.argument('workdir')
+@click.argument('project_name')
+@click.option('--versions', default=None, help='Version specifier, e.g. ">=2.0,<3".')
+@click.option('--python-tags', default=None, help='Wheel python tag patterns, e.g. "cp311,py3".')
+@click.option('--platform-tags', default=None, help='Wheel platform tag patterns, e.g. "manylinux*_x86_64,any".')
+@click.option('--workers', type=int, default=None, help='Files downloaded at the same time (MIRROR_WORKERS).')
+def mirror(workdir, project_name, versions, python_tags, platform_tags, workers):
+    """Download all missing files of a project, e.g. to prepare an air-gapped environment."""
+    init_app(workdir)
+    if offline_mode.is_on:
+        shutdown_app()
+        raise click.ClickException("offline mode is on, switch it off first: offline WORKDIR off")
+    if workers:
+        project_mirror.max_workers = workers
+
+    try:
+        job = project_mirror.start(project_name, versions, python_tags, platform_tags)
+        while job["state"] in ("running", "cancelling"):
+            click.echo(f"\r{job['done_files']}/{job['total_files']} files", nl=False)
+            time.sleep(1)
+            job = db.get_job(job["id"])
+    finally:
+        shutdown_app()
+
+    click.echo(
+        f"\r{job['done_files']}/{job['total_files']} files, {job['downloaded_files']} downloaded "
+        f"({cached_files.human_readable_size(job['downloaded_bytes'])}), {job['failed_files']} failed, "
+        f"{job['skipped_files']} skipped"
+    )
+    if job["failed_files"]:
+        sys.exit(1)
+
+@cli.command()
+@click.argument('workdir')
+@click.argument('value', required=False, type=click.Choice(['on', 'off']))
+def offline(workdir, value):
+    """Show or switch offline mode: serve only from the cache, never asking the remote server."""
+    init_app(workdir)
+    try:
+        if value is not None:
+            offline_mode.set(value == 'on')
+        click.echo("on" if offline_mode.is_on else "off")
+    finally:
+        shutdown_app()
+
 @cli.command()
 @click.argument('workdir')
 def init(workdir):
@@ -1,48 +1,174 @@
 import json
+import time
 import requests
-from bs4 import BeautifulSoup
+from app.http_client import HttpClient
+from app.upstream_retry import CircuitOpenError, RetryPolicy, parse_retry_after
+from app.simple_page_parser import parse_simple_json, parse_simple_page
+
+# PEP 691: JSON preferred, HTML from indexes which don't have it
+SIMPLE_ACCEPT = (
+    "application/vnd.pypi.simple.v1+json, application/vnd.pypi.simple.v1+html;q=0.2, text/html;q=0.01"
+)
+
 
 class RemoteSimpleIndex:
-    def __init__(self, logger, simple_url, json_url, connect_timeout=5, download_timeout=30, max_retries=3):
+    def __init__(self, logger, simple_url, json_url, connect_timeout=5, download_timeout=30, max_retries=3, http_client=None, retry_policy=None):
         self.remote_simple_url = simple_url
         self.remote_json_url = json_url
         self.connect_timeout = connect_timeout
         self.download_timeout = download_timeout
-        self.max_retries = max_retries
+        self.retry_policy = retry_policy or RetryPolicy(max_retries)
+        self.max_retries = self.retry_policy.max_retries
         self.logger = logger
+        self.http = http_client or HttpClient(logger)
 
-    def fetch_content(self, url):
-        """Получает контент страницы по URL."""
+    def fetch_response(self, url, validators=None, headers=None):
+        """Получает ответ по URL; если переданы validators, запрос условный и ответ может быть 304."""
         self.logger.info(f"Fetching content from {url}")
-        for _ in range(self.max_retries):
+        headers = dict(headers or {})
+        if validators:
+            if validators.get("etag"):
+                headers["If-None-Match"] = validators["etag"]
+            if validators.get("last_modified"):
+                headers["If-Modified-Since"] = validators["last_modified"]
+
+        for attempt in range(self.retry_policy.max_retries):
+            retry_after = None
             try:
-                response = requests.get(url, timeout=(self.connect_timeout, self.download_timeout))
-                response.raise_for_status()
-                return response.text
+                response = self.http.get(url, headers=headers, timeout=(self.connect_timeout, self.download_timeout))
+            except CircuitOpenError:
+                raise
             except requests.exceptions.RequestException as e:
                 self.logger.debug(f"Error fetching content: {e}")
-        raise requests.exceptions.RequestException(f"Failed to fetch content from {url} after {self.max_retries} retries")
+            else:
+                if response.status_code == 304:
+                    self.logger.debug(f"Not modified: {url}")
+                    return response
+                if not self.retry_policy.is_retryable(response.status_code):
+                    # 4xx answers won't change on retry
+                    response.raise_for_status()
+                    return response
+                self.logger.debug(f"Error fetching content: {url} answered {response.status_code}")
+                retry_after = parse_retry_after(response.headers.get("Retry-After"))
+
+            delay = self.retry_policy.get_delay(attempt, retry_after)
+            if delay is None:
+                break
+            self.logger.debug(f"Retrying {url} in {delay:.1f} seconds")
+            time.sleep(delay)
+        raise requests.exceptions.RequestException(f"Failed to fetch content from {url} after {attempt + 1} attempts")
 
-    def fetch_simple_links(self, project_name):
-        """Получает SIMPLE LINKS для пакета."""
+    def fetch_content(self, url):
+        """Получает контент страницы по URL."""
+        return self.fetch_response(url).text
+
+    def get_validators(self, response):
+        """Извлекает из ответа ETag, Last-Modified и X-PyPI-Last-Serial."""
+        last_serial = response.headers.get("X-PyPI-Last-Serial")
+        return {
+            "etag": response.headers.get("ETag"),
+            "last_modified": response.headers.get("Last-Modified"),
+            "last_serial": int(last_serial) if last_serial and last_serial.isdigit() else None,
+        }
+
+    def fetch_simple_links(self, project_name, validators=None):
+        """Получает SIMPLE LINKS для пакета.
+
+        Returns:
+            Tuple[Optional[dict], Optional[dict], dict]: links {text: href} and their data-* attributes
+            (both None if not modified since `validators`), and new validators
+        """
         # TODO implement MAX_ATTEMPTS
         remote_url = self.remote_simple_url % project_name
         self.logger.debug(f"Fetching SIMPLE LINKS from {remote_url}")
-        content = self.fetch_content(remote_url)
-        soup = BeautifulSoup(content, 'html.parser')
+        response = self.fetch_response(remote_url, validators, {"Accept": SIMPLE_ACCEPT})
+        if response.status_code == 304:
+            return None, None, self.get_validators(response)
 
-        links = {}
-        for link in soup.find_all('a'):
-            link_text = link.string
-            link_href = link.get('href')
-            links[link_text] = link_href
+        # relative hrefs are resolved against the final URL of the page (after redirects)
+        content_type = response.headers.get("Content-Type", "")
+        if content_type.startswith("application/vnd.pypi.simple.v1+json"):
+            links, link_attrs = parse_simple_json(response.json(), response.url)
+        else:
+            links, link_attrs = parse_simple_page(response.text, response.url)
+        return links, link_attrs, self.get_validators(response)
 
-        return links
+    def fetch_pypi_json(self, project_name, validators=None):
+        """Получает JSON для пакета.
 
-    def fetch_pypi_json(self, project_name):
-        """Получает JSON для пакета."""
+        Returns:
+            Tuple[Optional[dict], dict]: project JSON (None if not modified since `validators`) and new validators
+        """
         remote_url = self.remote_json_url % project_name
         # url = f"https://pypi.org/pypi/{project_name}/json"
         self.logger.info(f"Fetching JSON from {remote_url}")
-        content = self.fetch_content(remote_url)
-        return json.loads(content) if content else None
+        response = self.fetch_response(remote_url, validators)
+        if response.status_code == 304:
+            return None, self.get_validators(response)
+
+        content = response.text
+        return (json.loads(content) if content else None), self.get_validators(response)
+
+    @staticmethod
+    def merge_validators(saved, received):
+        """Validators after a 304 answer: the received ones, falling back to the saved ones it didn't repeat"""
+        merged = dict(saved or {})
+        merged.update({name: value for name, value in received.items() if value is not None})
+        return merged
+
+    def skip_pypi_json(self, project_name, error):
+        """The JSON is optional (simple-only indexes have none): a project whose JSON failed is still
+        served from its links, and the saved JSON and its validators are kept"""
+        self.logger.warning(f"Failed to fetch JSON of project {project_name}, keeping the saved one: {error}")
+        return None
+
+    def fetch_project(self, project_name, simple_validators=None, package_validators=None):
+        """Получает SIMPLE LINKS и JSON пакета. JSON не запрашивается, если serial страницы
+        совпадает с serial сохранённого JSON; ошибка JSON не мешает сохранить SIMPLE LINKS.
+
+        Returns:
+            dict: "links", "link_attrs", "simple_validators", "project_info", "package_validators";
+            links and project_info are None if not modified (or, for the JSON, not fetched)
+        """
+        links, link_attrs, new_simple_validators = self.fetch_simple_links(project_name, simple_validators)
+        if links is None:
+            new_simple_validators = self.merge_validators(simple_validators, new_simple_validators)
+
+        # serial of the simple page tells whether the saved JSON is still current
+        upstream_serial = new_simple_validators.get("last_serial")
+        if upstream_serial is not None and upstream_serial == (package_validators or {}).get("last_serial"):
+            self.logger.debug(f"JSON of project {project_name} is up to date (serial {upstream_serial})")
+            project_info = None
+        else:
+            try:
+                project_info, package_validators = self.fetch_pypi_json(project_name, package_validators)
+            except Exception as e:
+                project_info = self.skip_pypi_json(project_name, e)
+
+        return {
+            "links": links,
+            "link_attrs": link_attrs,
+            "simple_validators": new_simple_validators,
+            "project_info": project_info,
+            "package_validators": package_validators,
+        }
+
+    def fetch_projects(self, projects):
+        """Получает данные многих пакетов, один за другим.
+
+        Args:
+            projects (Dict[str, Tuple[dict, dict]]): {project name: (simple validators, package validators)}
+
+        Returns:
+            dict: {project name: result of fetch_project, or the exception it raised}
+        """
+        results = {}
+        for project_name, (simple_validators, package_validators) in projects.items():
+            try:
+                results[project_name] = self.fetch_project(project_name, simple_validators, package_validators)
+            except Exception as e:
+                results[project_name] = e
+        return results
+
+    def close(self):
+        """Connections belong to the HttpClient, which is closed by its owner"""
@@ -0,0 +1,107 @@
+import html
+import re
+from urllib.parse import urljoin
+
+# <a ...attributes...>text</a>; attribute values may contain ">" when quoted
+ANCHOR_RE = re.compile(
+    r"""<a((?:\s+[^\s=/>]+(?:\s*=\s*(?:"[^"]*"|'[^']*'|[^\s"'>]+))?)*)\s*/?>(.*?)</a\s*>""",
+    re.IGNORECASE | re.DOTALL,
+)
+ATTRIBUTE_RE = re.compile(r"""([^\s=/>]+)(?:\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s"'>]+)))?""")
+TAG_RE = re.compile(r"<[^>]*>")
+
+# data-* attributes of file links (PEP 503, 592, 658, 714) and the names they are stored under
+LINK_ATTRIBUTES = {
+    "data-requires-python": "requires_python",
+    "data-yanked": "yanked",
+    "data-dist-info-metadata": "core_metadata",
+    "data-core-metadata": "core_metadata",
+    "data-gpg-sig": "gpg_sig",
+}
+
+
+def iter_anchors(page, base_url=None):
+    """Yield (text, href, attributes) of every link on a simple index page, without building a DOM tree
+
+    Args:
+        page (str): HTML of the page
+        base_url (str): URL of the page; relative hrefs are resolved against it
+
+    Yields:
+        Tuple[str, str, dict]: Link text, absolute href and lower-cased attributes (unescaped)
+    """
+    for match in ANCHOR_RE.finditer(page):
+        attributes = {}
+        for name, double_quoted, single_quoted, unquoted in ATTRIBUTE_RE.findall(match.group(1)):
+            value = double_quoted or single_quoted or unquoted
+            attributes[name.lower()] = html.unescape(value) if "&" in value else value
+
+        href = attributes.get("href")
+        if href is None:
+            continue
+        if base_url is not None and not href.startswith(("https://", "http://")):
+            href = urljoin(base_url, href)
+
+        text = match.group(2)
+        if "<" in text:
+            text = TAG_RE.sub("", text)
+        text = text.strip()
+        if "&" in text:
+            text = html.unescape(text)
+
+        yield text, href, attributes
+
+
+def parse_simple_page(page, base_url=None):
+    """Parse a PEP 503 project page
+
+    Returns:
+        Tuple[dict, dict]: links {text: href} and link attributes {text: {"requires_python": ...,
+        "yanked": reason or "", "core_metadata": "true" or "<hash name>=<hex>", ...}} of links having any
+    """
+    links = {}
+    link_attrs = {}
+    for text, href, attributes in iter_anchors(page, base_url):
+        links[text] = href
+        file_attrs = {
+            LINK_ATTRIBUTES[name]: value for name, value in attributes.items() if name in LINK_ATTRIBUTES
+        }
+        if file_attrs:
+            link_attrs[text] = file_attrs
+    return links, link_attrs
+
+
+def parse_simple_json(data, base_url=None):
+    """Parse a PEP 691 project page (application/vnd.pypi.simple.v1+json) into the same shape as
+    parse_simple_page: hashes go to the #<hash name>=<hex> fragment of the href, as in the HTML form"""
+    links = {}
+    link_attrs = {}
+    for file in data.get("files", []):
+        href = file["url"]
+        if base_url is not None and not href.startswith(("https://", "http://")):
+            href = urljoin(base_url, href)
+        hashes = file.get("hashes") or {}
+        if "#" not in href and hashes:
+            hash_name = "sha256" if "sha256" in hashes else next(iter(hashes))
+            href += f"#{hash_name}={hashes[hash_name]}"
+
+        text = file["filename"]
+        links[text] = href
+
+        file_attrs = {}
+        if file.get("requires-python"):
+            file_attrs["requires_python"] = file["requires-python"]
+        yanked = file.get("yanked", False)
+        if yanked:
+            file_attrs["yanked"] = yanked if isinstance(yanked, str) else ""
+        core_metadata = file.get("core-metadata", file.get("dist-info-metadata"))
+        if core_metadata:
+            file_attrs["core_metadata"] = (
+                "true" if core_metadata is True else ",".join(f"{k}={v}" for k, v in core_metadata.items())
+            )
+        if file.get("gpg-sig") is not None:
+            file_attrs["gpg_sig"] = "true" if file["gpg-sig"] else "false"
+        if file_attrs:
+            link_attrs[text] = file_attrs
+    return links, link_attrs
+
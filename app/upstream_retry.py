@@ -0,0 +1,162 @@
+import email.utils
+import random
+import threading
+import time
+from urllib.parse import urlparse
+
+# answers meaning "try again later"
+RETRYABLE_STATUS_CODES = frozenset((429, 500, 502, 503, 504))
+
+
+def parse_retry_after(value):
+    """Seconds to wait from a Retry-After header (delay in seconds or HTTP date), or None"""
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return int(value)
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, retry_at.timestamp() - time.time())
+
+
+class CircuitOpenError(IOError):
+    """The remote host is failing: the request is not sent at all"""
+
+    def __init__(self, host, retry_in):
+        super().__init__(f"remote host {host} is unavailable, not asking it for {retry_in:.0f} more seconds")
+        self.host = host
+        self.retry_in = retry_in
+
+
+class RetryPolicy:
+    """How upstream requests are retried: exponential backoff with full jitter, honoring Retry-After"""
+
+    def __init__(self, max_retries=3, backoff_base=0.5, backoff_max=10, retry_after_max=60):
+        """Initialize RetryPolicy class
+
+        Args:
+            max_retries (int): Number of attempts, the first one included
+            backoff_base (float): Delay (seconds) before the second attempt, doubled for every next one
+            backoff_max (float): Upper bound of the delay between attempts
+            retry_after_max (float): Longer Retry-After delays are not waited for: the request fails instead
+        """
+        self.max_retries = max(1, max_retries)
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.retry_after_max = retry_after_max
+
+    @staticmethod
+    def is_retryable(status_code):
+        return status_code in RETRYABLE_STATUS_CODES
+
+    def get_delay(self, attempt, retry_after=None):
+        """Seconds to wait after the failed attempt (0-based), or None if the request should not be retried
+
+        Args:
+            attempt (int): Number of the failed attempt, from 0
+            retry_after (Optional[float]): Delay the remote server asked for
+        """
+        if attempt + 1 >= self.max_retries:
+            return None
+        if retry_after is not None:
+            return retry_after if retry_after <= self.retry_after_max else None
+        # full jitter: clients failing together don't come back together
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+
+class CircuitBreaker:
+    """Per-host circuit breaker: after `failure_threshold` failures in a row the host is not asked for
+    `reset_timeout` seconds, requests to it fail at once. Then one probe request is let through:
+    success closes the circuit, failure opens it again.
+
+    A 429 or 5xx answer with Retry-After pauses requests to the host for that long straight away.
+    """
+
+    def __init__(self, logger, failure_threshold=5, reset_timeout=30, retry_after_max=60):
+        """Initialize CircuitBreaker class
+
+        Args:
+            logger (logging.Logger): Logger instance
+            failure_threshold (int): Failures in a row opening the circuit; 0 turns the breaker off
+            reset_timeout (float): Seconds the circuit stays open before a probe request
+            retry_after_max (float): Upper bound of the time a Retry-After answer opens the circuit for
+        """
+        self.logger = logger
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.retry_after_max = retry_after_max
+        self.lock = threading.Lock()
+        # host -> {"failures": failures in a row, "open_until": monotonic time requests are refused till,
+        #          "probe_at": when the probe request was let through, or None}
+        self.hosts = {}
+
+    @staticmethod
+    def get_host(url):
+        return urlparse(url).netloc
+
+    def before_request(self, url):
+        """Check that the host of `url` may be asked
+
+        Raises:
+            CircuitOpenError: if the circuit of the host is open
+        """
+        if not self.failure_threshold:
+            return
+        host = self.get_host(url)
+        with self.lock:
+            state = self.hosts.get(host)
+            if state is None:
+                return
+            now = time.monotonic()
+            if now < state["open_until"]:
+                raise CircuitOpenError(host, state["open_until"] - now)
+            if state["failures"] < self.failure_threshold:
+                return
+            # half-open: one probe at a time; a probe that never reported back is replaced after reset_timeout
+            if state["probe_at"] is not None and now - state["probe_at"] < self.reset_timeout:
+                raise CircuitOpenError(host, state["probe_at"] + self.reset_timeout - now)
+            state["probe_at"] = now
+
+    def record_success(self, url):
+        if not self.failure_threshold:
+            return
+        host = self.get_host(url)
+        with self.lock:
+            state = self.hosts.pop(host, None)
+        if state is not None and state["failures"] >= self.failure_threshold:
+            self.logger.info(f"CircuitBreaker: remote host {host} is back")
+
+    def record_failure(self, url, retry_after=None):
+        """Count a failed request (connection error, timeout, 429 or 5xx answer) to the host of `url`"""
+        if not self.failure_threshold:
+            return
+        host = self.get_host(url)
+        now = time.monotonic()
+        with self.lock:
+            state = self.hosts.setdefault(host, {"failures": 0, "open_until": 0, "probe_at": None})
+            state["failures"] += 1
+            state["probe_at"] = None
+
+            # requests sent before the circuit opened don't keep it open longer
+            open_until = state["open_until"]
+            if state["failures"] >= self.failure_threshold and now >= state["open_until"]:
+                open_until = now + self.reset_timeout
+            if retry_after is not None:
+                open_until = max(open_until, now + min(retry_after, self.retry_after_max))
+            opened = open_until > max(now, state["open_until"])
+            state["open_until"] = open_until
+
+        if opened:
+            self.logger.warning(
+                f"CircuitBreaker: remote host {host} is failing, not asking it for {open_until - now:.0f} seconds"
+            )
+
+    def record_response(self, url, status_code, retry_after=None):
+        """Count the answer: 429 and 5xx are failures, anything else is a success"""
+        if RetryPolicy.is_retryable(status_code):
+            self.record_failure(url, retry_after)
+        else:
+            self.record_success(url)
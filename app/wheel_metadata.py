@@ -0,0 +1,194 @@
+import io
+import os
+import zipfile
+from urllib.parse import urlparse
+
+from packaging.utils import InvalidWheelFilename, parse_wheel_filename
+
+from app.offline_mode import OfflineModeError
+from app.upstream_retry import CircuitOpenError
+
+# PEP 658: metadata of <file> is served at <file>.metadata
+METADATA_SUFFIX = ".metadata"
+
+
+def read_wheel_metadata(file):
+    """Return the .dist-info/METADATA of a wheel
+
+    Only the zip central directory and the METADATA member are read, not the whole file.
+
+    Args:
+        file (BinaryIO): Seekable wheel file
+
+    Raises:
+        ValueError: if the file is not a wheel with exactly one .dist-info/METADATA
+    """
+    try:
+        with zipfile.ZipFile(file) as wheel:
+            names = [
+                name for name in wheel.namelist()
+                if name.count("/") == 1 and name.endswith(".dist-info/METADATA")
+            ]
+            if len(names) != 1:
+                raise ValueError(f"wheel has {len(names)} .dist-info/METADATA files")
+            return wheel.read(names[0])
+    except zipfile.BadZipFile as e:
+        raise ValueError(f"not a wheel: {e}")
+
+
+class HttpRangeFile(io.RawIOBase):
+    """Read-only seekable file on the remote server, read with HTTP range requests.
+
+    The first request gets the tail of the file, where the zip central directory is;
+    later reads fetch at least READ_AHEAD bytes at a time.
+    """
+
+    TAIL_SIZE = 64 * 1024
+    READ_AHEAD = 64 * 1024
+
+    def __init__(self, download_manager, remote_url):
+        """Initialize HttpRangeFile class
+
+        Raises:
+            IOError: if the remote server doesn't answer range requests
+        """
+        self.download_manager = download_manager
+        self.remote_url = remote_url
+        self.position = 0
+
+        with download_manager.fetch_range(remote_url, -self.TAIL_SIZE) as response:
+            if response.status_code != 206 or "content-range" not in response.headers:
+                raise IOError(f"{remote_url}: remote server doesn't support range requests")
+            self.size = int(response.headers["content-range"].rsplit("/", 1)[1])
+            self.block = response.content
+        self.block_start = self.size - len(self.block)
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self.position = offset
+        elif whence == io.SEEK_CUR:
+            self.position += offset
+        elif whence == io.SEEK_END:
+            self.position = self.size + offset
+        else:
+            raise ValueError(f"invalid whence {whence}")
+        return self.position
+
+    def readinto(self, buffer):
+        size = min(len(buffer), self.size - self.position)
+        if size <= 0:
+            return 0
+
+        block_end = self.block_start + len(self.block)
+        if not (self.block_start <= self.position and self.position + size <= block_end):
+            stop = min(self.size, self.position + max(size, self.READ_AHEAD))
+            with self.download_manager.fetch_range(self.remote_url, self.position, stop) as response:
+                if response.status_code != 206:
+                    raise IOError(f"{self.remote_url}: remote server answered {response.status_code} to a range request")
+                self.block = response.content
+            self.block_start = self.position
+
+        offset = self.position - self.block_start
+        data = self.block[offset:offset + size]
+        buffer[:len(data)] = data
+        self.position += len(data)
+        return len(data)
+
+
+class WheelMetadata:
+    """Serves METADATA of wheels (PEP 658) so that resolvers don't download whole wheels.
+
+    The metadata is cached like any other file, under the <wheel URL>.metadata URL. It is taken from
+    the cached wheel, or from the remote index if it advertises the metadata, or read from the
+    remote wheel with range requests (central directory and the METADATA member only), or, if the
+    remote server doesn't answer range requests, from the whole wheel downloaded into the cache.
+    """
+
+    def __init__(self, logger, db, cached_files, download_manager):
+        """Initialize WheelMetadata class
+
+        Args:
+            logger (logging.Logger): Logger instance
+            db (DBSQLite): Database with link attributes of projects
+            cached_files (CachedFiles): Cache directory manager
+            download_manager (DownloadManager): Downloads files and ranges from the remote server
+        """
+        self.logger = logger
+        self.db = db
+        self.cached_files = cached_files
+        self.download_manager = download_manager
+
+    @staticmethod
+    def is_metadata_url(remote_url):
+        return urlparse(remote_url).path.endswith(".whl" + METADATA_SUFFIX)
+
+    @staticmethod
+    def is_wheel_url(url):
+        """Whether the metadata of the file at `url` can be served at <url>.metadata: the URL must name a wheel"""
+        return urlparse(url).path.endswith(".whl")
+
+    def get_remote_core_metadata(self, wheel_url):
+        """data-core-metadata the remote index advertised for the wheel ("true" or "sha256=..."), or None"""
+        file_name = os.path.basename(urlparse(wheel_url).path)
+        try:
+            project_name = parse_wheel_filename(file_name)[0]
+        except InvalidWheelFilename:
+            return None
+        return self.db.get_simple_link_attrs(project_name).get(file_name, {}).get("core_metadata")
+
+    def get_metadata_file(self, metadata_url):
+        """Return path of the cached METADATA for the <wheel URL>.metadata URL, getting it first if needed
+
+        Raises:
+            IOError, ValueError: if the metadata can't be got
+        """
+        cached_file_path = self.cached_files.find_cached_file(metadata_url)
+        if cached_file_path is not None:
+            return cached_file_path
+
+        wheel_url = metadata_url[:-len(METADATA_SUFFIX)]
+        wheel_path = self.cached_files.find_cached_file(wheel_url)
+        if wheel_path is not None:
+            return self.extract_metadata(wheel_path, metadata_url)
+
+        core_metadata = self.get_remote_core_metadata(wheel_url)
+        if core_metadata is not None and core_metadata != "false":
+            self.logger.debug(f"WheelMetadata: downloading {metadata_url}")
+            # the advertised hash, if any, is checked by the download
+            fragment = f"#{core_metadata}" if core_metadata.startswith("sha256=") else ""
+            download = self.download_manager.get_or_start(metadata_url + fragment)
+            if download is None:
+                return self.cached_files.find_cached_file(metadata_url)
+            if download.wait_until_done():
+                return download.cached_file_path
+            self.logger.warning(f"WheelMetadata: failed to download {metadata_url}: {download.error}")
+
+        self.logger.debug(f"WheelMetadata: reading METADATA of {wheel_url} with range requests")
+        try:
+            with HttpRangeFile(self.download_manager, wheel_url) as f:
+                return self.cached_files.store_bytes(read_wheel_metadata(f), metadata_url)
+        except (OfflineModeError, CircuitOpenError):
+            raise
+        except IOError as e:
+            self.logger.debug(f"WheelMetadata: {e}, downloading the whole wheel")
+
+        download = self.download_manager.get_or_start(wheel_url)
+        if download is not None and not download.wait_until_done():
+            raise IOError(f"failed to download {wheel_url}: {download.error}")
+        wheel_path = download.cached_file_path if download is not None else self.cached_files.find_cached_file(wheel_url)
+        return self.extract_metadata(wheel_path, metadata_url)
+
+    def extract_metadata(self, wheel_path, metadata_url):
+        """Store METADATA of the cached wheel under `metadata_url` and return its path"""
+        self.logger.debug(f"WheelMetadata: extracting METADATA from cached {wheel_path}")
+        with open(wheel_path, "rb") as f:
+            return self.cached_files.store_bytes(read_wheel_metadata(f), metadata_url)
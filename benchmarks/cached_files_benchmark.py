@@ -0,0 +1,107 @@
+"""Microbenchmarks of URL proxification and path mapping in CachedFiles on a 5,000-link project page.
+
+    python benchmarks/cached_files_benchmark.py [--links N] [--repeat N]
+
+"before" is the implementation without memoization (urlparse + base64 + urljoin per link,
+two os.path.exists and os.path.getsize per file).
+"""
+import argparse
+import hashlib
+import logging
+import os
+import sys
+import tempfile
+import time
+from urllib.parse import urljoin, urlparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from app.cached_files import CachedFiles
+
+
+def proxify_url_before(cached_files, remote_url):
+    parsed_url = urlparse(remote_url)
+    base64_host = cached_files.encode_data_to_base64url(f"{parsed_url.scheme}://{parsed_url.netloc}")
+    proxified_url = urljoin(
+        cached_files.proxy_server_base_url, f"{cached_files.download_endpoint_name}/{base64_host}/{parsed_url.path}"
+    )
+    if parsed_url.fragment:
+        proxified_url += f"#{parsed_url.fragment}"
+    return proxified_url
+
+
+def convert_url_to_file_path_before(cached_files, url):
+    url_path = urlparse(url).path.lstrip("/").lstrip("\\")
+    return os.path.normpath(os.path.join(cached_files.cache_dir, url_path))
+
+
+def get_files_info_before(file_paths):
+    return [
+        (
+            file_path,
+            os.path.basename(file_path),
+            os.path.exists(file_path),
+            os.path.getsize(file_path) if os.path.exists(file_path) else 0,
+        )
+        for file_path in file_paths
+    ]
+
+
+def measure(name, func, repeat):
+    func()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    elapsed = (time.perf_counter() - start) / repeat
+    print(f"  {name:<40} {elapsed * 1000:8.2f} ms")
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--links", type=int, default=5000)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    cache_dir = tempfile.mkdtemp()
+    cached_files = CachedFiles(logging.getLogger(), cache_dir, "http://localhost:2222/", "download_file")
+
+    links = {}
+    for i in range(args.links):
+        file_name = f"example_project-{i // 20}.{i % 20}.0-cp311-cp311-manylinux_2_17_x86_64.whl"
+        sha256 = hashlib.sha256(file_name.encode()).hexdigest()
+        links[file_name] = (
+            f"https://files.pythonhosted.org/packages/{sha256[:2]}/{sha256[2:4]}/{sha256[4:]}/{file_name}#sha256={sha256}"
+        )
+    urls = list(links.values())
+    assert [proxify_url_before(cached_files, url) for url in urls] == list(cached_files.proxify_urls(links).values())
+
+    # half of the files exist
+    file_paths = [cached_files.convert_url_to_file_path(url) for url in urls]
+    for file_path in file_paths[::2]:
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        with open(file_path, "wb") as f:
+            f.write(b"x")
+
+    print(f"proxify {len(urls)} links")
+    before = measure("before: proxify_url per link", lambda: [proxify_url_before(cached_files, url) for url in urls], args.repeat)
+    single = measure("proxify_url per link", lambda: [cached_files.proxify_url(url) for url in urls], args.repeat)
+    batch = measure("proxify_urls (batch)", lambda: cached_files.proxify_urls(links), args.repeat)
+    print(f"  speedup: {before / single:.1f}x per link, {before / batch:.1f}x batch")
+
+    print(f"map {len(urls)} URLs to cache paths")
+    before = measure(
+        "before: convert_url_to_file_path",
+        lambda: [convert_url_to_file_path_before(cached_files, url) for url in urls],
+        args.repeat,
+    )
+    after = measure("convert_url_to_file_path (memoized)", lambda: cached_files.convert_urls_to_file_paths(urls), args.repeat)
+    print(f"  speedup: {before / after:.1f}x")
+
+    print(f"get_files_info of {len(file_paths)} files, half of them cached")
+    before = measure("before: exists + exists + getsize", lambda: get_files_info_before(file_paths), args.repeat)
+    after = measure("get_files_info (one stat)", lambda: cached_files.get_files_info(file_paths), args.repeat)
+    print(f"  speedup: {before / after:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+"""Compare the simple page parser with the BeautifulSoup one it replaced.
+
+    python benchmarks/simple_page_parser_benchmark.py [--files N] [--url URL ...] [--repeat N]
+
+Without --url a synthetic page shaped like pypi.org project pages (N files with
+sha256 fragments, data-requires-python and some data-yanked / data-dist-info-metadata)
+is parsed. With --url real pages are downloaded once and parsed, e.g.
+https://pypi.org/simple/boto3/ or https://pypi.org/simple/numpy/.
+Needs beautifulsoup4 for the comparison (pip install beautifulsoup4).
+"""
+import argparse
+import hashlib
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from app.simple_page_parser import parse_simple_page
+
+
+def synthetic_page(files):
+    anchors = []
+    for i in range(files):
+        version = f"{i // 20}.{i % 20}.0"
+        file_name = f"example_project-{version}-cp311-cp311-manylinux_2_17_x86_64.manylinux2014_x86_64.whl"
+        sha256 = hashlib.sha256(file_name.encode()).hexdigest()
+        attributes = 'data-requires-python="&gt;=3.8"'
+        if i % 50 == 0:
+            attributes += ' data-yanked="broken build"'
+        if i % 3 == 0:
+            attributes += f' data-dist-info-metadata="sha256={sha256}" data-core-metadata="sha256={sha256}"'
+        anchors.append(
+            f'    <a href="https://files.pythonhosted.org/packages/{sha256[:2]}/{sha256[2:4]}/{sha256[4:]}/'
+            f'{file_name}#sha256={sha256}" {attributes}>{file_name}</a><br />'
+        )
+    return (
+        "<!DOCTYPE html>\n<html>\n  <head>\n    <meta name=\"pypi:repository-version\" content=\"1.1\">\n"
+        "    <title>Links for example-project</title>\n  </head>\n  <body>\n"
+        "    <h1>Links for example-project</h1>\n" + "\n".join(anchors) + "\n  </body>\n</html>\n"
+    )
+
+
+def parse_with_beautifulsoup(page, base_url=None):
+    from bs4 import BeautifulSoup
+
+    soup = BeautifulSoup(page, "html.parser")
+    links = {}
+    for link in soup.find_all("a"):
+        links[link.string] = link.get("href")
+    return links
+
+
+def measure(name, parse, page, repeat):
+    tracemalloc.start()
+    parse(page)
+    peak_memory = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    start = time.perf_counter()
+    for _ in range(repeat):
+        parse(page)
+    elapsed = (time.perf_counter() - start) / repeat
+
+    print(f"  {name:<16} {elapsed * 1000:9.2f} ms  {peak_memory / 1024 / 1024:8.2f} MiB peak")
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--files", type=int, default=5000, help="files on the synthetic page")
+    parser.add_argument("--url", action="append", default=[], help="real simple page to parse")
+    parser.add_argument("--repeat", type=int, default=10)
+    args = parser.parse_args()
+
+    pages = []
+    if args.url:
+        import requests
+
+        for url in args.url:
+            response = requests.get(url, headers={"Accept": "text/html"}, timeout=60)
+            response.raise_for_status()
+            pages.append((url, response.text))
+    else:
+        pages.append((f"synthetic page, {args.files} files", synthetic_page(args.files)))
+
+    for name, page in pages:
+        links, link_attrs = parse_simple_page(page)
+        print(f"{name}: {len(page) / 1024:.0f} KiB, {len(links)} links, {len(link_attrs)} with data-* attributes")
+        new = measure("simple_page_parser", parse_simple_page, page, args.repeat)
+        try:
+            old = measure("BeautifulSoup", parse_with_beautifulsoup, page, args.repeat)
+        except ImportError:
+            print("  BeautifulSoup is not installed, nothing to compare with")
+            continue
+        print(f"  {old / new:.1f}x faster")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,179 @@
+import hashlib
+import http.server
+import importlib.util
+import json
+import os
+import sys
+import threading
+import time
+
+import pytest
+import toml
+
+APP_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "app", "pypi-offgrid.py")
+PROXY_BASE_URL = "http://127.0.0.1:2222/"
+
+
+class UpstreamHandler(http.server.BaseHTTPRequestHandler):
+    """Index with the simple pages, the JSON API and the files of `server.projects`"""
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def send_body(self, status, body, headers=None):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    def do_HEAD(self):
+        self.do_GET()
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.requests.append(self.path)
+        if server.fail_status:
+            return self.send_body(server.fail_status, b"")
+
+        parts = self.path.strip("/").split("/")
+        if parts[0] == "simple" and len(parts) == 2 and parts[1] in server.projects:
+            return self.send_simple_page(parts[1])
+        if parts[0] == "pypi" and len(parts) == 3 and parts[1] in server.projects and server.json_api:
+            return self.send_json(parts[1])
+        if parts[0] == "files" and len(parts) == 2:
+            for files in server.projects.values():
+                if parts[1] in files:
+                    return self.send_file(files[parts[1]])
+        self.send_body(404, b"")
+
+    def send_simple_page(self, project_name):
+        server = self.server
+        links = "".join(
+            f'<a href="{server.url}/files/{name}#sha256={hashlib.sha256(content).hexdigest()}">{name}</a>'
+            for name, content in server.projects[project_name].items()
+        )
+        etag = f'"simple-{server.serial}"'
+        headers = {"ETag": etag, "X-PyPI-Last-Serial": str(server.serial)}
+        if self.headers.get("If-None-Match") == etag:
+            return self.send_body(304, b"", headers)
+        self.send_body(200, f"<html><body>{links}</body></html>".encode(), dict(headers, **{"Content-Type": "text/html"}))
+
+    def send_json(self, project_name):
+        server = self.server
+        releases = {}
+        for name, content in server.projects[project_name].items():
+            releases.setdefault(name.split("-")[1], []).append({
+                "filename": name,
+                "url": f"{server.url}/files/{name}",
+                "size": len(content),
+                "digests": {"sha256": hashlib.sha256(content).hexdigest()},
+                "requires_python": None,
+                "yanked": False,
+                "yanked_reason": None,
+                "upload_time_iso_8601": "2020-01-01T00:00:00Z",
+                "packagetype": "bdist_wheel" if name.endswith(".whl") else "sdist",
+                "python_version": "py3",
+            })
+        data = {
+            "info": {"name": project_name, "version": max(releases), "summary": f"{project_name} summary"},
+            "releases": releases,
+            "urls": [],
+            "last_serial": server.serial,
+        }
+        etag = f'"json-{server.serial}"'
+        headers = {"ETag": etag, "X-PyPI-Last-Serial": str(server.serial)}
+        if self.headers.get("If-None-Match") == etag:
+            return self.send_body(304, b"", headers)
+        self.send_body(200, json.dumps(data).encode(), dict(headers, **{"Content-Type": "application/json"}))
+
+    def send_file(self, content):
+        start, stop, status = 0, len(content), 200
+        headers = {"Content-Type": "application/octet-stream", "Accept-Ranges": "bytes"}
+        byte_range = self.headers.get("Range")
+        if byte_range:
+            first, last = byte_range.split("=", 1)[1].split("-")
+            start, stop, status = int(first), (int(last) + 1 if last else len(content)), 206
+            headers["Content-Range"] = f"bytes {start}-{stop - 1}/{len(content)}"
+
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(stop - start))
+        self.end_headers()
+        if self.command == "HEAD":
+            return
+        for position in range(start, stop, 65536):
+            self.wfile.write(content[position:min(position + 65536, stop)])
+            self.wfile.flush()
+            time.sleep(self.server.chunk_delay)
+
+
+@pytest.fixture
+def upstream():
+    """Fake remote index: set `projects` ({project: {file name: content}}), `json_api`, `serial`,
+    `fail_status` (every answer) and `chunk_delay` (seconds between 64 KiB chunks of a file)"""
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), UpstreamHandler)
+    server.daemon_threads = True
+    server.url = f"http://127.0.0.1:{server.server_port}"
+    server.lock = threading.Lock()
+    server.requests = []
+    server.projects = {}
+    server.json_api = True
+    server.serial = 1
+    server.fail_status = None
+    server.chunk_delay = 0
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def make_proxy(tmp_path, upstream):
+    """Start the proxy in a new workdir: make_proxy(**config) returns the initialized app module"""
+    started = []
+
+    def make(**config):
+        workdir = tmp_path / f"workdir{len(started)}"
+        workdir.mkdir()
+        settings = {
+            "FLASK_LISTEN_IP": "127.0.0.1",
+            "FLASK_LISTEN_PORT": 2222,
+            "PROXY_SERVER_BASE_URL": PROXY_BASE_URL,
+            "REMOTE_INDEX_SIMPLE": f"{upstream.url}/simple/%s/",
+            "REMOTE_INDEX_JSON": f"{upstream.url}/pypi/%s/json",
+            "CONNECTION_TIMEOUT": 5,
+            "DOWNLOAD_TIMEOUT": 30,
+            "MAX_RETRIES": 1,
+            "ASYNC_FETCH": False,
+        }
+        settings.update(config)
+        with open(workdir / "pypi-offgrid.toml", "w") as f:
+            toml.dump(settings, f)
+
+        # a fresh module each time: the app and its globals belong to one workdir
+        spec = importlib.util.spec_from_file_location("pypi_offgrid", APP_PATH)
+        proxy = importlib.util.module_from_spec(spec)
+        sys.modules["pypi_offgrid"] = proxy
+        spec.loader.exec_module(proxy)
+        proxy.init_app(str(workdir))
+        started.append(proxy)
+        return proxy
+
+    yield make
+    for proxy in started:
+        proxy.shutdown_app()
+
+
+@pytest.fixture
+def download_path():
+    """download_path(proxy, remote_url): path of the proxy's download URL for the remote file"""
+    def path(proxy, remote_url):
+        return "/" + proxy.cached_files.proxify_url(remote_url)[len(PROXY_BASE_URL):]
+    return path
@@ -0,0 +1,59 @@
+import logging
+import threading
+
+import pytest
+
+from app.background_refresher import BackgroundRefresher
+
+logger = logging.getLogger(__name__)
+
+
+class BlockingRefresh:
+    """refresh_func whose calls wait for `release`; records the projects refreshed"""
+
+    def __init__(self):
+        self.started = threading.Event()
+        self.release = threading.Event()
+        self.refreshed = []
+
+    def __call__(self, project_name):
+        self.started.set()
+        assert self.release.wait(5)
+        self.refreshed.append(project_name)
+        return project_name
+
+    def batch(self, project_names):
+        for project_name in project_names:
+            self(project_name)
+
+
+@pytest.mark.parametrize("batch", [False, True])
+def test_shutdown_cancels_queued_refreshes(batch):
+    refresh = BlockingRefresh()
+    refresher = BackgroundRefresher(
+        logger, refresh, max_workers=1, batch_refresh_func=refresh.batch if batch else None
+    )
+    running = refresher.submit("six")
+    assert refresh.started.wait(5)
+    queued = refresher.submit("requests")
+
+    # somebody waits for the queued refresh
+    waiter_result = []
+    waiter = threading.Thread(target=lambda: waiter_result.append(refresher.refresh("requests")))
+    waiter.start()
+
+    refresher.shutdown()
+    waiter.join(5)
+    assert not waiter.is_alive()
+    assert waiter_result == [None]
+    assert queued.cancelled()
+
+    # submitting after shutdown neither raises nor queues anything
+    late = refresher.submit("flask")
+    assert late.cancelled()
+
+    # the running refresh is finished
+    refresh.release.set()
+    assert running.result(5) == ("six" if not batch else None)
+    assert refresh.refreshed == ["six"]
+    assert refresher.in_progress == {}
@@ -0,0 +1,68 @@
+import logging
+import os
+import time
+
+import pytest
+
+from app.cache_manager import CacheManager
+from app.cached_files import CachedFiles
+from app.db_sqlite import DBSQLite
+
+logger = logging.getLogger(__name__)
+
+
+@pytest.fixture
+def cache(tmp_path):
+    """(db, cached_files, {name: sha256}) with four 100-byte blobs a, b, c, d"""
+    db = DBSQLite(str(tmp_path / "remote_index.sqlite"))
+    cached_files = CachedFiles(logger, str(tmp_path / "cache"), "http://127.0.0.1:2222/", "download_file", db)
+    blobs = {
+        name: os.path.basename(cached_files.store_bytes(name.encode() * 100, f"https://files.example/{name}.whl"))
+        for name in "abcd"
+    }
+    yield db, cached_files, blobs
+    db.close()
+
+
+def cached_names(cached_files, blobs):
+    return "".join(name for name, sha256 in blobs.items() if os.path.exists(cached_files.get_blob_path(sha256)))
+
+
+@pytest.mark.parametrize("policy, hits, pinned, kept", [
+    # least recently used first: a, b (pinned), c, d
+    ("lru", {"a": (1, 1), "b": (1, 2), "c": (1, 3), "d": (1, 4)}, "b", "bd"),
+    # least frequently used first: d, c (pinned), b, a
+    ("lfu", {"a": (4, 1), "b": (3, 2), "c": (2, 3), "d": (1, 4)}, "c", "ac"),
+])
+def test_eviction_order_skips_pinned_files(cache, policy, hits, pinned, kept):
+    db, cached_files, blobs = cache
+    now = time.time()
+    db.record_blob_hits({blobs[name]: (count, now + offset) for name, (count, offset) in hits.items()})
+
+    cache_manager = CacheManager(logger, db, cached_files, max_size=250, policy=policy)
+    cache_manager.pin(blobs[pinned])
+    assert cache_manager.run_once() == 2
+
+    assert cached_names(cached_files, blobs) == kept
+    assert db.get_blobs_total_size() == 200
+    assert db.get_url_blob(f"https://files.example/{pinned}.whl") == blobs[pinned]
+
+
+def test_pinned_file_is_evicted_once_unpinned(cache):
+    db, cached_files, blobs = cache
+    with db._connection() as conn:
+        conn.execute("UPDATE blobs SET last_access = ? WHERE sha256 IN (?, ?)", (time.time() - 7200, blobs["a"], blobs["b"]))
+
+    cache_manager = CacheManager(logger, db, cached_files, max_age=3600)
+    # pinned twice (two requests serving it), released by both
+    cache_manager.pin(blobs["a"])
+    cache_manager.pin(blobs["a"])
+    assert cache_manager.run_once() == 1
+    assert cached_names(cached_files, blobs) == "acd"
+
+    cache_manager.unpin(blobs["a"])
+    assert cache_manager.run_once() == 0
+    cache_manager.unpin(blobs["a"])
+    assert cache_manager.run_once() == 1
+    assert cached_names(cached_files, blobs) == "cd"
+    assert db.get_url_blob("https://files.example/a.whl") is None
@@ -0,0 +1,169 @@
+import json
+import sqlite3
+import threading
+
+import pytest
+
+from app.db_sqlite import DBSQLite
+
+
+@pytest.fixture
+def db(tmp_path):
+    db = DBSQLite(str(tmp_path / "remote_index.sqlite"))
+    yield db
+    db.close()
+
+
+def test_connection_is_kept_per_thread_in_wal_mode(db):
+    conn = db._connection()
+    assert db._connection() is conn
+    assert conn.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+
+    other_thread_conn = []
+    thread = threading.Thread(target=lambda: other_thread_conn.append(db._connection()))
+    thread.start()
+    thread.join()
+    assert other_thread_conn[0] is not conn
+
+    db.close()
+    assert db._connection() is not conn
+
+
+def test_concurrent_readers_and_writers(db):
+    errors = []
+
+    def write(thread_number):
+        try:
+            for i in range(100):
+                db.set_prefs_value(f"key-{thread_number}-{i}", str(i))
+        except sqlite3.Error as e:
+            errors.append(e)
+
+    def read():
+        try:
+            for _ in range(200):
+                db.get_prefs_value("key-0-0", None)
+                db.get_simple_advanced("six")
+        except sqlite3.Error as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=write, args=(n,)) for n in range(4)]
+    threads += [threading.Thread(target=read) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    assert all(db.get_prefs_value(f"key-{n}-99", None) == "99" for n in range(4))
+
+
+def test_packages_table_is_migrated(tmp_path):
+    db_path = str(tmp_path / "remote_index.sqlite")
+    releases = {
+        "1.0": [{
+            "filename": "six-1.0-py3-none-any.whl",
+            "url": "https://files.example/six-1.0-py3-none-any.whl",
+            "size": 5,
+            "digests": {"sha256": "a" * 64},
+            "packagetype": "bdist_wheel",
+            "upload_time_iso_8601": "2020-01-01T00:00:00Z",
+        }],
+    }
+    # schema of the versions that kept the project JSON as blobs
+    with sqlite3.connect(db_path) as conn:
+        conn.execute("CREATE TABLE packages (name TEXT PRIMARY KEY, info TEXT, releases TEXT, urls TEXT, last_serial INTEGER, etag TEXT)")
+        conn.execute("CREATE TABLE simple_links (id INTEGER PRIMARY KEY AUTOINCREMENT, pkg_name TEXT UNIQUE, links TEXT)")
+        conn.execute(
+            "INSERT INTO packages VALUES (?, ?, ?, ?, ?, ?)",
+            ("six", json.dumps({"name": "six", "version": "1.0", "summary": "Python 2 and 3 compatibility"}),
+             json.dumps(releases), "[]", 42, '"json-42"'),
+        )
+        conn.execute("INSERT INTO simple_links (pkg_name, links) VALUES (?, ?)", ("six", "{}"))
+    conn.close()
+
+    db = DBSQLite(db_path)
+    try:
+        assert db.get_project_info("six")["version"] == "1.0"
+        assert db.get_project_summary("six") == "Python 2 and 3 compatibility"
+        assert db.get_package_validators("six") == {"etag": '"json-42"', "last_modified": None, "last_serial": 42}
+        files = db.get_project_files("six")
+        assert [(file["version"], file["filename"], file["sha256"]) for file in files] == [
+            ("1.0", "six-1.0-py3-none-any.whl", "a" * 64)
+        ]
+
+        conn = db._connection()
+        assert conn.execute("SELECT name FROM sqlite_master WHERE name = 'packages'").fetchone() is None
+        assert conn.execute("PRAGMA user_version").fetchone()[0] == DBSQLite.SCHEMA_VERSION
+    finally:
+        db.close()
+
+    # reopening a migrated database changes nothing
+    db = DBSQLite(db_path)
+    try:
+        assert db.get_project_summary("six") == "Python 2 and 3 compatibility"
+    finally:
+        db.close()
+
+
+PROJECTS = {
+    "requests": "Python HTTP for Humans.",
+    "requests-oauthlib": "OAuthlib authentication support for Requests.",
+    "six": "Python 2 and 3 compatibility utilities",
+    "pytest": "pytest: simple powerful testing with Python",
+    "py": "library with cross-python path, ini-parsing, io, code, log facilities",
+    "attrs": "Classes Without Boilerplate",
+    "urllib3": "HTTP library with thread-safe connection pooling",
+}
+
+
+@pytest.fixture
+def projects_db(db):
+    for name, summary in PROJECTS.items():
+        db.save_simple_links(name, {})
+        db.save_package_json(name, {"info": {"name": name, "summary": summary}, "releases": {}, "last_serial": 1})
+    return db
+
+
+def test_search_looks_up_names_and_summaries(projects_db):
+    if not projects_db.fts_enabled:
+        pytest.skip("SQLite without FTS5 trigram tokenizer")
+
+    assert projects_db.get_simple_advanced("compat") == ["six"]
+    assert projects_db.get_simple_advanced("REQU") == ["requests", "requests-oauthlib"]
+    assert projects_db.get_simple_advanced("http") == ["requests", "urllib3"]
+    assert projects_db.get_project_summaries("oauth") == [("requests-oauthlib", PROJECTS["requests-oauthlib"])]
+    # quotes are part of the substring, not FTS syntax
+    assert projects_db.get_simple_advanced('six" OR "py') == []
+
+
+def test_short_masks_and_no_fts_use_like_on_names(projects_db):
+    assert projects_db.get_simple_advanced("py") == ["py", "pytest"]
+    assert projects_db.get_simple_advanced("*") == sorted(PROJECTS)
+
+    projects_db.fts_enabled = False
+    assert projects_db.get_simple_advanced("requ") == ["requests", "requests-oauthlib"]
+    assert projects_db.get_simple_advanced("compat") == []
+    assert projects_db.get_project_summaries("six") == [("six", PROJECTS["six"])]
+
+
+@pytest.mark.parametrize("fts_enabled", [True, False])
+@pytest.mark.parametrize("pkg_mask", [None, "py", "req", "s"])
+def test_after_pages_match_numbered_pages(projects_db, fts_enabled, pkg_mask):
+    projects_db.fts_enabled = projects_db.fts_enabled and fts_enabled
+    all_names = projects_db.get_simple_advanced(pkg_mask)
+    assert all_names
+
+    page_number, after = 1, None
+    pages = []
+    while True:
+        # as the /projects/ view: the first page has no `after`, the next ones do
+        page = projects_db.get_simple_advanced(pkg_mask, page_size=2, page_number=page_number, after=after)
+        assert page == projects_db.get_simple_advanced(pkg_mask, page_size=2, page_number=page_number)
+        if not page:
+            break
+        pages.append(page)
+        page_number, after = page_number + 1, page[-1]
+
+    assert [name for page in pages for name in page] == all_names
+    assert all(len(page) == 2 for page in pages[:-1])
@@ -0,0 +1,99 @@
+import hashlib
+import http.server
+import logging
+import os
+import threading
+import time
+
+import pytest
+
+from app.cached_files import CachedFiles
+from app.db_sqlite import DBSQLite
+from app.download_manager import DownloadManager
+
+logger = logging.getLogger(__name__)
+
+DAY = 24 * 3600
+
+CONTENT = b"wheel contents" * 1000
+
+
+class FileServer(http.server.BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(CONTENT)))
+        self.end_headers()
+        self.wfile.write(CONTENT)
+
+
+@pytest.fixture
+def upstream():
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), FileServer)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_port}"
+    server.shutdown()
+    server.server_close()
+
+
+def make_download_manager(tmp_path):
+    db = DBSQLite(str(tmp_path / "remote_index.sqlite"))
+    cached_files = CachedFiles(logger, str(tmp_path / "cache"), "http://127.0.0.1:2222/", "download_file", db)
+    return db, cached_files, DownloadManager(logger, cached_files, db=db)
+
+
+def make_file(path, age):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(b"partial")
+    mtime = time.time() - age
+    os.utime(path, (mtime, mtime))
+    return path
+
+
+def test_collect_garbage_deletes_legacy_temp_files(tmp_path):
+    db, cached_files, download_manager = make_download_manager(tmp_path)
+    legacy_dir = os.path.join(cached_files.cache_dir, "files.pythonhosted.org", "packages", "ab", "cd")
+
+    old_legacy = make_file(os.path.join(legacy_dir, "torch-2.3.0-cp311-none-linux_x86_64.whl.1700000000.tmp"), 8 * DAY)
+    old_unique = make_file(os.path.join(legacy_dir, "six-1.16.0.tar.gz.1700000000.0123456789ab.tmp"), 8 * DAY)
+    fresh_legacy = make_file(os.path.join(legacy_dir, "six-1.16.0-py3-none-any.whl.1790000000.tmp"), 60)
+    cached_file = make_file(os.path.join(legacy_dir, "six-1.16.0-py3-none-any.whl"), 8 * DAY)
+
+    download_manager.collect_garbage(7 * DAY)
+
+    assert not os.path.exists(old_legacy)
+    assert not os.path.exists(old_unique)
+    assert os.path.exists(fresh_legacy)
+    assert os.path.exists(cached_file)
+
+
+@pytest.mark.parametrize("published_sha256, stored", [(hashlib.sha256(CONTENT).hexdigest(), True), ("0" * 64, False)])
+def test_download_is_checked_against_simple_page_hash(tmp_path, upstream, published_sha256, stored):
+    # no JSON of the project (simple-only index): the digest comes from the link on the simple page
+    db, cached_files, download_manager = make_download_manager(tmp_path)
+    remote_url = f"{upstream}/files/six-1.0-py3-none-any.whl"
+    db.save_simple_links("six", {"six-1.0-py3-none-any.whl": f"{remote_url}#sha256={published_sha256}"})
+    assert cached_files.get_expected_sha256(remote_url) == published_sha256
+
+    download = download_manager.get_or_start(remote_url)
+
+    assert download.wait_until_done() is stored
+    assert (cached_files.find_cached_file(remote_url) is not None) is stored
+    if not stored:
+        assert "sha256 mismatch" in str(download.error)
+        assert os.listdir(cached_files.temp_dir) == []
+
+
+def test_link_digests_are_filled_for_older_databases(tmp_path):
+    db_path = str(tmp_path / "remote_index.sqlite")
+    db = DBSQLite(db_path)
+    db.save_simple_links("six", {"six-1.0.tar.gz": "http://127.0.0.1:8765/files/six-1.0.tar.gz#sha256=ABCD"})
+    with db._connection() as conn:
+        conn.execute("DELETE FROM link_digests")
+        conn.execute("PRAGMA user_version = 1")
+    db.close()
+
+    assert DBSQLite(db_path).get_expected_sha256("http://127.0.0.1:8765/files/six-1.0.tar.gz") == "abcd"
@@ -0,0 +1,67 @@
+import threading
+
+from app.upstream_retry import CircuitOpenError
+
+CONTENT = bytes(range(256)) * 2048  # 512 KiB
+
+
+def test_range_of_inflight_download_is_served_when_range_request_fails(make_proxy, upstream, download_path):
+    upstream.projects = {"six": {"six-1.0-py3-none-any.whl": CONTENT}}
+    upstream.chunk_delay = 0.02
+    proxy = make_proxy()
+    # every range ahead of the download is asked from the remote server, whose circuit is open
+    proxy.RANGE_PASSTHROUGH_DISTANCE = 0
+
+    def fetch_range(remote_url, start, stop=None):
+        raise CircuitOpenError("127.0.0.1", 30)
+
+    proxy.download_manager.fetch_range = fetch_range
+    client = proxy.app.test_client()
+    path = download_path(proxy, f"{upstream.url}/files/six-1.0-py3-none-any.whl")
+
+    # the first client starts the download, the second one asks for its tail meanwhile
+    full = threading.Thread(target=client.get, args=(path,))
+    full.start()
+    download = None
+    while download is None:
+        download = proxy.download_manager.downloads.get(f"{upstream.url}/files/six-1.0-py3-none-any.whl")
+    assert download.wait_for_headers()
+
+    response = client.get(path, headers={"Range": "bytes=500000-500099"})
+    full.join(10)
+
+    assert response.status_code == 206
+    assert response.headers["Content-Range"] == f"bytes 500000-500099/{len(CONTENT)}"
+    assert response.data == CONTENT[500000:500100]
+
+
+def test_concurrent_requests_share_one_upstream_download(make_proxy, upstream, download_path):
+    upstream.projects = {"six": {"six-1.0-py3-none-any.whl": CONTENT}}
+    upstream.chunk_delay = 0.01
+    proxy = make_proxy()
+    path = download_path(proxy, f"{upstream.url}/files/six-1.0-py3-none-any.whl")
+    barrier = threading.Barrier(10)
+    bodies = []
+
+    def get():
+        client = proxy.app.test_client()
+        barrier.wait()
+        response = client.get(path)
+        bodies.append((response.status_code, response.data))
+
+    clients = [threading.Thread(target=get) for _ in range(10)]
+    for client in clients:
+        client.start()
+    for client in clients:
+        client.join(30)
+
+    assert bodies == [(200, CONTENT)] * 10
+    assert upstream.requests.count("/files/six-1.0-py3-none-any.whl") == 1
+    assert proxy.cached_files.find_cached_file(f"{upstream.url}/files/six-1.0-py3-none-any.whl") is not None
+    assert proxy.download_manager.downloads == {}
+
+
+def test_temporary_file_names_are_unique(make_proxy):
+    proxy = make_proxy()
+    file_path = proxy.cached_files.temp_dir + "/six-1.0-py3-none-any.whl"
+    assert len({proxy.cached_files.get_temporary_file_name(file_path) for _ in range(100)}) == 100
@@ -0,0 +1,28 @@
+import logging
+
+from app.db_sqlite import DBSQLite
+from app.offline_mode import OfflineMode
+
+logger = logging.getLogger(__name__)
+
+
+def test_offline_mode_switches_off_and_survives_restart(tmp_path):
+    db_path = str(tmp_path / "remote_index.sqlite")
+    offline_mode = OfflineMode(logger, DBSQLite(db_path), check_interval=0)
+    assert not offline_mode.is_on
+
+    offline_mode.set(True)
+    assert offline_mode.is_on
+    assert OfflineMode(logger, DBSQLite(db_path)).is_on
+
+    offline_mode.set(False)
+    # check_interval=0: is_on rereads the setting from DB
+    assert not offline_mode.is_on
+    assert not OfflineMode(logger, DBSQLite(db_path)).is_on
+
+
+def test_offline_mode_reads_legacy_values(tmp_path):
+    db = DBSQLite(str(tmp_path / "remote_index.sqlite"))
+    for value, enabled in ((True, True), (False, False), ("1", True), ("0", False), ("on", True)):
+        db.set_prefs_value(OfflineMode.PREFS_KEY, value)
+        assert OfflineMode(logger, db).is_on is enabled
@@ -0,0 +1,77 @@
+import logging
+import threading
+
+from app.db_sqlite import DBSQLite
+from app.project_mirror import ProjectMirror
+
+logger = logging.getLogger(__name__)
+
+URLS = [f"http://127.0.0.1:8765/files/six-1.{i}-py3-none-any.whl" for i in range(5)]
+
+
+class FakeDownload:
+    bytes_written = 100
+
+    def __init__(self, release):
+        self.release = release
+
+    def wait_until_done(self):
+        self.release.wait(5)
+        return True
+
+
+class BlockingDownloadManager:
+    """Downloads finish when `release` is set; `started` is set when the first one begins"""
+
+    def __init__(self):
+        self.started = threading.Event()
+        self.release = threading.Event()
+
+    def get_or_start(self, remote_url):
+        self.started.set()
+        return FakeDownload(self.release)
+
+
+def start_job(tmp_path):
+    db = DBSQLite(str(tmp_path / "remote_index.sqlite"))
+    download_manager = BlockingDownloadManager()
+    project_mirror = ProjectMirror(logger, db, None, download_manager, None, max_workers=1)
+    db.create_job("job1", "mirror", "six", {}, len(URLS))
+    with project_mirror.lock:
+        project_mirror.running_jobs.add("job1")
+    thread = threading.Thread(target=project_mirror.run_job, args=("job1", URLS))
+    thread.start()
+    assert download_manager.started.wait(5)
+    return db, project_mirror, download_manager, thread
+
+
+def test_cancelled_job_is_terminal_with_consistent_counts(tmp_path):
+    db, project_mirror, download_manager, thread = start_job(tmp_path)
+
+    assert project_mirror.cancel("job1")
+    assert db.get_job("job1")["state"] == "cancelling"
+    download_manager.release.set()
+    thread.join(5)
+
+    job = db.get_job("job1")
+    assert job["state"] == "cancelled"
+    assert job["done_files"] == job["total_files"] == len(URLS)
+    assert job["downloaded_files"] == 1
+    assert job["skipped_files"] == len(URLS) - 1
+    assert not project_mirror.cancel("job1")
+
+
+def test_shutdown_cancels_running_jobs(tmp_path):
+    db, project_mirror, download_manager, thread = start_job(tmp_path)
+
+    project_mirror.shutdown()
+    job = db.get_job("job1")
+    assert job["state"] == "cancelled"
+    assert job["done_files"] == job["total_files"]
+
+    # the job thread finishing afterwards doesn't turn it into "finished"
+    download_manager.release.set()
+    thread.join(5)
+    job = db.get_job("job1")
+    assert job["state"] == "cancelled"
+    assert job["done_files"] == job["total_files"]
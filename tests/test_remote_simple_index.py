@@ -0,0 +1,62 @@
+import logging
+
+import pytest
+
+from app.remote_simple_index import RemoteSimpleIndex
+
+logger = logging.getLogger(__name__)
+
+
+@pytest.fixture(params=["sync", "async"])
+def remote_index(request, upstream):
+    upstream.projects = {"six": {"six-1.0-py3-none-any.whl": b"wheel"}}
+    simple_url, json_url = f"{upstream.url}/simple/%s/", f"{upstream.url}/pypi/%s/json"
+    if request.param == "sync":
+        yield RemoteSimpleIndex(logger, simple_url, json_url)
+        return
+
+    pytest.importorskip("aiohttp")
+    from app.async_remote_index import AsyncRemoteSimpleIndex
+
+    remote_index = AsyncRemoteSimpleIndex(logger, simple_url, json_url)
+    yield remote_index
+    remote_index.close()
+
+
+def json_requests(upstream):
+    return len([path for path in upstream.requests if path.startswith("/pypi/")])
+
+
+def test_failed_json_keeps_links(remote_index, upstream):
+    # index without the JSON API: /pypi/<project>/json answers 404
+    upstream.json_api = False
+    saved_package_validators = {"etag": '"json"', "last_modified": None, "last_serial": 0}
+    result = remote_index.fetch_project("six", None, saved_package_validators)
+
+    assert list(result["links"]) == ["six-1.0-py3-none-any.whl"]
+    assert result["simple_validators"]["etag"] == '"simple-1"'
+    assert result["project_info"] is None
+    assert result["package_validators"] == saved_package_validators
+
+    results = remote_index.fetch_projects({"six": (None, None)})
+    assert not isinstance(results["six"], Exception)
+    assert list(results["six"]["links"]) == ["six-1.0-py3-none-any.whl"]
+
+
+def test_json_is_fetched_only_when_serial_changes(remote_index, upstream):
+    result = remote_index.fetch_project("six")
+    assert result["project_info"]["info"]["name"] == "six"
+    assert json_requests(upstream) == 1
+
+    # refreshes while the serial stays the same don't ask for the JSON
+    for _ in range(3):
+        result = remote_index.fetch_project("six", result["simple_validators"], result["package_validators"])
+        assert result["links"] is None
+        assert result["project_info"] is None
+        assert result["package_validators"]["last_serial"] == 1
+    assert json_requests(upstream) == 1
+
+    upstream.serial = 2
+    result = remote_index.fetch_project("six", result["simple_validators"], result["package_validators"])
+    assert result["project_info"]["last_serial"] == 2
+    assert json_requests(upstream) == 2
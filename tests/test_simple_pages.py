@@ -0,0 +1,88 @@
+import gzip
+
+import pytest
+
+SIMPLE_JSON = "application/vnd.pypi.simple.v1+json"
+SIMPLE_HTML = "application/vnd.pypi.simple.v1+html"
+PIP_ACCEPT = f"{SIMPLE_JSON}, {SIMPLE_HTML}; q=0.1, text/html; q=0.01"
+
+
+@pytest.fixture
+def proxy(make_proxy, upstream):
+    upstream.projects = {"six": {"six-1.0-py3-none-any.whl": b"wheel", "six-1.0.tar.gz": b"sdist"}}
+    return make_proxy()
+
+
+@pytest.mark.parametrize("accept, content_type", [
+    (None, "text/html"),
+    ("*/*", "text/html"),
+    ("text/html", "text/html"),
+    ("text/*", "text/html"),
+    (SIMPLE_HTML, SIMPLE_HTML),
+    (SIMPLE_JSON, SIMPLE_JSON),
+    (PIP_ACCEPT, SIMPLE_JSON),
+    (f"{SIMPLE_JSON}, */*; q=0.1", SIMPLE_JSON),
+])
+def test_json_is_served_only_when_asked_for(proxy, accept, content_type):
+    headers = {"Accept": accept} if accept else {}
+    response = proxy.app.test_client().get("/simple/six/", headers=headers)
+
+    assert response.status_code == 200
+    assert response.mimetype == content_type
+    if content_type == SIMPLE_JSON:
+        assert {file["filename"] for file in response.get_json()["files"]} == {"six-1.0-py3-none-any.whl", "six-1.0.tar.gz"}
+    else:
+        assert b"six-1.0.tar.gz</a>" in response.data
+
+
+def decode(response):
+    encoding = response.headers.get("Content-Encoding")
+    if encoding == "br":
+        return pytest.importorskip("brotli").decompress(response.data)
+    if encoding == "gzip":
+        return gzip.decompress(response.data)
+    return response.data
+
+
+@pytest.mark.parametrize("path", ["/simple/six/", "/simple/"])
+# encoding of the response with and without brotli-compressed pages
+@pytest.mark.parametrize("accept_encoding, with_brotli, without_brotli", [
+    (None, None, None),
+    ("identity", None, None),
+    ("gzip", "gzip", "gzip"),
+    ("gzip, deflate, br", "br", "gzip"),
+    ("br", "br", None),
+])
+def test_pages_are_negotiated_and_revalidated(proxy, path, accept_encoding, with_brotli, without_brotli):
+    client = proxy.app.test_client()
+    headers = {"Accept-Encoding": accept_encoding} if accept_encoding else {}
+    plain = client.get(path)
+    expected_encoding = with_brotli if proxy.page_cache.use_brotli else without_brotli
+
+    response = client.get(path, headers=headers)
+    assert response.status_code == 200
+    assert response.headers.get("Content-Encoding") == expected_encoding
+    assert decode(response) == plain.data
+    assert {"Accept", "Accept-Encoding"} <= set(response.vary)
+
+    etag = response.headers["ETag"]
+    # each encoding of the page has its own ETag
+    assert (etag == plain.headers["ETag"]) == (expected_encoding is None)
+
+    revalidated = client.get(path, headers=dict(headers, **{"If-None-Match": etag}))
+    assert revalidated.status_code == 304
+    assert revalidated.data == b""
+    assert revalidated.headers["ETag"] == etag
+
+    stale = client.get(path, headers=dict(headers, **{"If-None-Match": '"stale"'}))
+    assert stale.status_code == 200
+    assert decode(stale) == plain.data
+
+
+def test_pages_are_not_kept_in_brotli_when_disabled(make_proxy, upstream):
+    upstream.projects = {"six": {"six-1.0-py3-none-any.whl": b"wheel"}}
+    proxy = make_proxy(SIMPLE_PAGES_BROTLI=False)
+    response = proxy.app.test_client().get("/simple/six/", headers={"Accept-Encoding": "br, gzip"})
+
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert b"six-1.0-py3-none-any.whl</a>" in gzip.decompress(response.data)
@@ -0,0 +1,173 @@
+import email.utils
+import logging
+import time
+
+import pytest
+import requests
+
+from app import upstream_retry
+from app.http_client import HttpClient
+from app.remote_simple_index import RemoteSimpleIndex
+from app.upstream_retry import CircuitBreaker, CircuitOpenError, RetryPolicy, parse_retry_after
+
+logger = logging.getLogger(__name__)
+
+URL = "https://pypi.example/simple/six/"
+OTHER_HOST_URL = "https://files.example/six-1.0.tar.gz"
+
+
+class Clock:
+    """Stands in for the time module of upstream_retry, so that circuits open and close without waiting"""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+    def time(self):
+        return time.time()
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(upstream_retry, "time", clock)
+    return clock
+
+
+def test_parse_retry_after():
+    assert parse_retry_after("120") == 120
+    assert 55 < parse_retry_after(email.utils.formatdate(time.time() + 60, usegmt=True)) <= 60
+    assert parse_retry_after(email.utils.formatdate(time.time() - 60, usegmt=True)) == 0
+    assert parse_retry_after("soon") is None
+    assert parse_retry_after(None) is None
+
+
+def test_retry_delays(monkeypatch):
+    # the upper bound of the jitter
+    monkeypatch.setattr(upstream_retry.random, "uniform", lambda low, high: high)
+    policy = RetryPolicy(max_retries=5, backoff_base=0.5, backoff_max=3, retry_after_max=60)
+
+    assert [policy.get_delay(attempt) for attempt in range(5)] == [0.5, 1, 2, 3, None]
+    assert policy.get_delay(0, retry_after=30) == 30
+    # asked to wait too long: give up rather than hold the client
+    assert policy.get_delay(0, retry_after=120) is None
+    assert policy.get_delay(4, retry_after=1) is None
+    assert RetryPolicy(max_retries=0).max_retries == 1
+
+
+def test_circuit_opens_probes_and_closes(clock):
+    breaker = CircuitBreaker(logger, failure_threshold=3, reset_timeout=30)
+
+    for _ in range(2):
+        breaker.record_failure(URL)
+        breaker.before_request(URL)
+    breaker.record_failure(URL)
+    with pytest.raises(CircuitOpenError) as error:
+        breaker.before_request(URL)
+    assert error.value.host == "pypi.example"
+    assert error.value.retry_in == 30
+    # other hosts are still asked
+    breaker.before_request(OTHER_HOST_URL)
+
+    # half-open: one probe, the others keep failing at once
+    clock.now += 30
+    breaker.before_request(URL)
+    with pytest.raises(CircuitOpenError):
+        breaker.before_request(URL)
+
+    # failed probe opens the circuit again
+    breaker.record_response(URL, 503)
+    with pytest.raises(CircuitOpenError):
+        breaker.before_request(URL)
+
+    clock.now += 30
+    breaker.before_request(URL)
+    breaker.record_response(URL, 200)
+    assert breaker.hosts == {}
+    breaker.before_request(URL)
+    breaker.before_request(URL)
+
+
+def test_lost_probe_is_replaced(clock):
+    breaker = CircuitBreaker(logger, failure_threshold=1, reset_timeout=30)
+    breaker.record_failure(URL)
+    clock.now += 30
+    breaker.before_request(URL)
+
+    # the probe never reported back
+    clock.now += 29
+    with pytest.raises(CircuitOpenError):
+        breaker.before_request(URL)
+    clock.now += 1
+    breaker.before_request(URL)
+
+
+def test_retry_after_pauses_host(clock):
+    breaker = CircuitBreaker(logger, failure_threshold=5, reset_timeout=30, retry_after_max=60)
+
+    breaker.record_response(URL, 429, retry_after=10)
+    with pytest.raises(CircuitOpenError) as error:
+        breaker.before_request(URL)
+    assert error.value.retry_in == 10
+    clock.now += 10
+    breaker.before_request(URL)
+
+    # long pauses are cut to retry_after_max
+    breaker.record_response(URL, 503, retry_after=3600)
+    clock.now += 60
+    breaker.before_request(URL)
+
+
+def test_disabled_breaker_never_opens(clock):
+    breaker = CircuitBreaker(logger, failure_threshold=0)
+    for _ in range(10):
+        breaker.record_response(URL, 503, retry_after=10)
+    breaker.before_request(URL)
+    assert breaker.hosts == {}
+
+
+def make_remote_index(upstream, circuit_breaker=None):
+    return RemoteSimpleIndex(
+        logger,
+        f"{upstream.url}/simple/%s/",
+        f"{upstream.url}/pypi/%s/json",
+        http_client=HttpClient(logger, circuit_breaker=circuit_breaker),
+        retry_policy=RetryPolicy(max_retries=3, backoff_base=0),
+    )
+
+
+@pytest.mark.parametrize("fail_status, attempts, error", [
+    (503, 3, requests.exceptions.RequestException),
+    (429, 3, requests.exceptions.RequestException),
+    # 4xx answers are not retried
+    (404, 1, requests.exceptions.HTTPError),
+])
+def test_failed_requests_are_retried(upstream, fail_status, attempts, error):
+    upstream.projects = {"six": {"six-1.0-py3-none-any.whl": b"wheel"}}
+    upstream.fail_status = fail_status
+
+    with pytest.raises(error):
+        make_remote_index(upstream).fetch_simple_links("six")
+    assert len(upstream.requests) == attempts
+
+
+def test_open_circuit_stops_retries(upstream, clock):
+    upstream.projects = {"six": {"six-1.0-py3-none-any.whl": b"wheel"}}
+    upstream.fail_status = 503
+    remote_index = make_remote_index(upstream, CircuitBreaker(logger, failure_threshold=2, reset_timeout=30))
+
+    # the third attempt isn't sent: the circuit opened after the second one
+    with pytest.raises(CircuitOpenError):
+        remote_index.fetch_simple_links("six")
+    assert len(upstream.requests) == 2
+    with pytest.raises(CircuitOpenError):
+        remote_index.fetch_simple_links("six")
+    assert len(upstream.requests) == 2
+
+    upstream.fail_status = None
+    clock.now += 30
+    links, _, _ = remote_index.fetch_simple_links("six")
+    assert list(links) == ["six-1.0-py3-none-any.whl"]
+    assert len(upstream.requests) == 3
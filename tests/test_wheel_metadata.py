@@ -0,0 +1,74 @@
+import http.server
+import io
+import logging
+import threading
+import zipfile
+
+import pytest
+
+from app.cached_files import CachedFiles
+from app.db_sqlite import DBSQLite
+from app.download_manager import DownloadManager
+from app.wheel_metadata import WheelMetadata
+
+logger = logging.getLogger(__name__)
+
+METADATA = b"Metadata-Version: 2.1\nName: six\nVersion: 1.0\n"
+
+
+def make_wheel():
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w") as wheel:
+        wheel.writestr("six.py", b"")
+        wheel.writestr("six-1.0.dist-info/METADATA", METADATA)
+        wheel.writestr("six-1.0.dist-info/RECORD", b"")
+    return buffer.getvalue()
+
+
+WHEEL = make_wheel()
+
+
+class NoRangesServer(http.server.BaseHTTPRequestHandler):
+    """Serves the wheel, ignoring Range: every answer is the whole file; there is no upstream .metadata"""
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        if not self.path.endswith(".whl"):
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(WHEEL)))
+        self.end_headers()
+        self.wfile.write(WHEEL)
+
+
+@pytest.fixture
+def upstream():
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), NoRangesServer)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_port}"
+    server.shutdown()
+    server.server_close()
+
+
+def test_metadata_without_range_support_comes_from_the_whole_wheel(tmp_path, upstream):
+    db = DBSQLite(str(tmp_path / "remote_index.sqlite"))
+    cached_files = CachedFiles(logger, str(tmp_path / "cache"), "http://127.0.0.1:2222/", "download_file", db)
+    download_manager = DownloadManager(logger, cached_files, db=db)
+    wheel_metadata = WheelMetadata(logger, db, cached_files, download_manager)
+    wheel_url = f"{upstream}/files/six-1.0-py3-none-any.whl"
+
+    metadata_path = wheel_metadata.get_metadata_file(wheel_url + ".metadata")
+
+    with open(metadata_path, "rb") as f:
+        assert f.read() == METADATA
+    assert cached_files.find_cached_file(wheel_url) is not None
+
+
+def test_metadata_is_advertised_for_wheel_urls_only():
+    assert WheelMetadata.is_wheel_url("http://127.0.0.1:2222/download_file/aGVsbG8/six-1.0-py3-none-any.whl#sha256=00")
+    assert not WheelMetadata.is_wheel_url("http://127.0.0.1:2222/download_file/aGVsbG8/download?file=six-1.0-py3-none-any.whl")